@@ -0,0 +1,158 @@
+# End-to-end benchmark of packagebuilder, on a synthetic package tree (see synthetic_tree.py).
+#
+# Runs packagebuilder.main() on the tree, deploying to a local destination, in three scenarios:
+# - overwrite : first run, package-index-policy overwrite and deploy-policy wipe
+# - update-unchanged : package-index-policy update and deploy-policy update, nothing changed since the previous run
+# - update-changed : same, after modifying --changes percent of the files
+# Each phase is timed by wrapping the packagebuilder function doing it:
+# - scan : scan_root_paths (walking the root paths) and build_pacakge_list (listing packages, components and files). The walk is done by
+#   build_pacakge_list in older versions: both are timed, so that scan times compare with the results of these versions
+# - hash : hash_packages
+# - index : make_package_index (reading the old index, diff, writing the new index)
+# - compress : create_archives (building component archives, included in deploy)
+# - deploy : deploy_packages (raw files, archives and indexes)
+# - total : the whole run
+# The best time of --repeat runs is kept for each phase. Results are written as JSON, to be compared across commits.
+#
+# Example:
+# > python benchmarks\bench_end_to_end.py --packages 4 --components 10 --files 500 --output results.json
+# > python benchmarks\bench_end_to_end.py --packages 4 --components 10 --files 500 --baseline results.json
+
+import argparse
+import contextlib
+import functools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import packagebuilder
+import synthetic_tree
+
+PHASES = [ ('scan', 'scan_root_paths'), ('scan', 'build_pacakge_list'), ('hash', 'hash_packages'), ('index', 'make_package_index'), ('compress', 'create_archives'), ('deploy', 'deploy_packages') ]
+
+# Time spent in each phase during the current run
+phase_times = dict()
+
+def timed(phase, function):
+    """Returns 'function' wrapped to add the time spent in it to phase_times['phase']"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            phase_times[phase] = phase_times.get(phase, 0) + time.perf_counter() - start
+    return wrapper
+
+def run_packagebuilder(arguments, work_dir, verbose):
+    """Run packagebuilder.main() with the command line 'arguments' from 'work_dir', and return the time spent in each phase"""
+    phase_times.clear()
+    saved_argv = sys.argv
+    saved_cwd = os.getcwd()
+    sys.argv = [ packagebuilder.__file__ ] + arguments
+    os.chdir(work_dir)
+    try:
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            packagebuilder.main()
+        phase_times['total'] = time.perf_counter() - start
+    finally:
+        sys.argv = saved_argv
+        os.chdir(saved_cwd)
+    return dict(phase_times)
+
+def git_commit():
+    """Returns the current git commit of the package builder, if known"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(packagebuilder.__file__), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_scenarios(args, bench_dir):
+    """Run the three scenarios on a newly generated tree in 'bench_dir', and return the results of each scenario"""
+    tree_dir = os.path.join(bench_dir, 'tree')
+    work_dir = os.path.join(bench_dir, 'work')
+    destination = os.path.join(bench_dir, 'destination')
+    os.makedirs(work_dir)
+
+    file_count, byte_count = synthetic_tree.generate_tree_from_arguments(tree_dir, args)
+    # files modified just before a run are not stored in the hash cache (see HashCache.RACY_DELAY_NS)
+    time.sleep(packagebuilder.HashCache.RACY_DELAY_NS / 1000000000)
+    common_arguments = [ tree_dir, '--deploy', destination, '--jobs', str(args.jobs), '--compress-jobs', str(args.compress_jobs) ] + args.packagebuilder_arguments
+
+    results = []
+    results.append(('overwrite', run_packagebuilder(common_arguments + [ '--package-index-policy', 'overwrite', '--deploy-policy', 'wipe' ], work_dir, args.verbose)))
+    results.append(('update-unchanged', run_packagebuilder(common_arguments + [ '--package-index-policy', 'update', '--deploy-policy', 'update' ], work_dir, args.verbose)))
+    modified_count = synthetic_tree.modify_tree(tree_dir, args.changes, args.seed)
+    time.sleep(packagebuilder.HashCache.RACY_DELAY_NS / 1000000000)
+    results.append(('update-changed', run_packagebuilder(common_arguments + [ '--package-index-policy', 'update', '--deploy-policy', 'update' ], work_dir, args.verbose)))
+    return results, file_count, byte_count, modified_count
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the phases of packagebuilder on a synthetic package tree, in overwrite, unchanged update and changed update scenarios")
+    synthetic_tree.add_arguments(parser)
+    parser.add_argument('--changes', type=float, default=5, help='percentage of files modified before the update-changed scenario')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='packagebuilder --jobs')
+    parser.add_argument('--compress-jobs', type=int, default=os.cpu_count(), help='packagebuilder --compress-jobs')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs of the scenarios (on a new tree each time), the best time of each phase is kept')
+    parser.add_argument('--work-dir', help='folder where trees and destinations are generated (a temporary folder by default), removed afterwards')
+    parser.add_argument('--output', help='JSON file to write the results to (printed if not provided)')
+    parser.add_argument('--baseline', help='JSON results of a previous run, to compare the phase times with')
+    parser.add_argument('--verbose', action='store_true', help='show packagebuilder output')
+    parser.add_argument('packagebuilder_arguments', nargs=argparse.REMAINDER, help='other packagebuilder arguments, after --')
+    args = parser.parse_args()
+    if len(args.packagebuilder_arguments) != 0 and args.packagebuilder_arguments[0] == '--':
+        args.packagebuilder_arguments = args.packagebuilder_arguments[1:]
+
+    scenarios = dict()
+    for repeat in range(args.repeat):
+        bench_dir = tempfile.mkdtemp(prefix='packagebuilder-bench-', dir=args.work_dir)
+        try:
+            results, file_count, byte_count, modified_count = run_scenarios(args, bench_dir)
+        finally:
+            shutil.rmtree(bench_dir, ignore_errors=True)
+        for scenario, times in results:
+            best_times = scenarios.setdefault(scenario, dict())
+            for phase, elapsed in times.items():
+                best_times[phase] = min(best_times.get(phase, elapsed), elapsed)
+
+    report = {
+        'script_version': packagebuilder.script_version,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': dict((name, value) for name, value in vars(args).items() if name not in ('output', 'baseline', 'verbose', 'work_dir')),
+        'tree': { 'files': file_count, 'bytes': byte_count, 'modified_files': modified_count },
+        'scenarios': dict((scenario, dict((phase, round(elapsed, 6)) for phase, elapsed in times.items())) for scenario, times in scenarios.items()),
+    }
+
+    if args.output != None:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline != None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        print("%-18s %-10s %12s %12s %8s" % ("scenario", "phase", "baseline (s)", "current (s)", "ratio"))
+        for scenario, times in report['scenarios'].items():
+            for phase in list(dict.fromkeys(phase for phase, function_name in PHASES)) + [ 'total' ]:
+                baseline_time = baseline.get('scenarios', {}).get(scenario, {}).get(phase)
+                if baseline_time == None or not phase in times:
+                    continue
+                print("%-18s %-10s %12.4f %12.4f %8.2f" % (scenario, phase, baseline_time, times[phase], times[phase] / baseline_time if baseline_time != 0 else float('inf')))
+
+# Time the phases by wrapping the packagebuilder functions doing them (main() looks them up in the module when it runs)
+for phase, function_name in PHASES:
+    setattr(packagebuilder, function_name, timed(phase, getattr(packagebuilder, function_name)))
+
+if __name__ == '__main__':
+    main()
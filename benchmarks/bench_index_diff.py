@@ -0,0 +1,82 @@
+# Benchmark of the package index diff done by packagebuilder.diff_package_index (package-index-policy 'update').
+#
+# Builds synthetic new and old package indexes with a growing number of files per component, and times the diff between them.
+# The time per file should stay roughly constant when the number of files grows, i.e. the diff time scales linearly.
+# With --index-store, the diff done by IndexStore.diff (SQL joins against the old index saved in an index store) is timed as well.
+#
+# Example:
+# > python benchmarks\bench_index_diff.py --sizes 1000,10000,100000 --components 4 --changes 5
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import packagebuilder
+
+def make_package_index(files_per_component, components, changes, old):
+    """Build a PackageIndex with one package of 'components' components of 'files_per_component' files each. For the old index, 'changes' percent of the files have a different hash, and as many files only exist in the old or in the new index."""
+    changed_every = max(1, int(100 / changes)) if changes > 0 else 0
+    package = packagebuilder.Package('', 'Bench', 'Bench', 'Bench', '1.0', 'bench')
+    for component_number in range(components):
+        component = packagebuilder.Component('Component ' + str(component_number), 'lzma')
+        for file_number in range(files_per_component):
+            changed = changed_every != 0 and file_number % changed_every == 0
+            componentFile = packagebuilder.File(os.path.join('Dir' + str(file_number % 100), 'File' + str(file_number) + '.dll'))
+            componentFile.hash = '%032x' % file_number
+            if changed and old:
+                componentFile.hash = '%032x' % (file_number + 1)
+            component.append(componentFile)
+        # files only found in one of the indexes
+        for file_number in range(files_per_component // changed_every if changed_every != 0 else 0):
+            componentFile = packagebuilder.File(os.path.join('Only' + ('Old' if old else 'New'), 'File' + str(file_number) + '.dll'))
+            componentFile.hash = '%032x' % file_number
+            component.append(componentFile)
+        package.append(component)
+    return packagebuilder.PackageIndex([package])
+
+def main():
+    parser = argparse.ArgumentParser(description="Time packagebuilder.diff_package_index for growing numbers of files per component")
+    parser.add_argument('--sizes', default='1000,2000,4000,8000,16000,32000,64000', help='comma-separated list of number of files per component')
+    parser.add_argument('--components', type=int, default=2, help='number of components in the package')
+    parser.add_argument('--changes', type=float, default=5, help='percentage of modified files (and of added/removed files)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs for each size, the best time is kept')
+    parser.add_argument('--index-store', action='store_true', help='also time the diff against an index store holding the old index')
+    args = parser.parse_args()
+
+    print("%12s %12s %14s" % ("files", "diff (s)", "per file (us)") + (" %16s" % "store diff (s)" if args.index_store else ""))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        best_time = None
+        for repeat in range(args.repeat):
+            new_package_index = make_package_index(size, args.components, args.changes, False)
+            old_package_index = make_package_index(size, args.components, args.changes, True)
+            start = time.perf_counter()
+            packagebuilder.diff_package_index(new_package_index, old_package_index, 'update')
+            elapsed = time.perf_counter() - start
+            best_time = elapsed if best_time == None else min(best_time, elapsed)
+        files = size * args.components
+        line = "%12d %12.4f %14.3f" % (files, best_time, best_time * 1000000 / files)
+
+        if args.index_store:
+            best_store_time = None
+            store_dir = tempfile.mkdtemp(prefix='packagebuilder-bench-')
+            try:
+                index_store = packagebuilder.IndexStore(os.path.join(store_dir, 'package-index.db'))
+                index_store.record_run(make_package_index(size, args.components, args.changes, True), 'overwrite')
+                for repeat in range(args.repeat):
+                    new_package_index = make_package_index(size, args.components, args.changes, False)
+                    start = time.perf_counter()
+                    index_store.diff(new_package_index, 'update')
+                    elapsed = time.perf_counter() - start
+                    best_store_time = elapsed if best_store_time == None else min(best_store_time, elapsed)
+                index_store.close()
+            finally:
+                shutil.rmtree(store_dir, ignore_errors=True)
+            line += " %16.4f" % best_store_time
+        print(line)
+
+if __name__ == '__main__':
+    main()
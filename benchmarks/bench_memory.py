@@ -0,0 +1,128 @@
+# Memory benchmark of the package index model (Package, Component and File objects).
+#
+# Generates a synthetic package-index.xml of about --size MB, then measures, in a new process, the peak memory (resident set size)
+# of what make_package_index does with the update policy: the old and the new package indexes are both loaded, then compared by
+# diff_package_index. The same measure can be done with another version of packagebuilder.py (--baseline-script), to compare.
+# The baseline version must be importable and read package-index.xml from its file name (PackageIndex.import_from_xml(filename)):
+# versions before the streamed reading of package-index.xml can't be measured, the oldest ones parsing the command line and running
+# when loaded.
+#
+# Example:
+# > git show HEAD~1:packagebuilder.py > old_packagebuilder.py
+# > python benchmarks\bench_memory.py --size 25 --baseline-script old_packagebuilder.py
+
+import argparse
+import ctypes
+import importlib.util
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+PACKAGEBUILDER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'packagebuilder.py')
+
+def generate_index(filename, size, components, seed=0):
+    """Write a synthetic package index of about 'size' bytes to 'filename': packages of 'components' components, files spread over a few levels of folders, with random MD5 hashes. Returns the number of files."""
+    rng = random.Random(seed)
+    file_count = 0
+    package_number = 0
+    with open(filename, 'w', encoding='us-ascii') as index_file:
+        index_file.write('<WideIndex>')
+        while index_file.tell() < size:
+            package_id = 'product' + str(package_number) + '-1.0'
+            index_file.write('\n  <Package Type="product' + str(package_number) + '" Id="' + package_id + '" Name="Product ' + str(package_number) + '" Version="1.0" Description="Product ' + str(package_number) + ' (synthetic)">')
+            for component_number in range(components):
+                index_file.write('\n    <Component Name="Component ' + str(component_number) + '" Compression="lzma">')
+                for file_number in range(1000):
+                    path = os.path.join('Comp' + str(component_number), 'Sub' + str(file_number % 7), 'Sub' + str(file_number % 3), 'File' + str(file_number) + '.c' + str(component_number))
+                    index_file.write('\n      <File Path="' + path + '" Hash="' + '%032x' % rng.getrandbits(128) + '" />')
+                    file_count += 1
+                index_file.write('\n    </Component>')
+            index_file.write('\n  </Package>')
+            package_number += 1
+        index_file.write('\n</WideIndex>\n')
+    return file_count
+
+def peak_rss():
+    """Returns the peak resident set size of the current process, in bytes"""
+    try:
+        import resource
+    except ImportError: # Windows
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', ctypes.c_uint32), ('PageFaultCount', ctypes.c_uint32)] + [(name, ctypes.c_size_t) for name in ('PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage')]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.kernel32.K32GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def measure(script, index_filename):
+    """Load packagebuilder from 'script', load the package index twice and diff the copies, and return the peak memory along with the memory used before loading"""
+    spec = importlib.util.spec_from_file_location('packagebuilder', script)
+    packagebuilder = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(packagebuilder)
+    except SystemExit:
+        raise ImportError(script + " can't be imported: it parses the command line and runs when loaded")
+
+    start_rss = peak_rss()
+    old_package_index = packagebuilder.PackageIndex()
+    old_package_index.import_from_xml(index_filename)
+    new_package_index = packagebuilder.PackageIndex()
+    new_package_index.import_from_xml(index_filename)
+    packagebuilder.diff_package_index(new_package_index, old_package_index, 'update')
+    return { 'start_rss': start_rss, 'peak_rss': peak_rss() }
+
+def measure_in_process(script, index_filename):
+    """Run measure() in a new process, so that each measure starts from a fresh heap"""
+    process = subprocess.run([sys.executable, __file__, '--measure', script, index_filename], capture_output=True, text=True)
+    if process.returncode != 0:
+        print("Error: can't measure " + script + ": " + (process.stderr.strip().splitlines() or [ "exit status " + str(process.returncode) ])[-1])
+        exit(1)
+    return json.loads(process.stdout)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the peak memory of loading and comparing two copies of a synthetic package index, as done by the update policy")
+    parser.add_argument('--size', type=float, default=25, help='size of the synthetic package index, in MB')
+    parser.add_argument('--components', type=int, default=10, help='number of components per package (of 1000 files each)')
+    parser.add_argument('--baseline-script', help='another version of packagebuilder.py to measure, for comparison')
+    parser.add_argument('--work-dir', help='folder where the package index is generated (a temporary folder by default), removed afterwards')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--measure', nargs=2, metavar=('SCRIPT', 'INDEX'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure != None:
+        print(json.dumps(measure(*args.measure)))
+        return
+
+    bench_dir = tempfile.mkdtemp(prefix='packagebuilder-bench-', dir=args.work_dir)
+    try:
+        index_filename = os.path.join(bench_dir, 'package-index.xml')
+        file_count = generate_index(index_filename, int(args.size * 1000000), args.components)
+        index_size = os.path.getsize(index_filename)
+        scripts = [ ('current', os.path.abspath(PACKAGEBUILDER_SCRIPT)) ]
+        if args.baseline_script != None:
+            scripts.insert(0, ('baseline', os.path.abspath(args.baseline_script)))
+        results = dict((name, measure_in_process(script, index_filename)) for name, script in scripts)
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+    print("Package index: " + str(index_size) + " bytes, " + str(file_count) + " file(s), loaded twice")
+    print("%-10s %16s %16s %14s" % ("script", "peak RSS (MB)", "index RSS (MB)", "bytes/file"))
+    for name, result in results.items():
+        index_rss = result['peak_rss'] - result['start_rss']
+        print("%-10s %16.1f %16.1f %14.1f" % (name, result['peak_rss'] / 1000000, index_rss / 1000000, index_rss / file_count / 2))
+    if 'baseline' in results:
+        print("Peak RSS reduction: %.1f%%" % (100 * (1 - results['current']['peak_rss'] / results['baseline']['peak_rss'])))
+
+    if args.output != None:
+        with open(args.output, 'w') as output_file:
+            json.dump({ 'index_bytes': index_size, 'files': file_count, 'results': results }, output_file, indent=2)
+
+if __name__ == '__main__':
+    main()
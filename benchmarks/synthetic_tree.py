@@ -0,0 +1,132 @@
+# Generator of synthetic package trees, for the packagebuilder benchmarks.
+#
+# A tree holds one folder per product, laid out like the samples of Samples\Package Definitions: a *.package-definition file per
+# package version, and a *.package-components file listing components as 'name;package ids;patterns[;compression]'. Several
+# packages can share the same folder and components (as wynsure and wynsure-dev do).
+# Components are folders of files with a given extension, spread over a few levels of sub-folders. A component pattern either uses
+# '**' (Comp1/**/*.c1) or lists each level (Comp1/*.c1,Comp1/*/*.c1,...), depending on the '**' pattern density.
+#
+# Example:
+# > python benchmarks\synthetic_tree.py D:\bench\tree --packages 4 --components 10 --files 500 --file-size 20000
+
+import argparse
+import math
+import os
+import random
+
+SUBFOLDER_DEPTH = 3 # levels of sub-folders in each component folder
+SUBFOLDERS = 4 # sub-folders per folder
+
+def file_size(rng, mean_size, distribution):
+    """Returns a random file size, of 'mean_size' bytes on average, following 'distribution' (fixed, uniform or lognormal)"""
+    if distribution == 'fixed':
+        return mean_size
+    if distribution == 'uniform':
+        return rng.randint(0, 2 * mean_size)
+    # lognormal: many small files and a few big ones, as in a real product folder
+    sigma = 1.5
+    return int(rng.lognormvariate(math.log(max(1, mean_size)) - sigma * sigma / 2, sigma))
+
+def file_content(rng, size):
+    """Returns 'size' bytes of content, half random and half repeated text, so that files compress about as well as binaries do"""
+    random_size = size // 2
+    return rng.randbytes(random_size) + (b'eWAM package builder benchmark ' * (size // 31 + 1))[:size - random_size]
+
+def component_folder(component_number, file_number):
+    """Returns the folder of a file of a component, relative to the component folder"""
+    folders = []
+    for level in range(file_number % (SUBFOLDER_DEPTH + 1)):
+        folders.append('Sub' + str((file_number >> (2 * level)) % SUBFOLDERS))
+    return os.path.join(*folders) if len(folders) != 0 else ''
+
+def component_pattern(component_number, recursive):
+    """Returns the patterns of a component of the *.package-components file"""
+    extension = '*.c' + str(component_number)
+    if recursive:
+        return 'Comp' + str(component_number) + '/**/' + extension
+    return ','.join('Comp' + str(component_number) + '/' + '*/' * level + extension for level in range(SUBFOLDER_DEPTH + 1))
+
+def generate_tree(root, packages=2, components=10, files_per_component=100, file_size_mean=10000, size_distribution='lognormal', recursive_ratio=0.5, raw_ratio=0.2, packages_per_folder=2, seed=0):
+    """Generate a synthetic package tree in 'root': 'packages' packages of 'components' components of 'files_per_component' files each. 'recursive_ratio' is the share of components using '**' patterns, 'raw_ratio' the share of components deployed as raw files (compression None). Packages are grouped by 'packages_per_folder' in product folders, the packages of a folder sharing the same files. Returns the number of files and bytes written."""
+    rng = random.Random(seed)
+    file_count = 0
+    byte_count = 0
+    folders = (packages + packages_per_folder - 1) // packages_per_folder
+    for folder_number in range(folders):
+        product = 'Product' + str(folder_number)
+        folder = os.path.join(root, product.lower())
+        os.makedirs(folder, exist_ok=True)
+
+        # package definitions: several versions of the product share the folder
+        for version_number in range(min(packages_per_folder, packages - folder_number * packages_per_folder)):
+            version = '1.0.' + str(version_number)
+            package_id = product.lower() + '-' + version
+            with open(os.path.join(folder, package_id + '.package-definition'), 'w') as definition_file:
+                definition_file.write('unique-id:' + package_id + '\n')
+                definition_file.write('name:' + product + ' ' + version + '\n')
+                definition_file.write('description:' + product + ' ' + version + ' (synthetic)\n')
+                definition_file.write('product:' + product + '\n')
+                definition_file.write('version:' + version)
+
+        # components, shared by all the packages of the folder
+        with open(os.path.join(folder, product.lower() + '.package-components'), 'w') as components_file:
+            for component_number in range(components):
+                compression = ';None' if rng.random() < raw_ratio else ''
+                components_file.write('Component ' + str(component_number) + ';*;' + component_pattern(component_number, rng.random() < recursive_ratio) + compression + '\n')
+
+        for component_number in range(components):
+            for file_number in range(files_per_component):
+                file_folder = os.path.join(folder, 'Comp' + str(component_number), component_folder(component_number, file_number))
+                os.makedirs(file_folder, exist_ok=True)
+                content = file_content(rng, file_size(rng, file_size_mean, size_distribution))
+                with open(os.path.join(file_folder, 'File' + str(file_number) + '.c' + str(component_number)), 'wb') as component_file:
+                    component_file.write(content)
+                file_count += 1
+                byte_count += len(content)
+    return file_count, byte_count
+
+def modify_tree(root, percent, seed=0):
+    """Modify 'percent' percent of the component files of the tree in 'root' (changing a few bytes in the middle of the file, or appending some if it is empty). Returns the number of files modified."""
+    rng = random.Random(seed)
+    filenames = []
+    for folder, subfolders, names in os.walk(root):
+        subfolders.sort()
+        for name in sorted(names):
+            if not name.endswith('.package-definition') and not name.endswith('.package-components'):
+                filenames.append(os.path.join(folder, name))
+
+    modified = rng.sample(filenames, int(len(filenames) * percent / 100))
+    for filename in modified:
+        with open(filename, 'r+b') as component_file:
+            size = component_file.seek(0, os.SEEK_END)
+            component_file.seek(size // 2)
+            component_file.write(rng.randbytes(8))
+    return len(modified)
+
+def add_arguments(parser):
+    """Add the arguments of the tree generator to an argparse parser"""
+    parser.add_argument('--packages', type=int, default=2, help='number of packages')
+    parser.add_argument('--components', type=int, default=10, help='number of components per package')
+    parser.add_argument('--files', type=int, default=100, help='number of files per component')
+    parser.add_argument('--file-size', type=int, default=10000, help='mean file size, in bytes')
+    parser.add_argument('--size-distribution', choices=['fixed', 'uniform', 'lognormal'], default='lognormal', help='distribution of the file sizes')
+    parser.add_argument('--recursive-ratio', type=float, default=0.5, help="share of the components using '**' patterns, between 0 and 1")
+    parser.add_argument('--raw-ratio', type=float, default=0.2, help='share of the components deployed as raw files instead of archives, between 0 and 1')
+    parser.add_argument('--packages-per-folder', type=int, default=2, help='number of packages (versions of a product) sharing the same folder and files')
+    parser.add_argument('--seed', type=int, default=0, help='random seed, the same seed always gives the same tree')
+
+def generate_tree_from_arguments(root, args):
+    """Generate a tree in 'root' from the arguments added by add_arguments"""
+    return generate_tree(root, args.packages, args.components, args.files, args.file_size, args.size_distribution, args.recursive_ratio, args.raw_ratio, args.packages_per_folder, args.seed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic package tree for the packagebuilder benchmarks")
+    parser.add_argument('root', help='folder of the tree to generate')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    file_count, byte_count = generate_tree_from_arguments(args.root, args)
+    print("Generated " + str(file_count) + " file(s), " + str(byte_count) + " bytes in " + args.root)
+
+if __name__ == '__main__':
+    main()
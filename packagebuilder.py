@@ -9,7 +9,29 @@ import time
 import argparse
 import fnmatch
 import hashlib
+import zlib
 import time
+import sqlite3
+import threading
+import concurrent.futures
+import re
+import tempfile
+import functools
+import errno
+import struct
+import json
+import contextlib
+import select
+import ctypes
+import gzip
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+try:
+    import brotli
+except ImportError: # optional, only needed by --precompress brotli
+    brotli = None
 
 # This script is designed to walk a directory tree to find *.package-definition files and associated *.package-components.
 # These files contain package definitions to be prepared and deployed to a website, in order to make the packages available to 
@@ -18,7 +40,7 @@ import time
 # Example:
 # > python packagebuilder.py D:\wyde\ --package-index-policy overwrite --deploy C:\inetpub\wwwroot\eWamUpdate --wipe-destination
 
-script_version = '2019-01-10'
+script_version = '2026-10-17'
 
 parser = argparse.ArgumentParser(description="Index and deploy products referenced by *.package-definition and *.package-components")
 parser.add_argument('root_pathes', metavar='PATH', nargs='+', help='root path for indexing')
@@ -26,43 +48,322 @@ parser.add_argument('--package-index', help='package index file', default='packa
 parser.add_argument('--package-index-policy', choices=['overwrite', 'append', 'update', 'update-keep-old-packages'], help='Decide what to do if package-index already exists: overwrite=overwrite existing, append=append to existing, update=update existing package-index including removing package, components and files that ate not found anymore, update-keep-old-packages=update but keep old packages that where not found anymore, only update packages', required=True)
 parser.add_argument('--deploy', help='If provided, should specify where packages files should be deployed. No deployment is done if this argument is not provided.')
 parser.add_argument('--deploy-policy', choices=['wipe', 'update'], help='Decide what to do with existing deployed files: wipe=wipe existing in destination folder, update=update existing files in destination folder includeing remove files, pacakges, components that dont exist anymore. Use update-keep-old-packages for package-index-policy in order to prevent deletion of old packages that you removed from source.')
+parser.add_argument('--package-index-mode', choices=['full', 'sharded'], default='full', help='full=the package index lists every file of every component of every package, sharded=the package index only lists packages and components, the files of each package are listed in a sub-index deployed in the package folder (referenced by the IndexUrl and IndexHash attributes of the package)')
+parser.add_argument('--hash-cache', help='File hash cache database, used to skip re-hashing files that did not change since the previous run (same path, size, modification time and inode). Entries of the files that were not hashed or looked up by a run are dropped at its end: the cache only holds the files of the last run. Defaults to <package-index>.hash-cache next to the package index file.')
+parser.add_argument('--index-store', help='SQLite database holding the packages, components, files and hashes of the package index, and the changes of each run. Once it holds a run, the package index of the previous run is read from it instead of the deployed package index: the new index is compared with it by SQL joins, only the differences being loaded. It can be queried with packagequery.py (which packages contain a file, what changed since a run). No store is kept if this argument is not provided.')
+parser.add_argument('--rehash', action='store_true', help='Ignore the file hash cache content and re-hash every file. The cache is refreshed with the new hashes.')
+parser.add_argument('--defer-hash', action='store_true', help='When deploying, files of compressed components that are not found in the hash cache are hashed while their component archive is created, instead of being hashed then read again for compression. Such files are considered modified. The package index is written once archives are created.')
+parser.add_argument('--hash-algorithm', choices=['md5', 'sha256', 'blake2b'], default='md5', help='Algorithm of the file hashes (and sub-index and delta archive hashes) of the package index. The package index records it in its HashAlgorithm attribute (absent for md5). When updating a package index hashed with another algorithm, files are hashed with both algorithms once, so that only files which content changed are found modified. Defaults to md5.')
+parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of files hashed in parallel. Defaults to the number of processors.')
+parser.add_argument('--compress-jobs', type=int, default=os.cpu_count(), help='Number of component archives built in parallel, each in its own process. Defaults to the number of processors.')
+parser.add_argument('--compression-mode', choices=['fixed', 'auto'], default='fixed', help="fixed=every file of a component archive is compressed with the compression method of the component, auto=files that barely compress (already compressed content such as archives, images or installers) are stored without compression in the archive, the others are compressed with the method of the component. The decision is made by compressing the beginning of the file with a fast method, and remembered by file hash in the hash cache database.")
+parser.add_argument('--compression-level', type=int, help='Compression level of component archives, from 0 (fastest) to 9 (smallest), for the deflate (zip) and bzip2 (1 to 9) methods. Defaults to the default level of each method. lzma always uses its default preset.')
+parser.add_argument('--archive-part-size', type=float, help='Split the archive of a compressed component which files total more than this size (in MB) into several archives, <component>.part-NNN.zip, of at most about this size of files (a single file bigger than this size gets a part of its own). Files are assigned to parts by a hash of their path, the number of parts being a power of 2, so that unchanged files stay in the same part: when a file changes, only its part is rebuilt and redeployed with the update deploy policy. The parts of a component are listed by the Part elements of the component, with their digest (in the sub-index of its package, with the sharded package index mode). Components are only split (or split again, after a change of this size) once they are modified, or deployed with the wipe deploy policy. Components are not split if this argument is not provided.')
+parser.add_argument('--archive-cache', help='Folder of a local cache of component archives, indexed by the content of the component (compression method, paths and hashes of its files). A component archive found in the cache is reused instead of being compressed again. No cache is used if this argument is not provided.')
+parser.add_argument('--archive-cache-max-size', type=int, help='Maximum size of the archive cache, in MB. The least recently used archives are removed from the cache when it gets bigger.')
+parser.add_argument('--link-mode', choices=['copy', 'hardlink', 'reflink', 'auto'], default='copy', help='How files are deployed: copy=copy files, hardlink=hard link deployed files to the source files (destination on the same volume as the sources, deployed files must not be modified), reflink=copy-on-write clone of the source files (file systems supporting it, such as Btrfs or XFS), auto=reflink if possible, hard link otherwise, copy as a last resort. Destination files that already have the size and hash of the indexed file are never rewritten.')
+parser.add_argument('--deploy-jobs', type=int, default=8, help='Number of files deployed in parallel (raw files of components without compression). Deploying many small files to a network share is limited by the latency of each copy rather than by the bandwidth, more files than processors can be deployed at once. Defaults to 8.')
+parser.add_argument('--deploy-retries', type=int, default=5, help='Number of retries of a file that could not be deployed (e.g. locked by the web server), waiting 1, 2, 4... seconds (at most 60) between retries. Files still failing are listed once every other file is deployed, and the package index is not deployed: clients keep using the previous one. Defaults to 5.')
+parser.add_argument('--deploy-staging', action='store_true', help='Deploy the packages that changed to a staging folder of the destination (.staging), then publish them right before the package index: the folder of each package is replaced by its staged folder by renaming folders, one package after the other. Clients never see a partially updated package folder, but the previous package index may be served with the new archives until it is replaced, and a package folder is missing between its two renames. Use the objects deploy layout for a package index always consistent with the deployed archives. If a folder cannot be renamed, the folders already replaced are restored and the package index is not deployed. A staged folder starts with hard links to the files of the current folder of the package (copies if the destination does not support hard links), which the deploy then updates. Folders of removed packages are deleted once the new package index is deployed.')
+parser.add_argument('--deploy-layout', choices=['packages', 'objects'], default='packages', help='packages=files and component archives are deployed in a folder per package, objects=raw files and component archives are deployed once in a shared object store (objects folder of the destination), named after their hash (raw files) or digest (component archives, see the Digest attribute of components). Objects no longer referenced by any package are removed with the update deploy policy.')
+parser.add_argument('--delta', action='store_true', help='When deploying, also create a delta archive for each (re)built component archive, against the same component of the previous version of the product (same product, same id apart from the version), if it is deployed. The delta archive lists added and removed files and holds binary diffs of modified files. It is referenced by a Delta element of the component, with the base package version and the digest of the delta archive.')
+parser.add_argument('--delta-max-ratio', type=float, default=0.5, help='Delta archives bigger than this ratio of the full component archive are not kept: the full archive is downloaded instead. Defaults to 0.5.')
+parser.add_argument('--delta-max-file-size', type=float, default=32, help='Modified files bigger than this size (in MB), or whose previous version is, are not diffed: they are stored whole in the delta archive, like added files. Binary diffs are computed in memory (both versions of the file, in each of the --compress-jobs processes), and are slow on files that changed a lot. Defaults to 32.')
+parser.add_argument('--precompress', action='append', choices=['gzip', 'brotli'], default=[], help='When deploying, also write a precompressed copy (sidecar) of the package indexes, and of the raw files (components without compression) of at least --precompress-min-size bytes: <file>.gz for gzip, <file>.br for brotli (requires the brotli module). Can be repeated to write both. Sidecars are only written again when their file is deployed again (files of unchanged components deployed without sidecars get them with the wipe deploy policy), and are removed along with it. See Documentation/web.config to have IIS serve them to the clients accepting these encodings.')
+parser.add_argument('--precompress-min-size', type=int, default=2700, help='Minimum size of the files precompressed by --precompress, in bytes. Defaults to 2700, the minimum size of the files compressed by IIS.')
+parser.add_argument('--stats', action='store_true', help='Print a summary of the run: wall and CPU time of each phase (scan, parse, hash, index read, diff, index write, compress, delta, copy, precompress, deploy, publish, cleanup), bytes hashed, compressed and copied, compression ratio and time of the slowest components.')
+parser.add_argument('--trace-json', metavar='FILE', help='Write the statistics of the run (see --stats), with every compressed component, to a JSON file.')
+parser.add_argument('--quiet', action='store_true', help='Do not print a message for each file copied, removed or listed. Summaries are still printed.')
+parser.add_argument('--watch', action='store_true', help='After the first run, keep running and watch the root paths for changes: files added, modified or removed are matched against the component patterns of the packages, and only the matching components are updated, then the package index is written (and deployed, with the update deploy policy) again. A change of a *.package-definition or *.package-components file re-parses the packages of its root path. Stop with Ctrl+C.')
+parser.add_argument('--watch-debounce', type=float, default=2, help='With --watch, changes are processed once no other change happened for this many seconds, so that a burst of changes (e.g. a build) is processed at once. Defaults to 2.')
+parser.add_argument('--watch-method', choices=['auto', 'inotify', 'polling'], default='auto', help='With --watch, how changes are detected: inotify=Linux inotify API, polling=compare the size and modification time of every file at regular intervals, auto=inotify if available, polling otherwise.')
+parser.add_argument('--watch-poll-interval', type=float, default=5, help='With --watch and polling, number of seconds between two checks. Defaults to 5.')
 parser.add_argument('--version', action='version', version=script_version)
 
-args = parser.parse_args()
-
-script_name = sys.argv[0] 
-root_pathes = args.root_pathes
-package_index_file = args.package_index
-package_index_policy = args.package_index_policy
-destination = os.path.abspath(args.deploy)
-deploy_policy = args.deploy_policy
+# Settings, set from the command line arguments by parse_arguments()
+script_name = sys.argv[0]
+root_pathes = []
+package_index_file = 'package-index.xml'
+package_index_policy = 'overwrite'
+package_index_mode = 'full'
+destination = None
+deploy_policy = None
+hash_cache_file = None
+index_store_file = None
+rehash = False
+defer_hash = False
+hash_algorithm = 'md5'
+jobs = 1
+compress_jobs = 1
+compression_mode = 'fixed'
+compression_level = None
+archive_part_size = None
+archive_cache_dir = None
+archive_cache_max_size = None
+link_mode = 'copy'
+deploy_jobs = 8
+deploy_retries = 5
+deploy_staging = False
+deploy_layout = 'packages'
+delta = False
+delta_max_ratio = 0.5
+delta_max_file_size = 32 * 1024 * 1024
+precompress = []
+precompress_min_size = 2700
+show_stats = False
+trace_json_file = None
+quiet = False
+watch_changes = False
+watch_debounce = 2
+watch_method = 'auto'
+watch_poll_interval = 5
+
+# File hash cache, opened by main()
+hash_cache = None
+
+# Package index store, opened by main() if --index-store is provided
+index_store = None
+
+def parse_arguments(argv=None):
+    """Parse the command line arguments ('argv', sys.argv by default) and set the corresponding settings."""
+    global root_pathes, package_index_file, package_index_policy, package_index_mode, destination, deploy_policy, hash_cache_file, index_store_file, rehash, defer_hash, hash_algorithm, jobs, compress_jobs, compression_mode, compression_level, archive_part_size, archive_cache_dir, archive_cache_max_size, link_mode, deploy_jobs, deploy_retries, deploy_staging, deploy_layout, delta, delta_max_ratio, delta_max_file_size, precompress, precompress_min_size, show_stats, trace_json_file, quiet, watch_changes, watch_debounce, watch_method, watch_poll_interval
+
+    args = parser.parse_args(argv)
+
+    root_pathes = args.root_pathes
+    package_index_file = args.package_index
+    package_index_policy = args.package_index_policy
+    package_index_mode = args.package_index_mode
+    destination = os.path.abspath(args.deploy) if args.deploy != None else None
+    deploy_policy = args.deploy_policy
+    hash_cache_file = args.hash_cache if args.hash_cache != None else package_index_file + '.hash-cache'
+    index_store_file = args.index_store
+    rehash = args.rehash
+    defer_hash = args.defer_hash
+    hash_algorithm = args.hash_algorithm
+    jobs = max(1, args.jobs)
+    compress_jobs = max(1, args.compress_jobs)
+    compression_mode = args.compression_mode
+    compression_level = args.compression_level
+    if compression_level != None and not 0 <= compression_level <= 9:
+        print("Error: compression level should be between 0 and 9")
+        exit(1)
+    archive_part_size = int(args.archive_part_size * 1024 * 1024) if args.archive_part_size != None else None
+    if archive_part_size != None and archive_part_size <= 0:
+        print("Error: archive part size should be positive")
+        exit(1)
+    archive_cache_dir = os.path.abspath(args.archive_cache) if args.archive_cache != None else None
+    archive_cache_max_size = args.archive_cache_max_size * 1024 * 1024 if args.archive_cache_max_size != None else None
+    link_mode = args.link_mode
+    deploy_jobs = max(1, args.deploy_jobs)
+    deploy_retries = max(0, args.deploy_retries)
+    deploy_staging = args.deploy_staging
+    deploy_layout = args.deploy_layout
+    delta = args.delta
+    delta_max_ratio = args.delta_max_ratio
+    delta_max_file_size = int(args.delta_max_file_size * 1024 * 1024)
+    if delta_max_file_size <= 0:
+        print("Error: delta max file size should be positive")
+        exit(1)
+    precompress = sorted(set(args.precompress))
+    precompress_min_size = max(0, args.precompress_min_size)
+    if 'brotli' in precompress and brotli == None:
+        print("Error: brotli precompression requires the brotli module (pip install brotli)")
+        exit(1)
+    show_stats = args.stats
+    trace_json_file = args.trace_json
+    quiet = args.quiet
+    watch_changes = args.watch
+    watch_debounce = max(0, args.watch_debounce)
+    watch_method = args.watch_method
+    watch_poll_interval = max(0.1, args.watch_poll_interval)
+
+def print_detail(message):
+    """Print a per-file message, unless --quiet is set"""
+    if not quiet:
+        print(message)
+
+def cpu_time():
+    """Returns the CPU time used by the process, its threads and its terminated child processes (e.g. the archive process pool)"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+class RunStats:
+    """Statistics of a run: wall and CPU time of each phase, counters (bytes hashed, files copied...) and compressed components. Phases can be nested, the time of a phase doesn't include the time of the phases run inside it. Phases are timed in the main thread, counters can be incremented from any thread."""
+
+    # Number of slowest components listed by print_summary()
+    SLOWEST_COMPONENTS = 10
+
+    def __init__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_time()
+        self.phases = dict() # phase name -> [wall time, cpu time, calls]
+        self.phase_stack = [] # running phases: [name, start wall time, start cpu time, wall time of sub-phases, cpu time of sub-phases]
+        self.counters = dict()
+        self.components = [] # compressed components
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager timing the phase 'name'"""
+        self.phase_stack.append([name, time.perf_counter(), cpu_time(), 0, 0])
+        try:
+            yield
+        finally:
+            name, start_wall, start_cpu, sub_wall, sub_cpu = self.phase_stack.pop()
+            wall = time.perf_counter() - start_wall
+            cpu = cpu_time() - start_cpu
+            phase = self.phases.setdefault(name, [0, 0, 0])
+            phase[0] += wall - sub_wall
+            phase[1] += cpu - sub_cpu
+            phase[2] += 1
+            if len(self.phase_stack) != 0:
+                self.phase_stack[-1][3] += wall
+                self.phase_stack[-1][4] += cpu
+
+    def add(self, counter, value=1):
+        """Add 'value' to 'counter'"""
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def component_compressed(self, package, component, source_bytes, archive_bytes, seconds):
+        """Record the creation of a component archive, of 'archive_bytes' bytes from 'source_bytes' bytes of files, in 'seconds' seconds"""
+        self.add('components compressed')
+        self.add('bytes compressed', source_bytes)
+        self.add('archive bytes', archive_bytes)
+        self.components.append({ 'package': package.id, 'component': component.name, 'compression': component.compression, 'files': len(component.files), 'source_bytes': source_bytes, 'archive_bytes': archive_bytes, 'ratio': archive_bytes / source_bytes if source_bytes != 0 else 1.0, 'seconds': seconds })
+
+    def to_dict(self):
+        """Returns the statistics as a dictionary, written by write_json()"""
+        return {
+            'script_version': script_version,
+            'arguments': sys.argv[1:],
+            'wall': time.perf_counter() - self.start_wall,
+            'cpu': cpu_time() - self.start_cpu,
+            'phases': dict((name, { 'wall': wall, 'cpu': cpu, 'calls': calls }) for name, (wall, cpu, calls) in self.phases.items()),
+            'counters': dict(self.counters),
+            'components': sorted(self.components, key=lambda component: component['seconds'], reverse=True),
+        }
+
+    def write_json(self, filename):
+        """Write the statistics to JSON file 'filename'"""
+        with open(filename, 'w') as json_file:
+            json.dump(self.to_dict(), json_file, indent=2)
+
+    def print_summary(self):
+        """Print the time of each phase, the counters and the slowest components"""
+        summary = self.to_dict()
+        print("Statistics:")
+        print("   %-12s %10s %10s %8s" % ("phase", "wall (s)", "cpu (s)", "calls"))
+        for name, phase in sorted(summary['phases'].items(), key=lambda item: item[1]['wall'], reverse=True):
+            print("   %-12s %10.3f %10.3f %8d" % (name, phase['wall'], phase['cpu'], phase['calls']))
+        print("   %-12s %10.3f %10.3f" % ("total", summary['wall'], summary['cpu']))
+
+        counters = summary['counters']
+        hash_wall = summary['phases'].get('hash', { 'wall': 0 })['wall']
+        print("   " + str(counters.get('files hashed', 0)) + " file(s) hashed, " + str(counters.get('bytes hashed', 0)) + " bytes" + (" (%.1f MB/s in the hash phase)" % (counters.get('bytes hashed', 0) / hash_wall / 1000000) if hash_wall != 0 else ""))
+        if counters.get('bytes compressed', 0) != 0:
+            print("   " + str(counters['components compressed']) + " component(s) compressed, " + str(counters['bytes compressed']) + " bytes to " + str(counters['archive bytes']) + " bytes (ratio %.3f)" % (counters['archive bytes'] / counters['bytes compressed']) + (", " + str(counters['files stored']) + " file(s) stored without compression" if counters.get('files stored', 0) != 0 else ""))
+        print("   " + str(counters.get('files copied', 0)) + " file(s) copied (" + str(counters.get('bytes copied', 0)) + " bytes), " + str(counters.get('files skipped', 0)) + " file(s) already deployed" + (", " + str(counters['deploy retries']) + " retried deploy(s)" if 'deploy retries' in counters else ""))
+        if 'sidecars written' in counters:
+            print("   " + str(counters['sidecars written']) + " sidecar(s) written (" + str(counters['sidecar bytes']) + " bytes)")
+        if 'searches reused' in counters or 'hashes reused' in counters:
+            print("   " + str(counters.get('searches reused', 0)) + " search(es) and " + str(counters.get('hashes reused', 0)) + " hash(es) reused by packages sharing the same folder")
+        if 'objects stored' in counters or 'objects skipped' in counters:
+            print("   " + str(counters.get('objects stored', 0)) + " object(s) stored, " + str(counters.get('objects skipped', 0)) + " already in the object store")
+
+        if len(summary['components']) != 0:
+            print("   Slowest components:")
+            print("      %-40s %10s %12s %12s %7s" % ("component", "time (s)", "source", "archive", "ratio"))
+            for component in summary['components'][:self.SLOWEST_COMPONENTS]:
+                print("      %-40s %10.3f %12d %12d %7.3f" % (component['package'] + " " + component['component'], component['seconds'], component['source_bytes'], component['archive_bytes'], component['ratio']))
+
+# Statistics of the run, see --stats and --trace-json
+stats = RunStats()
 
 
 class PackageIndex:
     """Represents a package index."""
 
-    def __init__(self, packages = []):
-        self.packages = packages
+    def __init__(self, packages = None):
+        self.packages = []
+        self.packages_by_id = dict() # first package of each id, for lookups
+        self.is_written = False # set by write_package_index()
+        self.hash_algorithm = hash_algorithm # algorithm of the file hashes, see --hash-algorithm
+        if packages != None:
+            for package in packages:
+                self.append(package)
+
+    def import_from_xml(self, package_index_file):
+        """Re-import PackageIndex from XML file. The file is parsed incrementally, and each element is cleared once converted, so the XML tree of the whole index is never held in memory."""
+        with stats.phase('index read'):
+            self.import_xml_elements(package_index_file)
+
+    def import_xml_elements(self, package_index_file):
+        """Convert the elements of XML file 'package_index_file' to packages, components and files, see import_from_xml"""
+        root = None
+        package = None
+        component = None
+        for event, element in ET.iterparse(package_index_file, events=('start', 'end')):
+            if event == 'start':
+                if root == None:
+                    root = element
+                    self.hash_algorithm = root.attrib.get('HashAlgorithm', 'md5')
+                elif element.tag == "Package" and package == None:
+                    package = Package('', '', '', '', '', '')
+                    package.import_from_xml(element)
+                elif element.tag == "Component" and package != None and component == None:
+                    component = Component('', '')
+                    component.import_from_xml(element)
+                continue
 
-    def import_from_xml(self, wideIndexXML):
-        """Re-import PackageIndex from XML"""
-        for child in wideIndexXML:
-            if child.tag == "Package":
-                package = Package('', '', '', '', '', '')
-                package.import_from_xml(child)
-                self.packages.append(package)
+            if element.tag == "File" and component != None:
+                componentFile = File('')
+                componentFile.import_from_xml(element)
+                component.append(componentFile)
+            elif element.tag == "Delta" and component != None:
+                component.delta = Delta('', '', '', '', 0)
+                component.delta.import_from_xml(element)
+            elif element.tag == "Part" and component != None:
+                part = Part('', '')
+                part.import_from_xml(element)
+                component.parts.append(part)
+            elif element.tag == "Component" and component != None:
+                package.append(component)
+                component = None
+            elif element.tag == "Package" and package != None:
+                # the files of a package of a sharded index are listed in its sub-index
+                if package.index_url != '':
+                    package.import_sub_index_from_xml(os.path.join(os.path.dirname(package_index_file), *package.index_url.split('/')))
+                self.append(package)
+                package = None
+                # drop the (cleared) package elements already converted
+                root.clear()
+            element.clear()
 
     def __getitem__(self, item):
         """Implementation of operator [] with a Package object as parmeter: returns the Package with same id, if exists."""
-        return next((x for x in self.packages if item.id == x.id), None)
+        return self.packages_by_id.get(item.id)
 
     def __contains__(self, item):
         """Implementation of operator 'in' : "if package in packageIndex..." : returns true if the Package with same id is found in the PackageIndex."""
-        return any((x for x in self.packages if item.id == x.id))
+        return item.id in self.packages_by_id
 
     def append(self, package):
         """Append a package to PackageIndex"""
         self.packages.append(package)
+        self.packages_by_id.setdefault(package.id, package)
+
+    def remove(self, package):
+        """Remove a Package from PackageIndex"""
+        self.packages.remove(package)
+        if self.packages_by_id.get(package.id) is package:
+            del self.packages_by_id[package.id]
+            # another package may have the same id
+            for other_package in self.packages:
+                if other_package.id == package.id:
+                    self.packages_by_id[package.id] = other_package
+                    break
         
     def sort(self):
         """Sort the list of packages by their name"""
@@ -70,17 +371,46 @@ class PackageIndex:
         for package in self.packages:
             package.sort()
     
-    def to_element_tree(self):
-        """Converts to an XML node."""
-        wideIndexXML = ET.Element('WideIndex')
+    def write_xml(self, package_index_file, sharded=False):
+        """Write the package index to an indented XML file. The XML is written package by package, without building the XML tree of the whole index. If 'sharded', files are not listed: packages reference their sub-index instead (see write_sub_indexes)."""
+        packages = [package for package in self.packages if len(package.components) != 0 and (package.state != "removed" or package_index_policy == "update-keep-old-packages")]
+
+        # the index of an object store layout tells where to find files and archives
+        root_attributes = ' Layout="objects"' if deploy_layout == 'objects' else ''
+        # md5 hashes are the default, for compatibility with older launchers
+        if hash_algorithm != 'md5':
+            root_attributes += ' HashAlgorithm="' + hash_algorithm + '"'
+
+        # us-ascii encoding with character references for other characters, as ElementTree.write() does.
+        # The index is written to a temporary file, then renamed: readers never see a partially written index.
+        temporary_file = package_index_file + '.tmp'
+        with open(temporary_file, 'w', encoding='us-ascii', errors='xmlcharrefreplace') as xml_file:
+            if len(packages) == 0:
+                xml_file.write('<WideIndex' + root_attributes + ' />')
+            else:
+                xml_file.write('<WideIndex' + root_attributes + '>')
+                for package in packages:
+                    package.write_xml(xml_file, 1, not sharded)
+                xml_file.write('\n</WideIndex>\n')
+        os.replace(temporary_file, package_index_file)
+
+    def write_sub_indexes(self, package_index_file):
+        """Set up the sub-index of each package of a sharded index: the sub-index of a package is a package index listing only this package, written in a folder named after the package id, next to 'package_index_file'. Sub-indexes are only (re)written for packages that are not unchanged, unchanged packages keep the hash of their previous sub-index."""
+        index_dir = os.path.dirname(os.path.abspath(package_index_file))
+        index_name = os.path.basename(package_index_file)
         for package in self.packages:
-            if len(package.components) != 0 and (package.state != "removed" or package_index_policy == "update-keep-old-packages"):
-                wideIndexXML.append(package.to_element_tree())
-        return wideIndexXML
+            if package.state == "removed":
+                continue
+            package.index_url = package.id + '/' + index_name
+            package.index_file = os.path.join(index_dir, package.id, index_name)
+            if package.state != "unchanged" or package.index_hash == '':
+                package.write_sub_index()
 
 class Package:
     """Represents a package. A package is composed of components, each containing files."""
 
+    __slots__ = ('source_path', 'type', 'name', 'description', 'id', 'version', 'components', 'components_by_name', 'component_patterns', 'state', 'index_url', 'index_hash', 'index_file')
+
     def __init__(self, source_path, name, description, product, version, package_id):
         self.source_path = source_path
         self.type = str.lower(product)
@@ -89,10 +419,16 @@ class Package:
         self.id = package_id
         self.version = version
         self.components = []
+        self.components_by_name = dict() # first component of each name, for lookups
+        self.component_patterns = dict() # name -> (compression, patterns) of every component defined for the package, including empty ones, see watch_package_index()
         self.state = 'added'
+        # sharded package index only: url of the package sub-index (relative to the package index), hash of the sub-index, and local sub-index file
+        self.index_url = ''
+        self.index_hash = ''
+        self.index_file = ''
 
     def import_from_xml(self, packageXML):
-        """Re-import Package from XML"""
+        """Re-import Package from XML, components are imported by PackageIndex.import_from_xml"""
         self.source_path = ''
         self.type = packageXML.attrib['Type']
         self.name = packageXML.attrib['Name']
@@ -100,20 +436,39 @@ class Package:
         self.id = packageXML.attrib['Id']
         self.version = packageXML.attrib['Version']
         self.components = []
+        self.components_by_name = dict()
         self.state = 'unchanged'
-        for child in packageXML:
-            if child.tag == "Component":
-                component = Component('', '')
-                component.import_from_xml(child)
-                self.components.append(component)
+        self.index_url = packageXML.attrib.get('IndexUrl', '')
+        self.index_hash = packageXML.attrib.get('IndexHash', '')
+        self.index_file = ''
+
+    def import_sub_index_from_xml(self, sub_index_file):
+        """Re-import the components and files of the Package from its sub-index file, if it exists"""
+        if not os.path.isfile(sub_index_file):
+            print("Warning: sub-index " + sub_index_file + " of package " + self.id + " not found.")
+            return
+        sub_index = PackageIndex()
+        sub_index.import_from_xml(sub_index_file)
+        sub_index_package = sub_index[self]
+        if sub_index_package != None:
+            self.components = []
+            self.components_by_name = dict()
+            for component in sub_index_package.components:
+                self.append(component)
+
+    def write_sub_index(self):
+        """Write the sub-index of the package to 'index_file', and set 'index_hash' accordingly."""
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        PackageIndex([self]).write_xml(self.index_file)
+        self.index_hash = hash_file(self.index_file)
 
     def __getitem__(self, item):
         """Implementation of operator [] with a Component object as parmeter: returns the Component with same name, if exists."""
-        return next((x for x in self.components if item.name == x.name), None)
+        return self.components_by_name.get(item.name)
 
     def __contains__(self, item):
         """Implementation of operator 'in' : "if component in package..." : returns true if the Component with same name is found in the Package."""
-        return any((x for x in self.components if item.name == x.name))
+        return item.name in self.components_by_name
 
     def sort(self):
         """Sort the list of components by their name"""
@@ -124,73 +479,100 @@ class Package:
     def append(self, component):
         """Append a Component to Package"""
         self.components.append(component)
+        self.components_by_name.setdefault(component.name, component)
+
+    def remove(self, component):
+        """Remove a Component from Package"""
+        self.components.remove(component)
+        if self.components_by_name.get(component.name) is component:
+            del self.components_by_name[component.name]
+            # another component may have the same name
+            for other_component in self.components:
+                if other_component.name == component.name:
+                    self.components_by_name[component.name] = other_component
+                    break
 
-    def to_element_tree(self):
-        """Converts to an XML node."""
-
-        packageXML = ET.Element('Package')
-        packageXML.set("Type", self.type)
-        packageXML.set("Id", self.id)
-        packageXML.set("Name", self.name)
-        packageXML.set("Version", self.version)
-        packageXML.set("Description", self.description)
-        # packageXML.set("State", self.state)
-
-        for component in self.components:
-            if len(component.files) != 0 and component.state != 'removed':
-                packageXML.append(component.to_element_tree())
-
-        return packageXML
+    def write_xml(self, xml_file, level, with_files=True):
+        """Write the package as an XML element, indented at 'level'. Without files, the package references its sub-index instead."""
+        components = [component for component in self.components if len(component.files) != 0 and component.state != 'removed']
+        attributes = [("Type", self.type), ("Id", self.id), ("Name", self.name), ("Version", self.version), ("Description", self.description)]
+        if not with_files:
+            attributes.extend([("IndexUrl", self.index_url), ("IndexHash", self.index_hash)])
+        write_xml_element(xml_file, level, 'Package', attributes, len(components) == 0)
+        if len(components) != 0:
+            for component in components:
+                component.write_xml(xml_file, level + 1, with_files)
+            xml_file.write('\n' + level * '  ' + '</Package>')
 
 class Component:
     """Component contained in a package. A component can be set to have its files compressed in a zip file, if 'compression' is set to deflate, zip lzma, bzip2, or store. 'store' means the files are stored in the zip file without compression. If compression is empty string, component files will be stored raw, not in an archive. The archive container format is always '.zip'. Compression specifies the compression algorithm used."""
 
+    __slots__ = ('name', 'compression', 'files', 'files_by_path', 'state', 'delta', 'parts', 'patterns')
+
     def __init__(self, name, compression="7z"):
         self.name = name
         self.compression = compression
         self.files = []
+        self.files_by_path = dict() # first file of each path, for lookups
         self.state = 'added'
+        self.delta = None # Delta archive against the previous version of the package, see create_deltas()
+        self.parts = [] # Part archives of a component split by --archive-part-size (empty if the component has a single archive), see deploy_packages()
+        self.patterns = [] # patterns of the *.package-components files, relative to the package folder
 
     def import_from_xml(self, componentXML):
-        """Re-import Component from XML"""
+        """Re-import Component from XML, files (and delta and parts) are imported by PackageIndex.import_from_xml"""
         self.name = componentXML.attrib['Name']
         self.compression = componentXML.attrib['Compression']
         self.files = []
+        self.files_by_path = dict()
         self.state = 'unchanged'
-        for child in componentXML:
-            if child.tag == "File":
-                componentfile = File('')
-                componentfile.import_from_xml(child)
-                self.files.append(componentfile)
+        self.delta = None
+        self.parts = []
 
     def __getitem__(self, item):
         """Implementation of operator [] with a File object as parmeter: returns the File with same path, if exists."""
-        return next((x for x in self.files if item.path == x.path), None)
+        return self.files_by_path.get(item.path)
 
     def __contains__(self, item):
         """Implementation of operator 'in' : "if file in component..." : returns true if the File with same path is found in the Component."""
-        return any((x for x in self.files if item.path == x.path))
+        return item.path in self.files_by_path
 
     def sort(self):
         """Sort the list of files by their path"""
         self.files.sort(key=lambda file:file.path)
 
+    def append(self, componentFile):
+        """Append given 'File' object, without checking the file exists."""
+        self.files.append(componentFile)
+        self.files_by_path.setdefault(componentFile.path, componentFile)
+
+    def remove(self, componentFile):
+        """Remove a File from Component"""
+        self.files.remove(componentFile)
+        if self.files_by_path.get(componentFile.path) is componentFile:
+            del self.files_by_path[componentFile.path]
+            # another file may have the same path
+            for other_file in self.files:
+                if other_file.path == componentFile.path:
+                    self.files_by_path[componentFile.path] = other_file
+                    break
+
     def append_file(self, componentFile):
         """Append given 'File' object."""
         if os.path.isfile(componentFile.path):
-            self.files.append(componentFile)
+            self.append(componentFile)
 
     def append_filepath(self, filename):
         """Create and append 'File' object for given file name."""
         if os.path.isfile(filename):
             componentFile = File(filename)
-            self.files.append(componentFile)
+            self.append(componentFile)
 
     def append_files(self, componentFiles):
         """Append given 'File' objects."""
         for componentFile in componentFiles:
             if os.path.isfile(componentFile.path):
-                self.files.append(componentFile)
+                self.append(componentFile)
 
     def append_filepathes(self, filenames):
         """Create and append 'File' object for each file name in the list."""
@@ -198,85 +580,1155 @@ class Component:
             if os.path.isfile(filename):
                 self.append_filepath(filename)
 
-    def append_wildcards_files(self, wildcards):
-        """Search and append wildcards path files, from current directory."""
-        found_files = glob.glob(wildcards, recursive=True)
+    def append_wildcards_files(self, wildcards, directory_index=None, base_dir='', scan_cache=None):
+        """Search and append wildcards path files, relative to 'base_dir' (current directory by default). If a DirectoryIndex of 'base_dir' is provided, files are searched in the index instead of the file system. If a ScanCache is provided, files matched by the same pattern in the same folder for another package are reused."""
+        if scan_cache != None:
+            found_files = scan_cache.get((os.path.abspath(base_dir), wildcards), find_files, wildcards, directory_index, base_dir)
+        else:
+            found_files = find_files(wildcards, directory_index, base_dir)
         for found_file in found_files:
-            found_file = os.path.normpath(found_file)
-            if os.path.isfile(found_file):
-                self.append_filepath(found_file)
+            self.append(File(found_file))
 
-    def create_zip(self, archive_filename):
-        """Create a zip file from Component 'files' list"""
-        archive_format = None
+    def archive_format(self):
+        """Returns the zipfile compression constant corresponding to the component 'compression'"""
         if self.compression == "deflate" or self.compression == "zip":
-            archive_format = zipfile.ZIP_DEFLATED
+            return zipfile.ZIP_DEFLATED
         elif self.compression == "lzma":
-            archive_format = zipfile.ZIP_LZMA
+            return zipfile.ZIP_LZMA
         elif self.compression == "bzip2":
-            archive_format = zipfile.ZIP_BZIP2
+            return zipfile.ZIP_BZIP2
         elif self.compression == "store":
-            archive_format = zipfile.ZIP_STORED
+            return zipfile.ZIP_STORED
         else:
             print("Warning: unknown compression method for " + self.name + ": '" + self.compression + "'")
             exit(1)
-        
-        if os.path.isfile(archive_filename):
-            os.remove(archive_filename)
-
-        with zipfile.ZipFile(archive_filename, mode='w', compression=archive_format) as zip_file:
-            for file in self.files:
-                zip_file.write(file.path)
-
-    def to_element_tree(self):
-        """Converts to an XML node."""
-        componentXML = ET.Element("Component")
-        componentXML.set("Name", self.name)
-        componentXML.set("Compression", self.compression)
-        # componentXML.set("State", self.state)
 
+    def archive_digest(self):
+        """Returns the digest identifying the content of the component archive: compression method, and sorted paths and hashes of the files. Archives being deterministic (see create_zip_archive), components with the same digest have identical archives."""
+        hasher = hashlib.md5()
+        hasher.update((ARCHIVE_LAYOUT_VERSION + '\n' + self.compression + compression_settings() + '\n').encode('utf-8'))
+        for path, file_hash in sorted((file.path, file.hash) for file in self.files):
+            hasher.update((path + '\0' + file_hash + '\n').encode('utf-8'))
+        return hasher.hexdigest()
+
+    def is_compressed(self):
+        """Returns True if the component files are deployed in a zip archive"""
+        return self.compression != None and self.compression != "None" and self.compression != ""
+
+    def has_deferred_hashes(self):
+        """Returns True if some files are not hashed yet (see --defer-hash)"""
+        return any(file.digest == None for file in self.files)
+
+    def split(self, base_dir=''):
+        """Returns the parts of the component archive (see --archive-part-size), as components named '<name>.part-NNN' holding the files of each part (the same File objects), or an empty list if the files of the component (relative to 'base_dir') total at most archive_part_size bytes. File are assigned to parts by a hash of their path modulo the number of parts, a power of 2: the number of parts is doubled until every part holds at most archive_part_size bytes, or a single file. When the number of parts doubles, each part is split in two (part N of P parts becomes part N or N + P). Empty parts are left out, without renumbering the others."""
+        if archive_part_size == None:
+            return []
+        file_sizes = []
         for componentFile in self.files:
-            if componentFile.state != 'removed':
-                componentXML.append(componentFile.to_element_tree())
+            full_path = os.path.join(base_dir, componentFile.path)
+            file_sizes.append((componentFile, os.path.getsize(full_path) if os.path.isfile(full_path) else 0))
+        total_size = sum(size for componentFile, size in file_sizes)
+        if total_size <= archive_part_size:
+            return []
+
+        part_count = 2
+        while part_count * archive_part_size < total_size:
+            part_count *= 2
+        while True:
+            part_files = [[] for number in range(part_count)]
+            part_sizes = [0] * part_count
+            for componentFile, size in file_sizes:
+                number = part_number(componentFile.path) % part_count
+                part_files[number].append(componentFile)
+                part_sizes[number] += size
+            if part_count >= ARCHIVE_MAX_PARTS or all(part_sizes[number] <= archive_part_size or len(part_files[number]) == 1 for number in range(part_count)):
+                break
+            part_count *= 2
+
+        parts = []
+        for number, files in enumerate(part_files):
+            if len(files) == 0:
+                continue
+            part = Component(self.name + '.part-%03d' % (number + 1), self.compression)
+            for componentFile in files:
+                part.append(componentFile)
+            parts.append(part)
+        return parts
+
+    def create_zip(self, archive_filename, base_dir=''):
+        """Create a zip file from Component 'files' list. File paths are relative to 'base_dir' (current directory by default). Files not hashed yet are hashed while being compressed."""
+        file_hashes, stored_files = create_zip_archive(*self.archive_arguments(archive_filename, base_dir))
+        self.set_deferred_hashes(file_hashes, base_dir)
+        self.set_stored_files(stored_files)
+
+    def archive_arguments(self, archive_filename, base_dir):
+        """Returns the arguments of create_zip_archive creating the component archive 'archive_filename', with files relative to 'base_dir'. Files not hashed yet are hashed while being compressed. With adaptive compression (see --compression-mode), the files already known to be incompressible (or not) from their hash are not sampled again."""
+        stored_files = None
+        if compression_mode == 'auto' and hash_cache != None:
+            stored_files = dict()
+            for componentFile in self.files:
+                stored = hash_cache.lookup_stored(componentFile.hash) if componentFile.hash != None else None
+                if stored != None:
+                    stored_files[componentFile.path] = stored
+        return (archive_filename, self.archive_format(), base_dir, [file.path for file in self.files], hash_algorithm if self.has_deferred_hashes() else None, compression_level, compression_mode == 'auto', stored_files)
+
+    def set_stored_files(self, stored_files):
+        """Remember in the hash cache, by file hash, the adaptive compression decision of each file ('stored_files' is a dictionary of path -> True if the file was stored without compression, as returned by create_zip_archive)"""
+        if hash_cache == None:
+            return
+        for componentFile in self.files:
+            if componentFile.path in stored_files and componentFile.hash != None and componentFile.hash != '':
+                hash_cache.store_stored(componentFile.hash, stored_files[componentFile.path])
 
-        return componentXML
+    def set_deferred_hashes(self, file_hashes, base_dir):
+        """Set the hashes calculated while creating the component archive ('file_hashes' is a dictionary of path -> (hash, os.stat of the file before it was read)), and store them in the hash cache."""
+        for componentFile in self.files:
+            if componentFile.digest == None and componentFile.path in file_hashes:
+                componentFile.hash, file_stat = file_hashes[componentFile.path]
+                stats.add('files hashed')
+                stats.add('bytes hashed', file_stat.st_size)
+                if hash_cache != None:
+                    hash_cache.store(os.path.join(base_dir, componentFile.path), file_stat, componentFile.hash)
+
+    def write_xml(self, xml_file, level, with_files=True):
+        """Write the component as an XML element, indented at 'level'. Its delta and parts (if any) are listed along with its files."""
+        files = [componentFile for componentFile in self.files if componentFile.state != 'removed'] if with_files else []
+        component_delta = self.delta if with_files else None
+        parts = self.parts if with_files else []
+        attributes = [("Name", self.name), ("Compression", self.compression)]
+        if deploy_layout == 'objects' and self.is_compressed():
+            attributes.append(("Digest", self.archive_digest()))
+        write_xml_element(xml_file, level, 'Component', attributes, len(files) == 0 and component_delta == None and len(parts) == 0)
+        if len(files) != 0 or component_delta != None or len(parts) != 0:
+            if component_delta != None:
+                component_delta.write_xml(xml_file, level + 1)
+            for part in parts:
+                part.write_xml(xml_file, level + 1)
+            for componentFile in files:
+                componentFile.write_xml(xml_file, level + 1)
+            xml_file.write('\n' + level * '  ' + '</Component>')
 
 class File:
+    """File of a component. An index can hold hundreds of thousands of files, twice while comparing the old and new indexes: files have no per-instance dictionary, their path is interned (shared by the files of both indexes), and their hash is kept as bytes, the hexadecimal 'hash' being only built when needed (e.g. to write the XML)."""
+
+    __slots__ = ('path', 'digest', 'state')
+
     def __init__(self, path):
-        self.path = os.path.normpath(path)
-        self.hash = ''
-        self.calculateHash()
+        self.path = sys.intern(os.path.normpath(path))
+        self.digest = b'' # hash as bytes, calculated later by calculateHash(), see hash_packages(). None if hashing is deferred to the creation of the component archive.
         self.state = 'added'
+
+    @property
+    def hash(self):
+        """Hexadecimal hash of the file, '' if not found, None if not hashed yet"""
+        return self.digest.hex() if self.digest != None else None
+
+    @hash.setter
+    def hash(self, value):
+        self.digest = bytes.fromhex(value) if value != None else None
         
     def import_from_xml(self, fileXML):
         """Re-import File from XML"""
-        self.path = fileXML.attrib['Path']
+        self.path = sys.intern(fileXML.attrib['Path'])
         self.hash = fileXML.attrib['Hash']
         self.state = 'unchanged'
 
-    def calculateHash(self):
-        """Calculate MD5 hash if the file"""
-        if not os.path.isfile(self.path):
+    def calculateHash(self, base_dir='', defer=False):
+        """Calculate the hash of the file (see --hash-algorithm), or get it from the hash cache if the file didn't change since it was last hashed. The file path is relative to 'base_dir' (current directory by default). If 'defer' is set, the hash is only taken from the cache: it is set to None if not found, to be calculated later when the component archive is created."""
+        full_path = os.path.join(base_dir, self.path)
+        if not os.path.isfile(full_path):
             self.hash = ""
             return
 
-        BLOCKSIZE = 65536
-        hasher = hashlib.md5()
-        with open(self.path, 'rb') as dataFile:
-            buf = dataFile.read(BLOCKSIZE)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = dataFile.read(BLOCKSIZE)
-        self.hash = hasher.hexdigest()
-
-    def to_element_tree(self):
-        """Converts to an XML node."""
-        fileXML = ET.Element("File")
-        fileXML.set("Path", self.path)
-        fileXML.set("Hash", self.hash)
-        # fileXML.set("State", self.state)
-        return fileXML
+        file_stat = os.stat(full_path)
+        if hash_cache != None:
+            cached_hash = hash_cache.lookup(full_path, file_stat)
+            if cached_hash != None:
+                self.hash = cached_hash
+                return
+
+        if defer:
+            self.hash = None
+            return
+
+        self.hash = hash_file(full_path)
+        stats.add('files hashed')
+        stats.add('bytes hashed', file_stat.st_size)
+
+        if hash_cache != None:
+            hash_cache.store(full_path, file_stat, self.hash)
+
+    def write_xml(self, xml_file, level):
+        """Write the file as an XML element, indented at 'level'."""
+        write_xml_element(xml_file, level, 'File', [("Path", self.path), ("Hash", self.hash)], True)
+
+class Delta:
+    """Delta archive of a component, against the same component of a previous version of the package ('base_id', 'base_version'). 'archive' is the name of the delta archive file in the package folder, 'digest' its hash (see --hash-algorithm) and 'size' its size in bytes. See create_delta_archive for its content."""
+
+    __slots__ = ('base_id', 'base_version', 'archive', 'digest', 'size')
+
+    def __init__(self, base_id, base_version, archive, digest, size):
+        self.base_id = base_id
+        self.base_version = base_version
+        self.archive = archive
+        self.digest = digest
+        self.size = size
+
+    def import_from_xml(self, deltaXML):
+        """Re-import Delta from XML"""
+        self.base_id = deltaXML.attrib['BaseId']
+        self.base_version = deltaXML.attrib['BaseVersion']
+        self.archive = deltaXML.attrib['Archive']
+        self.digest = deltaXML.attrib['Digest']
+        self.size = int(deltaXML.attrib['Size'])
+
+    def write_xml(self, xml_file, level):
+        """Write the delta as an XML element, indented at 'level'."""
+        write_xml_element(xml_file, level, 'Delta', [("BaseId", self.base_id), ("BaseVersion", self.base_version), ("Archive", self.archive), ("Digest", self.digest), ("Size", str(self.size))], True)
+
+class Part:
+    """Part archive of a component split by --archive-part-size. 'archive' is the name of the part archive file in the package folder, 'digest' the digest of its content (see Component.archive_digest), which is also its object name (with the .zip extension) in the objects deploy layout."""
+
+    __slots__ = ('archive', 'digest')
+
+    def __init__(self, archive, digest):
+        self.archive = archive
+        self.digest = digest
+
+    def import_from_xml(self, partXML):
+        """Re-import Part from XML"""
+        self.archive = partXML.attrib['Archive']
+        self.digest = partXML.attrib['Digest']
+
+    def write_xml(self, xml_file, level):
+        """Write the part as an XML element, indented at 'level'."""
+        write_xml_element(xml_file, level, 'Part', [("Archive", self.archive), ("Digest", self.digest)], True)
+
+# Maximum number of parts of a component archive split by --archive-part-size
+ARCHIVE_MAX_PARTS = 1024
+
+def part_number(path):
+    """Returns the number of the part of a split component archive holding the file 'path', modulo the number of parts (see Component.split). It only depends on the path (with '/' separators, so that it is the same on any platform)."""
+    return int.from_bytes(hashlib.md5(path.replace('\\', '/').encode('utf-8')).digest()[:4], 'little')
+
+# Version of the layout of the zip files created by create_zip_archive, part of the component archive digests. To be changed whenever the layout changes, so that archives cached with an older layout are not reused.
+ARCHIVE_LAYOUT_VERSION = '1'
+
+def compression_settings():
+    """Returns the archive settings other than the compression method (see --compression-mode and --compression-level), as a string appended to the method in the component archive digests. Empty for the default settings, so that digests don't change."""
+    settings = ''
+    if compression_mode != 'fixed':
+        settings += ' ' + compression_mode
+    if compression_level != None:
+        settings += ' level ' + str(compression_level)
+    return settings
+
+# Adaptive compression (see is_incompressible): size of the sample compressed, and minimum size reduction of the sample for the file to be compressed
+ADAPTIVE_SAMPLE_SIZE = 65536
+ADAPTIVE_MIN_GAIN = 0.02
+
+def is_incompressible(sample):
+    """Returns True if 'sample' (the beginning of a file) barely compresses: the fastest deflate level reduces it by less than ADAPTIVE_MIN_GAIN. This is cheap compared to compressing the whole file with lzma for no gain."""
+    sample = sample[:ADAPTIVE_SAMPLE_SIZE]
+    return len(sample) != 0 and len(zlib.compress(sample, 1)) > len(sample) * (1 - ADAPTIVE_MIN_GAIN)
+
+def create_zip_archive(archive_filename, archive_format, base_dir, file_paths, file_hash_algorithm=None, compression_level=None, adaptive=False, stored_files=None):
+    """Create a zip file containing the files of the 'file_paths' list, relative to 'base_dir' and stored with this relative path. The archive is deterministic: files are sorted by path, and stored with fixed timestamps and attributes, so that the same files always give the same archive. If 'file_hash_algorithm' is set, each file is hashed with this algorithm while it is compressed, from the same reads, and a dictionary of path -> (hash, os.stat of the file before it was read) is returned. If 'adaptive' is set, files that barely compress are stored without compression (see is_incompressible), unless the decision is given by 'stored_files' (dictionary of path -> True to store the file): a dictionary of path -> True if the file is stored is returned along with the hashes. Both dictionaries are empty when not requested. This is a module level function, so that archives can be created in a process pool (see create_archives)."""
+    if os.path.isfile(archive_filename):
+        os.remove(archive_filename)
+
+    BLOCKSIZE = 1024 * 1024
+    file_hashes = dict()
+    decisions = dict()
+    with zipfile.ZipFile(archive_filename, mode='w', compression=archive_format) as zip_file:
+        for file_path in sorted(file_paths):
+            source_filename = os.path.join(base_dir, file_path)
+            file_stat = os.stat(source_filename)
+            zip_info = zipfile.ZipInfo.from_file(source_filename, arcname=file_path)
+            zip_info.date_time = (1980, 1, 1, 0, 0, 0)
+            zip_info.external_attr = 0o100644 << 16
+            zip_info.compress_type = archive_format
+            if compression_level != None:
+                zip_info._compresslevel = compression_level # no public attribute before Python 3.13 (compress_level)
+            hasher = hashlib.new(file_hash_algorithm) if file_hash_algorithm != None else None
+            with open(source_filename, 'rb') as source_file:
+                buf = source_file.read(BLOCKSIZE)
+                if adaptive:
+                    stored = stored_files.get(file_path) if stored_files != None else None
+                    decisions[file_path] = stored if stored != None else is_incompressible(buf)
+                    if decisions[file_path]:
+                        zip_info.compress_type = zipfile.ZIP_STORED
+                with zip_file.open(zip_info, mode='w') as archived_file:
+                    while len(buf) > 0:
+                        if hasher != None:
+                            hasher.update(buf)
+                        archived_file.write(buf)
+                        buf = source_file.read(BLOCKSIZE)
+            if hasher != None:
+                file_hashes[file_path] = (hasher.hexdigest(), file_stat)
+    return file_hashes, decisions
+
+def create_zip_archive_timed(*args):
+    """Same as create_zip_archive, returning the time taken to create the archive along with its result"""
+    start = time.perf_counter()
+    file_hashes, stored_files = create_zip_archive(*args)
+    return file_hashes, stored_files, time.perf_counter() - start
+
+# Binary delta format (see make_binary_delta): header, then a list of operations rebuilding the new file from the base file
+BINARY_DELTA_HEADER = b'PBDELTA1'
+BINARY_DELTA_COPY = b'C' # followed by base offset and length (little endian, 8 bytes each): copy bytes from the base file
+BINARY_DELTA_INSERT = b'I' # followed by length (little endian, 8 bytes) and the bytes to insert
+BINARY_DELTA_BLOCK_SIZE = 64
+
+def common_prefix_length(a, a_start, b, b_start):
+    """Returns the length of the common prefix of bytes 'a' from 'a_start' and 'b' from 'b_start'. Slices of growing size are compared, then halved on mismatch, so long matches are compared in few steps."""
+    limit = min(len(a) - a_start, len(b) - b_start)
+    length = 0
+    step = 4096
+    while length < limit:
+        size = min(step, limit - length)
+        if a[a_start + length:a_start + length + size] == b[b_start + length:b_start + length + size]:
+            length += size
+            step *= 2
+        elif size == 1:
+            break
+        else:
+            step = size // 2
+    return length
+
+def make_binary_delta(base, target, max_size=None):
+    """Returns the binary delta rebuilding bytes 'target' from bytes 'base', or None if the delta gets bigger than 'max_size'. The base is indexed by blocks of BINARY_DELTA_BLOCK_SIZE bytes; the target is scanned for these blocks, and each block found is extended as far as base and target match, giving a copy operation. Bytes found nowhere in the base give insert operations."""
+    block_size = BINARY_DELTA_BLOCK_SIZE
+    blocks = dict()
+    for offset in range(0, len(base) - block_size + 1, block_size):
+        blocks.setdefault(base[offset:offset + block_size], offset)
+
+    operations = [ BINARY_DELTA_HEADER, struct.pack('<Q', len(target)) ]
+    delta_size = len(BINARY_DELTA_HEADER) + 8
+    position = 0
+    insert_start = 0
+    while position <= len(target) - block_size:
+        offset = blocks.get(target[position:position + block_size])
+        if offset == None:
+            position += 1
+            if max_size != None and delta_size + position - insert_start > max_size:
+                return None
+            continue
+
+        # extend the match backwards, over the bytes to insert
+        while position > insert_start and offset > 0 and base[offset - 1] == target[position - 1]:
+            position -= 1
+            offset -= 1
+        length = block_size + common_prefix_length(base, offset + block_size, target, position + block_size)
+
+        if position > insert_start:
+            operations.append(BINARY_DELTA_INSERT + struct.pack('<Q', position - insert_start))
+            operations.append(target[insert_start:position])
+            delta_size += 9 + position - insert_start
+        operations.append(BINARY_DELTA_COPY + struct.pack('<QQ', offset, length))
+        delta_size += 17
+        position += length
+        insert_start = position
+
+    if insert_start < len(target):
+        operations.append(BINARY_DELTA_INSERT + struct.pack('<Q', len(target) - insert_start))
+        operations.append(target[insert_start:])
+        delta_size += 9 + len(target) - insert_start
+    if max_size != None and delta_size > max_size:
+        return None
+    return b''.join(operations)
+
+def apply_binary_delta(base, binary_delta):
+    """Returns the bytes rebuilt from bytes 'base' and 'binary_delta' (see make_binary_delta). This is what a client of the delta archives has to do for each patched file."""
+    if not binary_delta.startswith(BINARY_DELTA_HEADER):
+        raise ValueError("not a binary delta")
+    position = len(BINARY_DELTA_HEADER)
+    target_size, = struct.unpack_from('<Q', binary_delta, position)
+    position += 8
+    target = []
+    while position < len(binary_delta):
+        operation = binary_delta[position:position + 1]
+        if operation == BINARY_DELTA_COPY:
+            offset, length = struct.unpack_from('<QQ', binary_delta, position + 1)
+            target.append(base[offset:offset + length])
+            position += 17
+        elif operation == BINARY_DELTA_INSERT:
+            length, = struct.unpack_from('<Q', binary_delta, position + 1)
+            target.append(binary_delta[position + 9:position + 9 + length])
+            position += 9 + length
+        else:
+            raise ValueError("unknown binary delta operation")
+    target = b''.join(target)
+    if len(target) != target_size:
+        raise ValueError("binary delta size mismatch")
+    return target
+
+def create_delta_archive(delta_filename, archive_format, base_archive_filename, base_files, base_dir, files, max_file_size=None):
+    """Create the delta archive rebuilding a component from its base archive 'base_archive_filename'. 'base_files' and 'files' are dictionaries of path -> hash of the base and new component files, new files being relative to 'base_dir'. The archive is deterministic, like the archives of create_zip_archive, and contains:
+    - delta.txt: one line per added, patched or removed file: state, path and hash of the new file, separated by tabulations. Files not listed are unchanged.
+    - added/<path>: new content of added files, and of modified files whose binary delta isn't smaller than the file itself, or which (or whose base file) is bigger than 'max_file_size' bytes.
+    - patched/<path>: binary delta of modified files (see make_binary_delta), to apply to the base file.
+    Only the files diffed are read in memory, along with their base file. Returns the size of the delta archive. This is a module level function, so that delta archives can be created in a process pool (see create_deltas)."""
+    if os.path.isfile(delta_filename):
+        os.remove(delta_filename)
+
+    BLOCKSIZE = 1024 * 1024
+
+    def entry_info(arcname, size):
+        zip_info = zipfile.ZipInfo(arcname, date_time=(1980, 1, 1, 0, 0, 0))
+        zip_info.external_attr = 0o100644 << 16
+        zip_info.compress_type = archive_format
+        zip_info.file_size = size
+        return zip_info
+
+    def write_entry(zip_file, arcname, data):
+        zip_file.writestr(entry_info(arcname, len(data)), data)
+
+    def write_file_entry(zip_file, arcname, source_filename):
+        """Write the content of file 'source_filename' as entry 'arcname', by blocks"""
+        with open(source_filename, 'rb') as source_file, zip_file.open(entry_info(arcname, os.path.getsize(source_filename)), mode='w') as archived_file:
+            shutil.copyfileobj(source_file, archived_file, BLOCKSIZE)
+
+    manifest = []
+    with zipfile.ZipFile(base_archive_filename) as base_archive, zipfile.ZipFile(delta_filename, mode='w', compression=archive_format) as zip_file:
+        for file_path in sorted(files):
+            file_hash = files[file_path]
+            if base_files.get(file_path) == file_hash:
+                continue
+            source_filename = os.path.join(base_dir, file_path)
+            binary_delta = None
+            if file_path in base_files:
+                base_info = base_archive.getinfo(file_path.replace(os.sep, '/'))
+                if max_file_size == None or (os.path.getsize(source_filename) <= max_file_size and base_info.file_size <= max_file_size):
+                    with open(source_filename, 'rb') as source_file:
+                        target = source_file.read()
+                    binary_delta = make_binary_delta(base_archive.read(base_info), target, len(target) - 1)
+            if binary_delta != None:
+                manifest.append('patched\t' + file_path + '\t' + file_hash)
+                write_entry(zip_file, 'patched/' + file_path, binary_delta)
+            else:
+                manifest.append('added\t' + file_path + '\t' + file_hash)
+                write_file_entry(zip_file, 'added/' + file_path, source_filename)
+        for file_path in sorted(base_files):
+            if not file_path in files:
+                manifest.append('removed\t' + file_path + '\t')
+        write_entry(zip_file, 'delta.txt', ''.join(line + '\n' for line in manifest).encode('utf-8'))
+    return os.path.getsize(delta_filename)
+
+def link_or_copy(source, destination):
+    """Hard link 'source' to 'destination', or copy it if it can't be linked (e.g. different volumes)."""
+    if os.path.isfile(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+class ArchiveCache:
+    """Content addressed cache of component archives: archives are stored in 'cache_dir' under their component digest (see Component.archive_digest). A component whose files didn't change is not compressed again, even if the old package index is lost, or if the component is part of several packages. If 'max_size' (in bytes) is set, the least recently used archives are removed by prune() when the cache gets bigger."""
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, digest):
+        """Returns the path of the cached archive of the given digest."""
+        return os.path.join(self.cache_dir, digest[:2], digest + '.zip')
+
+    def fetch(self, digest, archive_filename):
+        """Link or copy the cached archive of the given digest to 'archive_filename'. Returns False if the archive is not in the cache."""
+        cached_filename = self.path(digest)
+        if not os.path.isfile(cached_filename):
+            self.misses += 1
+            return False
+        link_or_copy(cached_filename, archive_filename)
+        os.utime(cached_filename)
+        self.hits += 1
+        return True
+
+    def store(self, digest, archive_filename):
+        """Store a newly created archive in the cache."""
+        cached_filename = self.path(digest)
+        os.makedirs(os.path.dirname(cached_filename), exist_ok=True)
+        # Link or copy to a temporary name first, so that the cache never holds a partial archive
+        temporary_filename = cached_filename + '.' + str(os.getpid()) + '.tmp'
+        link_or_copy(archive_filename, temporary_filename)
+        os.replace(temporary_filename, cached_filename)
+
+    def prune(self):
+        """Remove the least recently used archives until the cache size is under 'max_size'."""
+        if self.max_size == None:
+            return
+        cached_archives = []
+        for cached_filename in glob.glob(os.path.join(self.cache_dir, '*', '*.zip')):
+            cached_stat = os.stat(cached_filename)
+            cached_archives.append((cached_stat.st_mtime, cached_stat.st_size, cached_filename))
+        cache_size = sum(size for mtime, size, cached_filename in cached_archives)
+        for mtime, size, cached_filename in sorted(cached_archives):
+            if cache_size <= self.max_size:
+                break
+            os.remove(cached_filename)
+            cache_size -= size
+
+    def print_stats(self):
+        """Print hit/miss statistics."""
+        print("Archive cache: " + str(self.hits) + " hit(s), " + str(self.misses) + " miss(es)")
+
+def hash_file(filename, algorithm=None):
+    """Returns the hash of a file, calculated with 'algorithm' (--hash-algorithm by default). The file is read into a reusable buffer (by hashlib.file_digest, Python 3.11+), instead of allocating a new bytes object for each block."""
+    BLOCKSIZE = 262144
+    if algorithm == None:
+        algorithm = hash_algorithm
+    with open(filename, 'rb') as dataFile:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(dataFile, algorithm).hexdigest()
+        hasher = hashlib.new(algorithm)
+        buf = bytearray(BLOCKSIZE)
+        view = memoryview(buf)
+        size = dataFile.readinto(buf)
+        while size > 0:
+            hasher.update(view[:size])
+            size = dataFile.readinto(buf)
+    return hasher.hexdigest()
+
+def escape_xml_attribute(text):
+    """Escape an XML attribute value, the same way as ElementTree does."""
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    if "\r" in text:
+        text = text.replace("\r", "&#13;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    if "\t" in text:
+        text = text.replace("\t", "&#09;")
+    return text
+
+def write_xml_element(xml_file, level, tag, attributes, empty):
+    """Write the start tag of an XML element (or the whole element if it is 'empty'), on a new line indented at 'level'."""
+    xml_file.write('\n' + level * '  ' + '<' + tag)
+    for name, value in attributes:
+        xml_file.write(' ' + name + '="' + escape_xml_attribute(value) + '"')
+    xml_file.write(' />' if empty else '>')
+
+class HashCache:
+    """Persistent cache of file hashes, stored in a SQLite database. An entry maps an absolute file path to its hash, along with the size, modification time and inode of the file when it was hashed. The cached hash is reused only if all three are unchanged. Hashes of each algorithm are stored in their own table."""
+
+    # Files modified less than this many nanoseconds before the run started are not cached: they could still be modified within the same mtime tick without changing their size.
+    RACY_DELAY_NS = 2 * 1000000000
+
+    def __init__(self, filename, rehash=False, algorithm='md5'):
+        self.filename = filename
+        self.rehash = rehash
+        self.table = 'file_hashes' if algorithm == 'md5' else 'file_hashes_' + algorithm
+        self.entries = dict()
+        self.new_entries = dict()
+        # keys of the files looked up or stored during the run, the other entries are removed by commit(prune=True)
+        self.used = set()
+        # adaptive compression decisions (see --compression-mode): file hash -> True if the file is stored without compression
+        self.stored = dict()
+        self.new_stored = dict()
+        self.hits = 0
+        self.misses = 0
+        self.start_time_ns = time.time_ns()
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS " + self.table + " (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, hash TEXT)")
+
+        self.connection.execute("CREATE TABLE IF NOT EXISTS stored_files (hash TEXT PRIMARY KEY, stored INTEGER)")
+
+        # With rehash, old entries are ignored (but get overwritten when saving)
+        if not rehash:
+            for path, size, mtime_ns, inode, file_hash in self.connection.execute("SELECT path, size, mtime_ns, inode, hash FROM " + self.table):
+                self.entries[path] = (size, mtime_ns, inode, file_hash)
+            for file_hash, stored in self.connection.execute("SELECT hash, stored FROM stored_files"):
+                self.stored[file_hash] = stored != 0
+
+    @staticmethod
+    def key(path):
+        """Returns the cache key of a file path: its normalized absolute path."""
+        return os.path.normcase(os.path.abspath(path))
+
+    def lookup(self, path, file_stat):
+        """Returns the cached hash of the file at 'path' if its 'file_stat' (as returned by os.stat) matches the cached entry, None otherwise."""
+        key = self.key(path)
+        entry = self.entries.get(key)
+        with self.lock:
+            self.used.add(key)
+            if entry != None and entry[:3] == (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino):
+                self.hits += 1
+                return entry[3]
+            self.misses += 1
+        return None
+
+    def store(self, path, file_stat, file_hash):
+        """Store the hash of the file at 'path', hashed while it had the given 'file_stat'."""
+        key = self.key(path)
+        with self.lock:
+            self.used.add(key)
+        if file_stat.st_mtime_ns > self.start_time_ns - self.RACY_DELAY_NS:
+            return
+        entry = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino, file_hash)
+        with self.lock:
+            self.entries[key] = entry
+            self.new_entries[key] = entry
+
+    def lookup_stored(self, file_hash):
+        """Returns True if the file of hash 'file_hash' is known to be stored without compression by adaptive compression, False if it is known to be compressed, None if unknown."""
+        return self.stored.get(file_hash)
+
+    def store_stored(self, file_hash, stored):
+        """Remember the adaptive compression decision of the file of hash 'file_hash'."""
+        with self.lock:
+            if self.stored.get(file_hash) != stored:
+                self.stored[file_hash] = stored
+                self.new_stored[file_hash] = stored
+
+    def commit(self, prune=False):
+        """Write new entries to the database. Files hashed from now on are racy if modified less than RACY_DELAY_NS before now (see --watch, which commits after each update). If 'prune', the entries of the files that were neither looked up nor stored since the cache was opened are removed (files removed, or not part of the packages anymore), along with the adaptive compression decisions of the hashes no file has anymore: this is done once a whole run is over, not after the updates of --watch, which only look up the files changed."""
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO " + self.table + " (path, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?)",
+                ((path,) + entry for path, entry in self.new_entries.items()))
+            self.connection.executemany("INSERT OR REPLACE INTO stored_files (hash, stored) VALUES (?, ?)",
+                ((file_hash, 1 if stored else 0) for file_hash, stored in self.new_stored.items()))
+            if prune:
+                unused_paths = [path for (path,) in self.connection.execute("SELECT path FROM " + self.table) if not path in self.used]
+                self.connection.executemany("DELETE FROM " + self.table + " WHERE path = ?", ((path,) for path in unused_paths))
+                for path in unused_paths:
+                    self.entries.pop(path, None)
+                self.connection.execute("DELETE FROM stored_files WHERE hash NOT IN (SELECT hash FROM " + self.table + ")")
+                kept_hashes = set(file_hash for (file_hash,) in self.connection.execute("SELECT hash FROM stored_files"))
+                self.stored = dict((file_hash, stored) for file_hash, stored in self.stored.items() if file_hash in kept_hashes)
+        self.new_entries = dict()
+        self.new_stored = dict()
+        self.start_time_ns = time.time_ns()
+
+    def save(self):
+        """Write new entries to the database and close it."""
+        self.commit()
+        self.connection.close()
+
+    def print_stats(self):
+        """Print hit/miss statistics."""
+        print("Hash cache: " + str(self.hits) + " hit(s), " + str(self.misses) + " miss(es)" + (" (rehash requested)" if self.rehash else ""))
+
+class IndexStore:
+    """Package index store (see --index-store), a SQLite database holding the packages, components and files of the last package index published, and the changes of each run. The files table is indexed by path, and the changes table by run."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY AUTOINCREMENT, time TEXT, policy TEXT, hash_algorithm TEXT);
+        CREATE TABLE IF NOT EXISTS packages (id TEXT PRIMARY KEY, type TEXT, name TEXT, version TEXT, description TEXT, index_url TEXT, index_hash TEXT, run INTEGER);
+        CREATE TABLE IF NOT EXISTS components (package_id TEXT, name TEXT, compression TEXT, delta_base_id TEXT, delta_base_version TEXT, delta_archive TEXT, delta_digest TEXT, delta_size INTEGER, run INTEGER, PRIMARY KEY (package_id, name));
+        CREATE TABLE IF NOT EXISTS files (package_id TEXT, component TEXT, path TEXT, hash TEXT, run INTEGER, PRIMARY KEY (package_id, component, path));
+        CREATE TABLE IF NOT EXISTS parts (package_id TEXT, component TEXT, archive TEXT, digest TEXT, PRIMARY KEY (package_id, component, archive));
+        CREATE INDEX IF NOT EXISTS files_by_path ON files (path);
+        CREATE TABLE IF NOT EXISTS changes (run INTEGER, package_id TEXT, component TEXT, path TEXT, state TEXT);
+        CREATE INDEX IF NOT EXISTS changes_by_run ON changes (run);
+        """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(self.SCHEMA)
+        # the new index is copied to temporary tables to be compared with the store (see stage)
+        self.connection.execute("PRAGMA temp_store = MEMORY")
+
+    def last_run(self):
+        """Returns (run, hash algorithm) of the last run recorded, None if the store is empty."""
+        return self.connection.execute("SELECT run, hash_algorithm FROM runs ORDER BY run DESC LIMIT 1").fetchone()
+
+    def load_component(self, package_id, name):
+        """Returns the Component 'name' of package 'package_id', with its files, as recorded in the store (in the 'unchanged' state, as imported from XML)."""
+        compression, delta_base_id, delta_base_version, delta_archive, delta_digest, delta_size = self.connection.execute("SELECT compression, delta_base_id, delta_base_version, delta_archive, delta_digest, delta_size FROM components WHERE package_id = ? AND name = ?", (package_id, name)).fetchone()
+        component = Component(name, compression)
+        component.state = 'unchanged'
+        if delta_archive != None:
+            component.delta = Delta(delta_base_id, delta_base_version, delta_archive, delta_digest, delta_size)
+        component.parts = [Part(archive, digest) for archive, digest in self.connection.execute("SELECT archive, digest FROM parts WHERE package_id = ? AND component = ? ORDER BY archive", (package_id, name))]
+        for path, file_hash in self.connection.execute("SELECT path, hash FROM files WHERE package_id = ? AND component = ? ORDER BY path", (package_id, name)):
+            componentFile = File(path)
+            componentFile.hash = file_hash
+            componentFile.state = 'unchanged'
+            component.append(componentFile)
+        return component
+
+    def load_package(self, package_id):
+        """Returns the Package 'package_id', with its components and files, as recorded in the store."""
+        package_type, name, version, description, index_url, index_hash = self.connection.execute("SELECT type, name, version, description, index_url, index_hash FROM packages WHERE id = ?", (package_id,)).fetchone()
+        package = Package('', name, description, package_type, version, package_id)
+        package.type = package_type
+        package.state = 'unchanged'
+        package.index_url = index_url
+        package.index_hash = index_hash
+        for (name,) in self.connection.execute("SELECT name FROM components WHERE package_id = ? ORDER BY name", (package_id,)).fetchall():
+            package.append(self.load_component(package_id, name))
+        return package
+
+    def load_package_index(self, package_index):
+        """Load the whole content of the store in 'package_index', like PackageIndex.import_from_xml does from a package index file."""
+        with stats.phase('index read'):
+            package_index.hash_algorithm = self.last_run()[1]
+            for (package_id,) in self.connection.execute("SELECT id FROM packages ORDER BY id").fetchall():
+                package_index.append(self.load_package(package_id))
+
+    def stage(self, package_index):
+        """Copy the packages, components and files of 'package_index' to temporary tables, to be compared with the store by diff()."""
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TEMP TABLE IF NOT EXISTS new_packages (id TEXT PRIMARY KEY) WITHOUT ROWID;
+                CREATE TEMP TABLE IF NOT EXISTS new_components (package_id TEXT, name TEXT, PRIMARY KEY (package_id, name)) WITHOUT ROWID;
+                CREATE TEMP TABLE IF NOT EXISTS new_files (package_id TEXT, component TEXT, path TEXT, hash TEXT, PRIMARY KEY (package_id, component, path)) WITHOUT ROWID;
+                DELETE FROM new_packages;
+                DELETE FROM new_components;
+                DELETE FROM new_files;
+                """)
+            # as with the lookup dictionaries, the first package, component or file of a given id, name or path is the one compared
+            self.connection.executemany("INSERT OR IGNORE INTO new_packages (id) VALUES (?)", ((package.id,) for package in package_index.packages))
+            self.connection.executemany("INSERT OR IGNORE INTO new_components (package_id, name) VALUES (?, ?)",
+                ((package.id, component.name) for package in package_index.packages for component in package.components))
+            self.connection.executemany("INSERT OR IGNORE INTO new_files (package_id, component, path, hash) VALUES (?, ?, ?, ?)",
+                ((package.id, component.name, componentFile.path, componentFile.hash) for package in package_index.packages for component in package.components for componentFile in component.files))
+
+    def diff(self, new_package_index, package_index_policy):
+        """Same as diff_package_index, 'new_package_index' being compared with the content of the store: the new index is copied to temporary tables, then added, modified and removed files are found by SQL joins, so that only the differences are loaded from the store."""
+        self.stage(new_package_index)
+
+        # look for modified/added packages/components
+        stored_packages = dict((package_id, index_hash) for package_id, index_hash in self.connection.execute("SELECT id, index_hash FROM packages JOIN new_packages USING (id)"))
+        stored_components = dict(((row[0], row[1]), row[2:]) for row in self.connection.execute(
+            "SELECT package_id, name, compression, delta_base_id, delta_base_version, delta_archive, delta_digest, delta_size FROM components JOIN new_components USING (package_id, name)"))
+        stored_parts = dict()
+        for package_id, component_name, archive, digest in self.connection.execute("SELECT parts.package_id, component, archive, digest FROM parts JOIN new_components ON new_components.package_id = parts.package_id AND new_components.name = parts.component ORDER BY archive"):
+            stored_parts.setdefault((package_id, component_name), []).append(Part(archive, digest))
+        for package in new_package_index.packages:
+            if not package.id in stored_packages:
+                package.state = 'added'
+                continue
+            package.state = 'unchanged'
+            package.index_hash = stored_packages[package.id]
+
+            for component in package.components:
+                stored_component = stored_components.get((package.id, component.name))
+                if stored_component == None:
+                    component.state = 'added'
+                    package.state = 'modified'
+                    continue
+                compression, delta_base_id, delta_base_version, delta_archive, delta_digest, delta_size = stored_component
+                component.state = 'unchanged'
+                component.delta = Delta(delta_base_id, delta_base_version, delta_archive, delta_digest, delta_size) if delta_archive != None else None
+                component.parts = stored_parts.get((package.id, component.name), [])
+                if component.compression != compression:
+                    component.state = 'modifiedcompression'
+                    package.state = 'modified'
+                for componentFile in component.files:
+                    componentFile.state = 'unchanged'
+
+        # look for added/modified files of the components found in the store
+        for package_id, component_name, path, state in self.connection.execute("""
+            SELECT n.package_id, n.component, n.path, CASE WHEN f.path IS NULL THEN 'added' ELSE 'modified' END FROM new_files n
+            JOIN components c ON c.package_id = n.package_id AND c.name = n.component
+            LEFT JOIN files f ON f.package_id = n.package_id AND f.component = n.component AND f.path = n.path
+            WHERE f.path IS NULL OR f.hash IS NOT n.hash""").fetchall():
+            package = new_package_index.packages_by_id[package_id]
+            component = package.components_by_name[component_name]
+            component.files_by_path[path].state = state
+            component.state = 'modified'
+            package.state = 'modified'
+
+        # look for removed packages/components/files
+        for (package_id,) in self.connection.execute("SELECT id FROM packages WHERE id NOT IN (SELECT id FROM new_packages) ORDER BY id").fetchall():
+            package = self.load_package(package_id)
+            if package_index_policy != 'update-keep-old-packages':
+                package.state = 'removed'
+            new_package_index.append(package)
+
+        for package_id, component_name in self.connection.execute("""
+            SELECT c.package_id, c.name FROM components c JOIN new_packages p ON p.id = c.package_id
+            WHERE NOT EXISTS (SELECT 1 FROM new_components n WHERE n.package_id = c.package_id AND n.name = c.name) ORDER BY c.package_id, c.name""").fetchall():
+            new_package = new_package_index.packages_by_id[package_id]
+            component = self.load_component(package_id, component_name)
+            new_package.state = 'modified'
+            component.state = 'removed'
+            new_package.append(component)
+
+        for package_id, component_name, path, file_hash in self.connection.execute("""
+            SELECT f.package_id, f.component, f.path, f.hash FROM files f JOIN new_components c ON c.package_id = f.package_id AND c.name = f.component
+            WHERE NOT EXISTS (SELECT 1 FROM new_files n WHERE n.package_id = f.package_id AND n.component = f.component AND n.path = f.path) ORDER BY f.package_id, f.component, f.path""").fetchall():
+            new_package = new_package_index.packages_by_id[package_id]
+            new_component = new_package.components_by_name[component_name]
+            componentFile = File(path)
+            componentFile.hash = file_hash
+            componentFile.state = 'removed'
+            new_component.state = 'modified'
+            new_package.state = 'modified'
+            new_component.append_file(componentFile)
+
+    def record_run(self, package_index, package_index_policy):
+        """Record a run, once 'package_index' is published: the packages, components and files that are not unchanged are saved to the store (or removed from it), and logged in the changes table. With the overwrite policy, or another hash algorithm than the previous run, the whole content of the store is replaced. Returns the run number."""
+        last_run = self.last_run()
+        replace_all = package_index_policy == 'overwrite' or last_run == None or last_run[1] != hash_algorithm
+        with self.connection:
+            run = self.connection.execute("INSERT INTO runs (time, policy, hash_algorithm) VALUES (datetime('now'), ?, ?)", (package_index_policy, hash_algorithm)).lastrowid
+            if replace_all:
+                self.connection.executescript("DELETE FROM files; DELETE FROM parts; DELETE FROM components; DELETE FROM packages;")
+            changes = []
+            for package in package_index.packages:
+                if package.state == 'unchanged' and not replace_all:
+                    continue
+                if package.state == 'removed':
+                    self.connection.execute("DELETE FROM files WHERE package_id = ?", (package.id,))
+                    self.connection.execute("DELETE FROM parts WHERE package_id = ?", (package.id,))
+                    self.connection.execute("DELETE FROM components WHERE package_id = ?", (package.id,))
+                    self.connection.execute("DELETE FROM packages WHERE id = ?", (package.id,))
+                    changes.append((run, package.id, None, None, package.state))
+                    continue
+                if package.state != 'unchanged':
+                    changes.append((run, package.id, None, None, package.state))
+                self.save_package(package, run, replace_all, changes)
+            self.connection.executemany("INSERT INTO changes (run, package_id, component, path, state) VALUES (?, ?, ?, ?, ?)", changes)
+        return run
+
+    def save_package(self, package, run, replace_all, changes):
+        """Save a package that is not unchanged (and its components) to the store, see record_run. Only the files that are not unchanged are written, unless 'replace_all'."""
+        self.connection.execute("INSERT OR REPLACE INTO packages (id, type, name, version, description, index_url, index_hash, run) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (package.id, package.type, package.name, package.version, package.description, package.index_url, package.index_hash, run))
+        for component in package.components:
+            if component.state == 'removed':
+                self.connection.execute("DELETE FROM files WHERE package_id = ? AND component = ?", (package.id, component.name))
+                self.connection.execute("DELETE FROM parts WHERE package_id = ? AND component = ?", (package.id, component.name))
+                self.connection.execute("DELETE FROM components WHERE package_id = ? AND name = ?", (package.id, component.name))
+                changes.append((run, package.id, component.name, None, component.state))
+                continue
+            # the delta and parts of a component can change even if the component didn't (see deploy_packages)
+            component_delta = component.delta if component.delta != None else Delta(None, None, None, None, None)
+            self.connection.execute("INSERT OR REPLACE INTO components (package_id, name, compression, delta_base_id, delta_base_version, delta_archive, delta_digest, delta_size, run) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (package.id, component.name, component.compression, component_delta.base_id, component_delta.base_version, component_delta.archive, component_delta.digest, component_delta.size, run))
+            self.connection.execute("DELETE FROM parts WHERE package_id = ? AND component = ?", (package.id, component.name))
+            self.connection.executemany("INSERT INTO parts (package_id, component, archive, digest) VALUES (?, ?, ?, ?)", ((package.id, component.name, part.archive, part.digest) for part in component.parts))
+            if component.state == 'unchanged' and not replace_all:
+                continue
+            if component.state != 'unchanged':
+                changes.append((run, package.id, component.name, None, component.state))
+            # removed files are usually not kept in the component (see diff_package_index): files of the store not found in the component are removed
+            removed_paths = set(path for (path,) in self.connection.execute("SELECT path FROM files WHERE package_id = ? AND component = ?", (package.id, component.name)))
+            for componentFile in component.files:
+                if componentFile.state == 'removed':
+                    continue
+                removed_paths.discard(componentFile.path)
+                if componentFile.state != 'unchanged' or replace_all:
+                    self.connection.execute("INSERT OR REPLACE INTO files (package_id, component, path, hash, run) VALUES (?, ?, ?, ?, ?)", (package.id, component.name, componentFile.path, componentFile.hash, run))
+                if componentFile.state != 'unchanged':
+                    changes.append((run, package.id, component.name, componentFile.path, componentFile.state))
+            for path in sorted(removed_paths):
+                self.connection.execute("DELETE FROM files WHERE package_id = ? AND component = ? AND path = ?", (package.id, component.name, path))
+                changes.append((run, package.id, component.name, path, 'removed'))
+
+    def packages_containing(self, path):
+        """Returns (package id, component, hash) of each component of the store containing a file of the given path (relative to the package folder)."""
+        return self.connection.execute("SELECT package_id, component, hash FROM files WHERE path = ? ORDER BY package_id, component", (os.path.normpath(path),)).fetchall()
+
+    def changes_since(self, run):
+        """Returns (run, package id, component, path, state) of each change logged after 'run'. Component and path are None for changes of a package, path is None for changes of a component."""
+        return self.connection.execute("SELECT run, package_id, component, path, state FROM changes WHERE run > ? ORDER BY run, package_id, component, path", (run,)).fetchall()
+
+    def runs(self):
+        """Returns (run, time, policy, hash algorithm, number of changes) of each run recorded."""
+        return self.connection.execute("SELECT run, time, policy, hash_algorithm, (SELECT COUNT(*) FROM changes WHERE changes.run = runs.run) FROM runs ORDER BY run").fetchall()
+
+    def close(self):
+        """Close the database."""
+        self.connection.close()
+
+class DirectoryIndex:
+    """In-memory index of a directory tree, built with a single os.scandir traversal. glob() matches patterns against the index with the same semantics as glob.glob(..., recursive=True), so a tree is only walked once, whatever the number of patterns. A DirectoryIndex can also be a view on a sub-directory of another index (see subdirectory())."""
+
+    MAGIC_CHECK = re.compile('([*?[])')
+
+    def __init__(self, root_dir, entries=None, base='', links=None):
+        self.root_dir = root_dir
+        # normcased relative directory path ('' for root_dir) -> dictionary of normcased name -> (name, is_dir, is_file)
+        self.entries = entries
+        self.base = base
+        # normcased relative path of each symbolic link to a directory -> real path of the directory, see aliases()
+        self.links = links if links != None else dict()
+        if entries == None:
+            self.entries = dict()
+            self.scan()
+
+    def scan(self, key='', path=None):
+        """Walk the whole directory tree once (or the sub-tree of 'path', which key is 'key'). Symbolic links to directories are followed, as glob does, unless they point to one of their parent directories."""
+        pending = [(key, path if path != None else self.root_dir)]
+        while len(pending) != 0:
+            key, path = pending.pop()
+            entries = dict()
+            try:
+                with os.scandir(path) as directory:
+                    for entry in directory:
+                        try:
+                            is_dir = entry.is_dir()
+                            is_file = not is_dir and entry.is_file()
+                        except OSError:
+                            is_dir = is_file = False
+                        entries[os.path.normcase(entry.name)] = (entry.name, is_dir, is_file)
+                        if is_dir and not (entry.is_symlink() and self.is_link_loop(path, entry.path)):
+                            pending.append((os.path.join(key, os.path.normcase(entry.name)), entry.path))
+                            if entry.is_symlink():
+                                self.links[os.path.join(key, os.path.normcase(entry.name))] = os.path.realpath(entry.path)
+            except OSError:
+                pass
+            self.entries[key] = entries
+
+    def update(self, path):
+        """Update the index for 'path' (relative to root_dir), which has been created, modified or removed since the index was built: the entry of the path is refreshed, and a new directory is scanned, so that the index matches the file system again without walking the whole tree (see watch_package_index). The other paths of the index under which 'path' is found are updated too (see aliases)."""
+        aliases = self.aliases(path)
+        self.update_entry(path)
+        for alias in aliases:
+            self.update_entry(alias)
+
+    def update_entry(self, path):
+        """Update the index for 'path', see update()."""
+        key = self.key(path)
+        if key == '':
+            self.entries.clear()
+            self.links.clear()
+            self.scan()
+            return
+
+        parent, name = os.path.split(key)
+        old_entry = self.entries.get(parent, {}).get(name)
+        full_path = os.path.join(self.root_dir, path)
+        is_dir = os.path.isdir(full_path)
+        is_file = not is_dir and os.path.isfile(full_path)
+
+        # forget the content of a directory that is not a directory anymore
+        if old_entry != None and old_entry[1] and not is_dir:
+            for sub_key in [sub_key for sub_key in self.entries if sub_key == key or sub_key.startswith(key + os.sep)]:
+                del self.entries[sub_key]
+            for link_key in [link_key for link_key in self.links if link_key == key or link_key.startswith(key + os.sep)]:
+                del self.links[link_key]
+
+        if not os.path.lexists(full_path):
+            self.entries.get(parent, {}).pop(name, None)
+            return
 
+        # the parent folder may be new too: scanning it also indexes the path
+        if parent != '' and not parent in self.entries:
+            self.update_entry(os.path.dirname(os.path.normpath(path)))
+        self.entries.setdefault(parent, dict())[name] = (os.path.basename(os.path.normpath(path)), is_dir, is_file)
+        if is_dir and not key in self.entries:
+            self.scan(key, full_path)
+
+    def aliases(self, path):
+        """Returns the other paths (relative to this index) of 'path' in the index: symbolic links to directories being followed when scanning, the content of a directory is also indexed under each link to it (or to one of its parents), and under its real path for a path found through a link."""
+        full_path = os.path.normpath(os.path.join(self.root_dir, path))
+        parent_real_path = os.path.realpath(os.path.dirname(full_path))
+        name = os.path.basename(full_path)
+        keys = []
+        # real path of the directory of the whole index (of which this index may be a sub-directory)
+        root_real_path = os.path.realpath(os.path.join(self.root_dir, os.path.relpath(os.curdir, self.base)) if self.base != '' else self.root_dir)
+        link_targets = [('', root_real_path)] + [(link_key, link_real_path) for link_key, link_real_path in self.links.items() if link_key in self.entries]
+        for link_key, link_real_path in link_targets:
+            if parent_real_path == link_real_path or parent_real_path.startswith(link_real_path.rstrip(os.sep) + os.sep):
+                keys.append(os.path.normpath(os.path.join(link_key, os.path.normcase(os.path.relpath(parent_real_path, link_real_path)), os.path.normcase(name))))
+        key = self.key(path)
+        return [os.path.relpath(alias_key, self.base) if self.base != '' else alias_key for alias_key in keys if alias_key != key and (self.base == '' or alias_key.startswith(self.base + os.sep))]
+
+    def list_files(self, path):
+        """Returns the paths (relative to this index) of the files of directory 'path' and its sub-directories."""
+        files = []
+        pending = [path]
+        while len(pending) != 0:
+            dirname = pending.pop()
+            for name, is_dir, is_file in self.entries.get(self.key(dirname), {}).values():
+                if is_dir:
+                    pending.append(os.path.join(dirname, name))
+                elif is_file:
+                    files.append(os.path.join(dirname, name))
+        return files
+
+    @staticmethod
+    def path_matches(pattern, path):
+        """Returns True if file 'path' is matched by glob 'pattern' (both relative to the same directory), without accessing the file system: the pattern is matched against an index holding only this path. Patterns going out of the directory never match."""
+        if DirectoryIndex.is_outside(pattern):
+            return False
+        names = os.path.normpath(path).split(os.sep)
+        entries = dict()
+        key = ''
+        for number, name in enumerate(names):
+            is_file = number == len(names) - 1
+            entries[key] = { os.path.normcase(name): (name, not is_file, is_file) }
+            key = os.path.join(key, os.path.normcase(name))
+        normalized_path = os.path.normcase(os.path.normpath(path))
+        return any(os.path.normcase(os.path.normpath(found)) == normalized_path for found in DirectoryIndex('', entries).glob(pattern))
+
+    @staticmethod
+    def is_link_loop(parent_path, link_path):
+        """Returns True if the directory symbolic link 'link_path' points to 'parent_path' or one of its parents."""
+        parent_real_path = os.path.realpath(parent_path)
+        link_real_path = os.path.realpath(link_path)
+        return parent_real_path == link_real_path or parent_real_path.startswith(link_real_path.rstrip(os.sep) + os.sep)
+
+    def subdirectory(self, path):
+        """Returns a DirectoryIndex of the sub-directory 'path' (relative to this index), sharing this index entries."""
+        return DirectoryIndex(os.path.join(self.root_dir, path), self.entries, self.key(path), self.links)
+
+    def key(self, path):
+        """Returns the key in 'entries' of a path relative to this index."""
+        key = os.path.normcase(os.path.normpath(os.path.join(self.base, path)))
+        return '' if key == os.curdir else key
+
+    def lookup(self, path):
+        """Returns (name, is_dir, is_file) for the given path relative to this index, or None if it doesn't exist."""
+        key = self.key(path)
+        if key == '':
+            return ('', True, False)
+        parent, name = os.path.split(key)
+        return self.entries.get(parent, {}).get(name)
+
+    def isfile(self, path):
+        """Equivalent of os.path.isfile for a path relative to this index."""
+        if self.is_outside(path):
+            return os.path.isfile(os.path.join(self.root_dir, path))
+        entry = self.lookup(path)
+        return entry != None and entry[2]
+
+    @staticmethod
+    def is_outside(pathname):
+        """Returns True if the pathname can't be resolved in the index (absolute or going up with '..')."""
+        return os.path.isabs(pathname) or os.path.splitdrive(pathname)[0] != '' or os.pardir in re.split(r'[\\/]', pathname)
+
+    def glob(self, pathname):
+        """Equivalent of glob.glob(pathname, recursive=True), for a pathname relative to this index."""
+        if self.is_outside(pathname):
+            return glob.glob(pathname, root_dir=self.root_dir, recursive=True)
+        found = list(self.iglob(pathname, False))
+        # glob skips the empty string yielded first for patterns starting with '**'
+        if pathname[:2] == '**' and len(found) != 0 and found[0] == '':
+            found.pop(0)
+        return found
+
+    # The methods below mirror the implementation of the glob module, on the index instead of the file system.
+
+    @staticmethod
+    def has_magic(pathname):
+        return DirectoryIndex.MAGIC_CHECK.search(pathname) != None
+
+    @staticmethod
+    def is_hidden(name):
+        return name[0] == '.'
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def compile_pattern(pattern):
+        """Returns the compiled match function of a path component pattern."""
+        return re.compile(fnmatch.translate(os.path.normcase(pattern))).match
+
+    def iglob(self, pathname, dironly):
+        dirname, basename = os.path.split(pathname)
+        if not self.has_magic(pathname):
+            if basename:
+                if self.lookup(pathname) != None:
+                    yield pathname
+            else:
+                entry = self.lookup(dirname)
+                if entry != None and entry[1]:
+                    yield pathname
+            return
+        if not dirname:
+            if basename == '**':
+                yield from self.glob2(dirname, basename, dironly)
+            else:
+                yield from self.glob1(dirname, basename, dironly)
+            return
+        if dirname != pathname and self.has_magic(dirname):
+            dirs = self.iglob(dirname, True)
+        else:
+            dirs = [dirname]
+        if self.has_magic(basename):
+            glob_in_dir = self.glob2 if basename == '**' else self.glob1
+        else:
+            glob_in_dir = self.glob0
+        for dirname in dirs:
+            for name in glob_in_dir(dirname, basename, dironly):
+                yield os.path.join(dirname, name)
+
+    def listdir(self, dirname, dironly):
+        entries = self.entries.get(self.key(dirname))
+        if entries == None:
+            return []
+        return [name for name, is_dir, is_file in entries.values() if not dironly or is_dir]
+
+    def glob0(self, dirname, basename, dironly):
+        if basename:
+            if self.lookup(os.path.join(dirname, basename)) != None:
+                return [basename]
+        else:
+            entry = self.lookup(dirname)
+            if entry != None and entry[1]:
+                return [basename]
+        return []
+
+    def glob1(self, dirname, pattern, dironly):
+        names = self.listdir(dirname, dironly)
+        if not self.is_hidden(pattern):
+            names = [name for name in names if not self.is_hidden(name)]
+        match = self.compile_pattern(pattern)
+        return [name for name in names if match(os.path.normcase(name))]
+
+    def glob2(self, dirname, pattern, dironly):
+        yield pattern[:0]
+        yield from self.rlistdir(dirname, dironly)
+
+    def rlistdir(self, dirname, dironly):
+        for name in self.listdir(dirname, dironly):
+            if not self.is_hidden(name):
+                yield name
+                path = os.path.join(dirname, name) if dirname else name
+                for sub_name in self.rlistdir(path, dironly):
+                    yield os.path.join(name, sub_name)
+
+def find_files(wildcards, directory_index=None, base_dir=''):
+    """Returns the normalized paths of the files matching wildcards path 'wildcards', relative to 'base_dir' (current directory by default). If a DirectoryIndex of 'base_dir' is provided, files are searched in the index instead of the file system."""
+    if directory_index != None:
+        found_files = (os.path.normpath(found_file) for found_file in directory_index.glob(wildcards))
+        return tuple(found_file for found_file in found_files if directory_index.isfile(found_file))
+
+    found_files = (os.path.normpath(found_file) for found_file in glob.glob(wildcards, root_dir=base_dir if base_dir != '' else None, recursive=True))
+    return tuple(found_file for found_file in found_files if os.path.isfile(os.path.join(base_dir, found_file)))
+
+class ScanCache:
+    """Cache of the searches done while parsing the packages of a run, keyed on (source folder, pattern). Several packages can be defined in the same folder with the same *.package-components files (as wynsure and wynsure-dev are): the folder and the patterns of their components are only searched once, for the first package needing them. Packages being parsed concurrently, a package needing a search already running waits for its result."""
+
+    def __init__(self):
+        self.searches = dict() # (folder, pattern) -> Future of the search result
+        self.lock = threading.Lock()
+
+    def get(self, key, search, *args):
+        """Returns the result of search(*args) for 'key', calling it only if it was not called yet for 'key'"""
+        with self.lock:
+            future = self.searches.get(key)
+            is_new = future == None
+            if is_new:
+                future = concurrent.futures.Future()
+                self.searches[key] = future
+        if not is_new:
+            stats.add('searches reused')
+            return future.result()
+        try:
+            future.set_result(search(*args))
+        except BaseException as exception:
+            future.set_exception(exception)
+            raise
+        return future.result()
 
 def parse_package_definition(filename):
     """Parse the content of a file '[...].package-definition' and return the corresponding Package object."""
@@ -308,12 +1760,12 @@ def parse_package_definition(filename):
     source_path = os.path.dirname(os.path.abspath(filename))
     return Package(source_path, name, description, product, version, package_id)
 
-def parse_components_definition(filename, package_id, components=None):
-    """Parse the content of a file '[...].package-components' and append files and to the passed 'components' dictionary. The dictionary will be created if empty."""
+def parse_components_definition(filename, package_id, components=None, directory_index=None, base_dir='', scan_cache=None):
+    """Parse the content of a file '[...].package-components' and append files and to the passed 'components' dictionary. The dictionary will be created if empty. 'filename', and the files of the components, are relative to 'base_dir' (current directory by default). If provided, files are searched in 'directory_index', the DirectoryIndex of 'base_dir', and searches are shared with the other packages of the run through 'scan_cache'."""
     if components == None:
         components = dict()
 
-    with open(filename) as pkgcompfile:
+    with open(os.path.join(base_dir, filename)) as pkgcompfile:
         # parse each line in the components definition file...
         for count, line in enumerate(pkgcompfile):
 
@@ -354,52 +1806,430 @@ def parse_components_definition(filename, package_id, components=None):
             # search and append the files for this component
             prefix = str(pathlib.PurePath(filename).parent)
             for wildcards_path in wildcards_paths:
-                components[name].append_wildcards_files(prefix + "\\" + wildcards_path)
+                components[name].patterns.append(os.path.join(prefix, wildcards_path))
+                components[name].append_wildcards_files(os.path.join(prefix, wildcards_path), directory_index, base_dir, scan_cache)
 
     pkgcompfile.close()
 
-def deploy(filenames, destination, move=False):
-    """Deploy files provided in the list of 'filenames' to the provided 'destination' folder. filenames may contain a leading folder, which will be created as sub tree of the destination. Move the file instead of copying if 'move' is True. Creates the path if it doesn't exist. Overwrites destination if exists."""
+# Folders known to exist in the destination, so that deploy() doesn't check (or create) the folder of every file it deploys
+existing_directories = set()
+
+def make_directories(path):
+    """Create folder 'path' and its parents if they don't exist, remembering the folders already created or found."""
+    if path in existing_directories:
+        return
+    os.makedirs(path, exist_ok=True)
+    existing_directories.add(path)
+
+# Delay before the first retry of a file that could not be deployed, doubled at each retry up to DEPLOY_RETRY_MAX_DELAY (in seconds), see --deploy-retries
+DEPLOY_RETRY_DELAY = 1
+DEPLOY_RETRY_MAX_DELAY = 60
+
+# Files that could not be deployed, after --deploy-retries retries: (destination file name, error), see deploy_packages()
+deploy_failures = []
+
+# errno values meaning a link (or clone) can't be made between two files, whatever the retries (other volume, file system without support...)
+LINK_UNSUPPORTED_ERRORS = { errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP) }
+FICLONE = 0x40049409 # Linux ioctl cloning a file (reflink)
+
+# Link modes that failed with a LINK_UNSUPPORTED_ERRORS error, not tried again in 'auto' link mode
+unsupported_link_modes = set()
+
+def reflink(source, destination):
+    """Create 'destination' as a copy-on-write clone of 'source'. Raises OSError if the file system doesn't support it."""
+    if fcntl == None:
+        raise OSError(errno.EOPNOTSUPP, "reflink is not supported on this platform", destination)
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            destination_file.close()
+            os.remove(destination)
+            raise
+    shutil.copystat(source, destination)
+
+def deploy_file(source, destination, mode='copy'):
+    """Deploy file 'source' to file 'destination' (which must not exist), according to link 'mode' (see --link-mode)."""
+    if mode == 'copy':
+        shutil.copy2(source, destination)
+        return
+
+    link_functions = [ ('reflink', reflink), ('hardlink', os.link) ]
+    for link_function_mode, link_function in link_functions:
+        if mode != 'auto' and mode != link_function_mode:
+            continue
+        if mode == 'auto' and link_function_mode in unsupported_link_modes:
+            continue
+        try:
+            link_function(source, destination)
+            return
+        except OSError as error:
+            if error.errno not in LINK_UNSUPPORTED_ERRORS:
+                raise
+            if mode != 'auto':
+                print("Error: can't " + mode + " " + source + " to " + destination + ": " + str(error))
+                exit(1)
+            print("   " + link_function_mode + " not supported to " + destination + ", falling back")
+            unsupported_link_modes.add(link_function_mode)
+
+    shutil.copy2(source, destination)
+
+def is_deployed(source, destination, file_hash):
+    """Returns True if file 'destination' is the same as file 'source', whose hash is 'file_hash': it is either the same file (hard link), or it has the same size and hash. The destination hash is looked up in the hash cache first, under the path the file has once published (see published_path)."""
+    if file_hash == None or file_hash == '' or not os.path.isfile(destination):
+        return False
+    source_stat = os.stat(source)
+    destination_stat = os.stat(destination)
+    if os.path.samestat(source_stat, destination_stat):
+        return True
+    if source_stat.st_size != destination_stat.st_size:
+        return False
+
+    destination_hash = hash_cache.lookup(published_path(destination), destination_stat) if hash_cache != None else None
+    if destination_hash == None:
+        destination_hash = hash_file(destination)
+        stats.add('files hashed')
+        stats.add('bytes hashed', destination_stat.st_size)
+        if hash_cache != None:
+            hash_cache.store(published_path(destination), destination_stat, destination_hash)
+    return destination_hash == file_hash
+
+def deploy(filenames, destination, move=False, file_hashes=None, sidecars=False, base_dir=''):
+    """Deploy files provided in the list of 'filenames' (relative to 'base_dir', current directory by default) to the provided 'destination' folder. filenames may contain a leading folder, which will be created as sub tree of the destination. Move the file instead of copying if 'move' is True, otherwise copy or link it according to --link-mode. Creates the path if it doesn't exist. Overwrites destination if exists, unless its hash is the one given for the file in 'file_hashes' (dictionary of filename -> hash). If 'sidecars', the precompressed copies of the deployed files are updated (see --precompress)."""
+    with stats.phase('copy'):
+        deploy_files(filenames, destination, move, file_hashes, sidecars, base_dir)
+
+def deploy_files(filenames, destination, move, file_hashes, sidecars=False, base_dir=''):
+    """Deploy files, see deploy(). The folders of the files are all created first, then files are deployed in a pool of deploy_jobs threads, their messages being printed in the order of 'filenames'. A file that can't be deployed is retried deploy_retries times, with a delay doubled at each retry, then appended to deploy_failures: the other files are deployed all the same."""
+    files_to_deploy = []
     for filename in filenames:
-
         if not os.path.isabs(filename):
-            real_destination = destination + '\\' + os.path.dirname(filename)
+            real_destination = os.path.join(destination, os.path.dirname(filename))
         else:
             real_destination = destination
-
-        if not os.path.exists(real_destination):
-            os.makedirs(real_destination)
-
-        print("   copying " + filename + " to " + real_destination)
-
-        if os.path.isfile(real_destination + '\\' + os.path.basename(filename)):
-            print("      Warning: " + real_destination + '\\' + os.path.basename(filename) + " already exists. Overwriting.")
-            os.remove(real_destination + '\\' + os.path.basename(filename))
-
-        deploy_success = False
-        while not deploy_success:
+        files_to_deploy.append((filename, real_destination, os.path.join(real_destination, os.path.basename(filename)), os.path.join(base_dir, filename)))
+
+    for real_destination in sorted(set(real_destination for filename, real_destination, destination_filename, source_filename in files_to_deploy)):
+        make_directories(real_destination)
+
+    def deploy_one_file(file_to_deploy):
+        """Deploy a file of 'files_to_deploy', unless already deployed. Returns 'skipped', 'copied' or 'failed', and the messages to print, as (is detail, message) (see print_detail)."""
+        filename, real_destination, destination_filename, source_filename = file_to_deploy
+        messages = []
+        # the source file is read from inside the retries too: a file removed or locked meanwhile ends up in deploy_failures
+        checked = False
+        # the file is deployed under a temporary name, then renamed: a file that can't be deployed leaves the previous one in place, still listed by the previous package index
+        temporary_filename = destination_filename + '.tmp'
+        for retry in range(deploy_retries + 1):
             try:
+                if not checked:
+                    if file_hashes != None and is_deployed(source_filename, destination_filename, file_hashes.get(filename)):
+                        stats.add('files skipped')
+                        return 'skipped', messages
+                    checked = True
+                    messages.append((True, "   copying " + filename + " to " + real_destination))
+                    if os.path.isfile(destination_filename):
+                        messages.append((True, "      Warning: " + destination_filename + " already exists. Overwriting."))
+                source_size = os.path.getsize(source_filename)
+                if os.path.isfile(temporary_filename):
+                    os.remove(temporary_filename)
                 if move == True:
-                    shutil.move(filename, real_destination)
-                    deploy_success = True
+                    shutil.move(source_filename, temporary_filename)
                 else:
-                    shutil.copy2(filename, real_destination)
-                    deploy_success = True
-            except:
-                print("   Deploy failed... retrying in 10 seconds")
-                time.sleep(10)
-                pass
+                    deploy_file(source_filename, temporary_filename, link_mode)
+                os.replace(temporary_filename, destination_filename)
+                stats.add('files copied')
+                stats.add('bytes copied', source_size)
+                return 'copied', messages
+            except Exception as error:
+                try:
+                    os.remove(temporary_filename)
+                except OSError:
+                    pass
+                if retry == deploy_retries:
+                    messages.append((False, "   Deploy of " + destination_filename + " failed (" + str(error) + "), giving up"))
+                    deploy_failures.append((destination_filename, str(error)))
+                    return 'failed', messages
+                delay = min(DEPLOY_RETRY_MAX_DELAY, DEPLOY_RETRY_DELAY * 2 ** retry)
+                messages.append((False, "   Deploy of " + destination_filename + " failed (" + str(error) + ")... retrying in " + str(delay) + " second(s)"))
+                stats.add('deploy retries')
+                time.sleep(delay)
+
+    def files_deployed(results):
+        """Print the messages of each file deployed, in the order of 'files_to_deploy', and update its sidecars (here, as phases are timed in the main thread). Returns the number of files already deployed."""
+        skipped_count = 0
+        for (filename, real_destination, destination_filename, source_filename), (result, messages) in zip(files_to_deploy, results):
+            for is_detail, message in messages:
+                if is_detail:
+                    print_detail(message)
+                else:
+                    print(message)
+            if result == 'skipped':
+                skipped_count += 1
+            if sidecars and result != 'failed':
+                update_sidecars(destination_filename, result == 'copied')
+        return skipped_count
+
+    if deploy_jobs == 1 or len(files_to_deploy) <= 1:
+        skipped_count = files_deployed(map(deploy_one_file, files_to_deploy))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=deploy_jobs) as executor:
+            skipped_count = files_deployed(executor.map(deploy_one_file, files_to_deploy))
+
+    if skipped_count != 0:
+        print("   " + str(skipped_count) + " file(s) already deployed in " + destination)
+
+# Extensions of the precompressed copies (sidecars) of deployed files, for each method of --precompress
+SIDECAR_EXTENSIONS = { 'gzip': '.gz', 'brotli': '.br' }
+
+def write_sidecar(filename, method, sidecar_filename=None):
+    """Write the precompressed copy of file 'filename' for 'method' (gzip or brotli), at the highest compression level, to 'sidecar_filename' (the file name with the extension of the method by default). The sidecar is written to a temporary file, then renamed. Returns the size of the sidecar, or None if it would not be smaller than the file (no sidecar is kept then)."""
+    BLOCKSIZE = 1048576
+    if sidecar_filename == None:
+        sidecar_filename = filename + SIDECAR_EXTENSIONS[method]
+    temporary_filename = sidecar_filename + '.tmp'
+    with open(filename, 'rb') as source_file, open(temporary_filename, 'wb') as sidecar_file:
+        if method == 'gzip':
+            # no file name nor timestamp in the gzip header: the same file always gives the same sidecar
+            with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=sidecar_file, mtime=0) as gzip_file:
+                shutil.copyfileobj(source_file, gzip_file, BLOCKSIZE)
+        else:
+            compressor = brotli.Compressor(quality=11)
+            for block in iter(lambda: source_file.read(BLOCKSIZE), b''):
+                sidecar_file.write(compressor.process(block))
+            sidecar_file.write(compressor.finish())
+        source_size = source_file.tell()
+        sidecar_size = sidecar_file.tell()
+
+    if sidecar_size >= source_size:
+        os.remove(temporary_filename)
+        if os.path.isfile(sidecar_filename):
+            os.remove(sidecar_filename)
+        return None
+    os.replace(temporary_filename, sidecar_filename)
+    return sidecar_size
+
+def update_sidecars(filename, rewritten=True):
+    """Write the sidecars of deployed file 'filename' for each method of --precompress, unless it is smaller than --precompress-min-size (its sidecars are removed then). Unless the file has been 'rewritten', existing sidecars are kept as they are."""
+    if len(precompress) == 0:
+        return
+    with stats.phase('precompress'):
+        size = os.path.getsize(filename)
+        for method in precompress:
+            sidecar_filename = filename + SIDECAR_EXTENSIONS[method]
+            if size < precompress_min_size:
+                if os.path.isfile(sidecar_filename):
+                    os.remove(sidecar_filename)
+                continue
+            if not rewritten and os.path.isfile(sidecar_filename):
+                continue
+            sidecar_size = write_sidecar(filename, method)
+            if sidecar_size != None:
+                stats.add('sidecars written')
+                stats.add('sidecar bytes', sidecar_size)
+
+def write_published_sidecars(filename, published_filename):
+    """Write the sidecars of file 'filename', which is about to be published as 'published_filename' (see publish_file), under temporary names next to it. Returns the list of (temporary sidecar, sidecar) to rename once written, the temporary sidecar being None for a sidecar to remove (file smaller than --precompress-min-size, or that doesn't compress)."""
+    sidecars = []
+    with stats.phase('precompress'):
+        size = os.path.getsize(filename)
+        for method in precompress:
+            sidecar_filename = published_filename + SIDECAR_EXTENSIONS[method]
+            sidecar_size = write_sidecar(filename, method, sidecar_filename + '.tmp') if size >= precompress_min_size else None
+            if sidecar_size != None:
+                stats.add('sidecars written')
+                stats.add('sidecar bytes', sidecar_size)
+                sidecars.append((sidecar_filename + '.tmp', sidecar_filename))
+            else:
+                sidecars.append((None, sidecar_filename))
+    return sidecars
+
+def remove_deployed_file(filename):
+    """Remove deployed file 'filename', along with its sidecars (see --precompress)"""
+    os.remove(filename)
+    for extension in SIDECAR_EXTENSIONS.values():
+        if os.path.isfile(filename + extension):
+            os.remove(filename + extension)
+
+# Folder of the object store in the destination, for the 'objects' deploy layout
+OBJECTS_DIR = 'objects'
+
+def object_path(name):
+    """Returns the path of object 'name' (file hash, or component archive digest + '.zip') in the object store, relative to the destination. Objects are spread in sub-folders named after the first 2 characters of their name."""
+    return os.path.join(OBJECTS_DIR, name[:2], name)
+
+def component_objects(component):
+    """Returns the names of the objects of a component: its archive (or part archives) if it is compressed, its files otherwise."""
+    if component.is_compressed() and len(component.parts) != 0:
+        return [ part.digest + '.zip' for part in component.parts ]
+    if component.is_compressed():
+        return [ component.archive_digest() + '.zip' ]
+    return [ componentFile.hash for componentFile in component.files if componentFile.state != 'removed' and componentFile.hash != '' ]
+
+def has_missing_objects(component, destination):
+    """Returns True if some objects of 'component' are not in the object store of 'destination' (e.g. when switching to the objects deploy layout)."""
+    return any(not os.path.isfile(os.path.join(destination, object_path(name))) for name in component_objects(component))
+
+def deploy_object(source, destination, name, move=False):
+    """Store file 'source' as object 'name' in the object store of 'destination', unless it is already there: objects are named after their content, an existing object is never rewritten. The object is written to a temporary file first, so that a partially written object is never taken for a complete one. Returns True if the object has been stored."""
+    with stats.phase('copy'):
+        object_filename = os.path.join(destination, object_path(name))
+        if os.path.isfile(object_filename):
+            if move == True:
+                os.remove(source)
+            stats.add('objects skipped')
+            return False
+
+        stats.add('objects stored')
+        stats.add('bytes copied', os.path.getsize(source))
+        make_directories(os.path.dirname(object_filename))
+        temporary_filename = object_filename + '.tmp'
+        if os.path.isfile(temporary_filename):
+            os.remove(temporary_filename)
+        if move == True:
+            shutil.move(source, temporary_filename)
+        else:
+            deploy_file(source, temporary_filename, link_mode)
+        os.replace(temporary_filename, object_filename)
+        return True
+
+def collect_objects(package_index, destination):
+    """Remove the objects of the object store of 'destination' that are not referenced by any package of 'package_index' (garbage collection). The references of each object are counted over the packages, components and files which are not removed."""
+    reference_counts = dict()
+    for package in package_index.packages:
+        if package.state == 'removed':
+            continue
+        for component in package.components:
+            if component.state == 'removed':
+                continue
+            for name in component_objects(component):
+                reference_counts[name] = reference_counts.get(name, 0) + 1
+
+    objects_dir = os.path.join(destination, OBJECTS_DIR)
+    if not os.path.isdir(objects_dir):
+        return
+    removed_count = 0
+    removed_size = 0
+    for objects_subdir in os.scandir(objects_dir):
+        if not objects_subdir.is_dir():
+            continue
+        for entry in os.scandir(objects_subdir.path):
+            # sidecars of raw file objects (see --precompress) go with their object
+            name, extension = os.path.splitext(entry.name)
+            if not extension in SIDECAR_EXTENSIONS.values():
+                name = entry.name
+            if entry.is_file() and reference_counts.get(name, 0) == 0:
+                removed_size += entry.stat().st_size
+                os.remove(entry.path)
+                removed_count += 1
+    print("Object store: " + str(len(reference_counts)) + " object(s) referenced, " + str(removed_count) + " unreferenced object(s) removed (" + str(removed_size) + " bytes)")
+
+def hash_packages(packages, jobs, defer=False):
+    """Calculate the hash of every file of every component of the packages, using a pool of 'jobs' threads. hashlib releases the GIL while hashing, so files are read and hashed concurrently. Each hash is stored on its File object, so the packages content and order is the same as with a serial run. If 'defer' is set, files of compressed components that are not in the hash cache are not hashed: they will be hashed while their component archive is created."""
+    files_to_hash = []
+    files_by_path = dict() # full path -> index in files_to_hash, and other File objects of the same file (packages defined in the same folder share files)
+    for package in packages:
+        for component in package.components:
+            for componentFile in component.files:
+                defer_file = defer and component.is_compressed()
+                full_path = os.path.join(package.source_path, componentFile.path)
+                same_files = files_by_path.get(full_path)
+                if same_files == None:
+                    files_by_path[full_path] = (len(files_to_hash), [])
+                    files_to_hash.append((componentFile, package.source_path, defer_file))
+                else:
+                    same_files[1].append(componentFile)
+                    if not defer_file:
+                        # the file is needed by a raw component (or hashing is not deferred): hash it now
+                        first_file, base_dir, first_defer = files_to_hash[same_files[0]]
+                        files_to_hash[same_files[0]] = (first_file, base_dir, False)
+
+    print("Hashing " + str(len(files_to_hash)) + " file(s) using " + str(jobs) + " thread(s)...")
+    hash_files(files_to_hash, jobs)
+
+    # Files shared by several packages are hashed once
+    shared_count = 0
+    for index, same_files in files_by_path.values():
+        for componentFile in same_files:
+            componentFile.digest = files_to_hash[index][0].digest
+        shared_count += len(same_files)
+    if shared_count != 0:
+        print("   " + str(shared_count) + " other file(s) of packages sharing the same folder got the same hashes")
+        stats.add('hashes reused', shared_count)
+
+    deferred_count = sum(1 for componentFile, base_dir, defer_file in files_to_hash if componentFile.digest == None)
+    if deferred_count != 0:
+        print("   " + str(deferred_count) + " file(s) will be hashed while compressing their component")
+
+def hash_files(files_to_hash, jobs):
+    """Calculate the hash of the files of 'files_to_hash', a list of (File, base_dir, defer), using a pool of 'jobs' threads, see hash_packages"""
+    if jobs == 1:
+        for componentFile, base_dir, defer_file in files_to_hash:
+            componentFile.calculateHash(base_dir, defer_file)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(componentFile.calculateHash, base_dir, defer_file) for componentFile, base_dir, defer_file in files_to_hash]
+            for future in futures:
+                future.result()
+
+def scan_root_paths(root_dirs, directory_indexes):
+    """Build the DirectoryIndex of each root path of 'root_dirs' not found in 'directory_indexes' (root_dir -> DirectoryIndex), and store it there. Root paths are scanned concurrently, as they are often on different volumes."""
+    root_dirs_to_scan = [root_dir for root_dir in root_dirs if not root_dir in directory_indexes]
+    if len(root_dirs_to_scan) == 0:
+        return
+    for root_dir in root_dirs_to_scan:
+        print("Scanning " + root_dir + "...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(root_dirs_to_scan)) as executor:
+        for root_dir, directory_index in zip(root_dirs_to_scan, executor.map(DirectoryIndex, root_dirs_to_scan)):
+            directory_indexes[root_dir] = directory_index
+
+def parse_package(root_dir, directory_index, package_definition, scan_cache=None):
+    """Parse the *.package-definition file 'package_definition' (relative to 'root_dir') and the *.package-components files of its folder, searching the files of the components in 'directory_index' (the DirectoryIndex of root_dir). Searches already done for another package of the same folder are taken from 'scan_cache'. Empty components are dropped. Returns the package, and the messages to print about it (packages are parsed concurrently, see build_pacakge_list)."""
+    messages = []
+    package = parse_package_definition(os.path.join(root_dir, package_definition))
+    messages.append("   - " + package_definition + "... " + package.id)
+
+    # Find all the .package-components files in the sub-tree as .package-definition
+    package_directory_index = directory_index.subdirectory(os.path.relpath(package.source_path, root_dir))
+    if scan_cache == None:
+        scan_cache = ScanCache()
+    components_def_list = []
+    for pattern in ('**/.package-components', '**/*.package-components'):
+        components_def_list.extend(scan_cache.get((package.source_path, pattern), package_directory_index.glob, pattern))
+    if (len(components_def_list) == 0):
+        print("\n".join(messages))
+        print("Error: no *.package-components found in '" + package.source_path)
+        exit(1)
 
-def build_pacakge_list(root_dir):
-    """Traverses root_dir in search for *.package-definition files, parses them and there corresponding *.package-components files, to build a package list."""
-    # Backup cwd
-    previous_cwd = os.getcwd()
+    # Parse all *.package-components found
+    components = dict()
+    for components_def in components_def_list:
+        if not quiet:
+            messages.append("      - " + os.path.join(package.source_path, components_def))
+        parse_components_definition(components_def, package.id, components, package_directory_index, package.source_path, scan_cache)
+
+    for component in components.values():
+        package.component_patterns[component.name] = (component.compression, component.patterns)
+        # Remove empty components
+        if len(component.files) != 0:
+            package.append(component)
+    return package, messages
+
+def build_pacakge_list(root_dir, directory_indexes=None, scan_cache=None):
+    """Traverses root_dir in search for *.package-definition files, parses them and there corresponding *.package-components files, to build a package list. If a 'directory_indexes' dictionary (root_dir -> DirectoryIndex) is provided, the DirectoryIndex of root_dir is taken from it if found, and stored in it otherwise. Packages defined in the same folder share their searches through 'scan_cache' (a new ScanCache by default, the cache is meant to live for one run only). Paths are resolved against root_dir and the package folders, never against the current directory, and packages are parsed concurrently (in a pool of --jobs threads): the package list is in the order of the *.package-definition files found, whatever the order in which they got parsed."""
+    # Scan the whole tree once, all the searches below are done in this index
+    directory_index = directory_indexes.get(root_dir) if directory_indexes != None else None
+    if directory_index == None:
+        print("Scanning " + root_dir + "...")
+        with stats.phase('scan'):
+            directory_index = DirectoryIndex(root_dir)
+        if directory_indexes != None:
+            directory_indexes[root_dir] = directory_index
 
     # Search for any .package-definition
-    os.chdir(root_dir)
     package_def_list = []
-    package_def_list.extend(glob.glob('**/.package-definition', recursive=True))
-    package_def_list.extend(glob.glob('**/*.package-definition', recursive=True))
+    package_def_list.extend(directory_index.glob('**/.package-definition'))
+    package_def_list.extend(directory_index.glob('**/*.package-definition'))
     if (len(package_def_list) == 0):
         print("Error: no *.package-definition found in '" + root_dir)
         exit(1)
@@ -407,43 +2237,134 @@ def build_pacakge_list(root_dir):
     # for each package-definition, create a package and find its components
     print("*.package-definition files found:")
     packages = []
-    for package_definition in package_def_list:
-        print("   - " + package_definition, end="... ")
-        # Parse .package-definition file
-        os.chdir(root_dir)
-        package = parse_package_definition(package_definition)
-        print(package.id)
-        
-        # Find all the .package-components files in the sub-tree as .package-definition
-        os.chdir(package.source_path)
-        components_def_list = []
-        components_def_list.extend(glob.glob('**/.package-components', recursive=True))
-        components_def_list.extend(glob.glob('**/*.package-components', recursive=True))
-        if (len(components_def_list) == 0):
-            print("Error: no *.package-components found in '" + package.source_path)
-            exit(1)
-        
-        # Parse all *.package-components found
-        components = dict()
-        for components_def in components_def_list:
-            print("      - " + package.source_path + "\\" + components_def)
-            parse_components_definition(components_def, package.id, components)
+    if scan_cache == None:
+        scan_cache = ScanCache()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(parse_package, root_dir, directory_index, package_definition, scan_cache) for package_definition in package_def_list]
+        for future in futures:
+            package, messages = future.result()
+            print("\n".join(messages))
+            packages.append(package)
+    return packages
+
+def diff_package_index(new_package_index, old_package_index, package_index_policy):
+    """Compare new_package_index with old_package_index, and set up accordingly the "state" attribute of each package/component/file of new_package_index. Packages, components and files not found anymore are appended to new_package_index with the "removed" state (or "unchanged" for packages with the 'update-keep-old-packages' policy). Lookups are done through the PackageIndex/Package/Component dictionaries, so the time taken is linear in the number of files."""
+    # look for modified/added packages/components/files
+    for package in new_package_index.packages:
+        if package in old_package_index:
+            package.state = 'unchanged'
+        else:
+            package.state = 'added'
+            continue
 
-        package.components.extend(components.values())
-        packages.append(package)
+        old_package = old_package_index[package]
+        package.index_hash = old_package.index_hash
 
-    # Remove empty components
-    for package in packages:
-        componentsToRemove = []
         for component in package.components:
-            if  component.files == None or len(component.files) == 0:
-                componentsToRemove.append(component)
-        for component in componentsToRemove:
-            package.components.remove(component)
+            if component in old_package:
+                component.state = 'unchanged'
+            else:
+                component.state = 'added'
+                package.state = 'modified'
+                continue
 
-    # Restore cwd
-    os.chdir(previous_cwd)
-    return packages
+            old_component = old_package[component]
+            component.delta = old_component.delta
+            component.parts = old_component.parts
+
+            if component.compression != old_component.compression:
+                component.state = 'modifiedcompression'
+                package.state = 'modified'
+
+            for componentFile in component.files:
+                if componentFile in old_component:
+                    componentFile.state = 'unchanged'
+                else:
+                    componentFile.state = 'added'
+                    component.state = 'modified'
+                    package.state = 'modified'
+                    continue
+
+                old_file = old_component[componentFile]
+
+                if componentFile.digest != old_file.digest:
+                    componentFile.state = 'modified'
+                    component.state = 'modified'
+                    package.state = 'modified'
+
+    # look for removed packages/components/files
+    for package in old_package_index.packages:
+        if not package in new_package_index:
+            if package_index_policy != 'update-keep-old-packages':
+                package.state = 'removed'
+            else:
+                package.state = 'unchanged'
+            new_package_index.append(package)
+            continue
+
+        new_package = new_package_index[package]
+        for component in package.components:
+            if not component in new_package:
+                new_package.state = 'modified'
+                component.state = 'removed'
+                new_package.append(component)
+                continue
+
+            new_component = new_package[component]
+            for componentFile in component.files:
+                if not componentFile in new_component:
+                    componentFile.state = 'removed'
+                    new_component.state = 'modified'
+                    new_package.state = 'modified'
+                    new_component.append_file(componentFile)
+                    continue
+
+def convert_package_index_hashes(new_package_index, old_package_index):
+    """Convert the file hashes of 'old_package_index', calculated with another algorithm, to --hash-algorithm, so that changing the algorithm doesn't mark every file as modified: the files of 'new_package_index' found in the old index are hashed again with the old algorithm (unless found in the hash cache of this algorithm), and if the content didn't change, the old file gets the new hash. The other files keep their old hash, and are found modified by diff_package_index."""
+    old_algorithm = old_package_index.hash_algorithm
+    if package_index_policy == 'update-keep-old-packages' and any(not package in new_package_index for package in old_package_index.packages):
+        print("Error: packages of the package index not found anymore can't be hashed with " + hash_algorithm + ". Use the update policy to change the hash algorithm.")
+        exit(1)
+
+    # (new file, old file, folder of the file) for each file found in both indexes (deferred hashes are considered modified anyway)
+    files_to_compare = []
+    for package in new_package_index.packages:
+        old_package = old_package_index[package]
+        if old_package == None:
+            continue
+        for component in package.components:
+            old_component = old_package[component]
+            if old_component == None:
+                continue
+            for componentFile in component.files:
+                old_file = old_component[componentFile]
+                if old_file != None and componentFile.hash != None and componentFile.hash != '':
+                    files_to_compare.append((componentFile, old_file, package.source_path))
+
+    print("Package index hashed with " + old_algorithm + ", hashing " + str(len(files_to_compare)) + " file(s) with " + old_algorithm + " to find the modified ones...")
+    old_hash_cache = HashCache(os.path.abspath(hash_cache_file), rehash, old_algorithm)
+
+    def old_hash(componentFile, base_dir):
+        full_path = os.path.join(base_dir, componentFile.path)
+        try:
+            file_stat = os.stat(full_path)
+        except OSError:
+            return ''
+        file_hash = old_hash_cache.lookup(full_path, file_stat)
+        if file_hash == None:
+            file_hash = hash_file(full_path, old_algorithm)
+            stats.add('files hashed')
+            stats.add('bytes hashed', file_stat.st_size)
+            old_hash_cache.store(full_path, file_stat, file_hash)
+        return file_hash
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        old_hashes = list(executor.map(lambda item: old_hash(item[0], item[2]), files_to_compare))
+    for (componentFile, old_file, base_dir), file_hash in zip(files_to_compare, old_hashes):
+        if file_hash == old_file.hash:
+            old_file.digest = componentFile.digest
+    old_hash_cache.save()
+    old_package_index.hash_algorithm = hash_algorithm
 
 def make_package_index(packages, package_index_file, old_package_index_file, package_index_policy):
     """Build new PackageIndex object based on new package list and old package list and package index policy (should we update the new index based on old index?)"""
@@ -458,227 +2379,1002 @@ def make_package_index(packages, package_index_file, old_package_index_file, pac
             os.remove(package_index_file)
 
     # if policy is to append, just append new content found to old existing package-index.xml file
-    elif package_index_policy == 'append' and os.path.isfile(old_package_index_file):
-        xmlTree = ET.parse(old_package_index_file)
-        wideIndexXML = xmlTree.getroot()
-        old_package_index = PackageIndex()
-        old_package_index.import_from_xml(wideIndexXML)
+    elif package_index_policy == 'append' and (os.path.isfile(old_package_index_file) or has_stored_run()):
+        old_package_index = read_old_package_index(old_package_index_file)
+        if old_package_index.hash_algorithm != hash_algorithm:
+            print("Error: can't append to " + old_package_index_file + ", hashed with " + old_package_index.hash_algorithm + " instead of " + hash_algorithm + ". Use the update policy to change the hash algorithm.")
+            exit(1)
         for package in new_package_index.packages:
             old_package_index.append(package)
         new_package_index = old_package_index
 
     # if policy is to update, compare newly created index with old index, and set up accordingly the "state" attribute of each package/component/file. This will be used in deployment phase (deploy_packages).
-    elif package_index_policy == 'update' or package_index_policy == 'update-keep-old-packages' and os.path.isfile(old_package_index_file):
-        xmlTree = ET.parse(old_package_index_file)
-        wideIndexXML = xmlTree.getroot()
-        old_package_index = PackageIndex()
-        old_package_index.import_from_xml(wideIndexXML)
-        
-        # look for modified/added packages/components/files
-        for package in new_package_index.packages:
-            if package in old_package_index:
-                package.state = 'unchanged'
-            else:
-                package.state = 'added'
-                continue
-
-            old_package = old_package_index[package]
-
-            for component in package.components:
-                if component in old_package:
-                    component.state = 'unchanged'
-                else:
-                    component.state = 'added'
-                    package.state = 'modified'
-                    continue
-
-                old_component = old_package[component]
-
-                if component.compression != old_component.compression:
-                    component.state = 'modifiedcompression'
-                    package.state = 'modified'
-
-                for componentFile in component.files:
-                    if componentFile in old_component:
-                        componentFile.state = 'unchanged'
-                    else:
-                        componentFile.state = 'added'
-                        component.state = 'modified'
-                        package.state = 'modified'
-                        continue
-
-                    old_file = old_component[componentFile]
-
-                    if componentFile.hash != old_file.hash:
-                        componentFile.state = 'modified'
+    # With an index store holding the previous run (hashed with the same algorithm), the diff is done by the store.
+    elif package_index_policy == 'update' or package_index_policy == 'update-keep-old-packages' and (os.path.isfile(old_package_index_file) or has_stored_run()):
+        converted = False
+        if has_stored_run() and index_store.last_run()[1] == hash_algorithm:
+            index_store.diff(new_package_index, package_index_policy)
+        else:
+            old_package_index = read_old_package_index(old_package_index_file)
+            converted = old_package_index.hash_algorithm != hash_algorithm
+            if converted:
+                convert_package_index_hashes(new_package_index, old_package_index)
+            diff_package_index(new_package_index, old_package_index, package_index_policy)
+
+        # With another hash algorithm, sub-indexes (sharded package index) have to be deployed again, and delta archives, which list file hashes, built again
+        if converted:
+            for package in new_package_index.packages:
+                for component in package.components:
+                    if component.state == 'unchanged' and component.delta != None:
                         component.state = 'modified'
-                        package.state = 'modified'
-
-        # look for removed packages/components/files
-        for package in old_package_index.packages:
-            if not package in new_package_index:
-                if package_index_policy != 'update-keep-old-packages':
-                    package.state = 'removed'
-                else:
-                    package.state = 'unchanged'
-                new_package_index.append(package)
-                continue
-
-            for component in package.components:
-                if not component in new_package_index[package]:
-                    new_package_index[package].state = 'modified'
-                    component.state = 'removed'
-                    new_package_index[package].append(component)
-                    continue
-
-                for componentFile in component.files:
-                    if not componentFile in new_package_index[package][component]:
-                        componentFile.state = 'removed'
-                        new_package_index[package][component].state = 'modified'
-                        new_package_index[package].state = 'modified'
-                        new_package_index[package][component].append_file(componentFile)
-                        continue
+                if package.state == 'unchanged':
+                    package.state = 'modified'
 
     new_package_index.sort()
-
-    # Write package index
-    wideIndexXML = new_package_index.to_element_tree()
-    indentXML(wideIndexXML)
-    wideTree = ET.ElementTree(wideIndexXML)
-    wideTree.write(package_index_file)
-
+    write_package_index_when_ready(new_package_index, package_index_file)
     return new_package_index
 
-def indentXML(elem, level=0):
-    """Indent XML when generating it"""
-    i = "\n" + level*"  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indentXML(elem, level+1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
+def has_stored_run():
+    """Returns True if the index store (see --index-store) holds a previous run"""
+    return index_store != None and index_store.last_run() != None
+
+def read_old_package_index(old_package_index_file):
+    """Returns the package index of the previous run: loaded from the index store if it holds a previous run, read from 'old_package_index_file' otherwise"""
+    old_package_index = PackageIndex()
+    if has_stored_run():
+        index_store.load_package_index(old_package_index)
     else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+        old_package_index.import_from_xml(old_package_index_file)
+    return old_package_index
+
+def record_index_store_run(package_index, package_index_policy):
+    """Record the run in the index store, if any, once 'package_index' is published"""
+    if index_store == None:
+        return
+    run = index_store.record_run(package_index, package_index_policy)
+    print("Index store: run " + str(run) + " recorded in " + index_store.filename)
+
+def write_package_index_when_ready(package_index, package_index_file):
+    """Write package index, unless some files are not hashed yet: it will be written once their component archive is created (see deploy_packages)"""
+    package_index.is_written = False
+    if any(component.has_deferred_hashes() for package in package_index.packages for component in package.components):
+        print("Package index will be written once component archives are created")
+    elif delta and destination != None:
+        print("Package index will be written once delta archives are created")
+    elif archive_part_size != None and destination != None:
+        print("Package index will be written once part archives are created")
+    else:
+        write_package_index(package_index, package_index_file)
+
+def write_package_index(package_index, package_index_file):
+    """Write package index (and sub-indexes, for a sharded index)"""
+    with stats.phase('index write'):
+        if package_index_mode == 'sharded':
+            package_index.write_sub_indexes(package_index_file)
+        package_index.write_xml(package_index_file, package_index_mode == 'sharded')
+    package_index.is_written = True
+
+def create_archives(archives, destination, compress_jobs):
+    """Create component archives, in a pool of 'compress_jobs' processes, and deploy each archive to its package folder in 'destination' as soon as it is created. 'archives' is a list of (package, component, archive_filename). Components with the same digest (same compression and files) are only compressed once, and archives found in the archive cache (if any) are not compressed again."""
+    if len(archives) == 0:
+        return
+
+    archive_cache = ArchiveCache(archive_cache_dir, archive_cache_max_size) if archive_cache_dir != None else None
+
+    # Group archives by digest: only the first archive of each group is created, the others are copies of it.
+    # The digest of a component with deferred hashes is not known yet: such components are grouped by source files instead.
+    archives_by_digest = dict()
+    for package, component, archive_filename in archives:
+        os.makedirs(os.path.dirname(archive_filename), exist_ok=True)
+        if component.has_deferred_hashes():
+            hasher = hashlib.md5((component.compression + '\n').encode('utf-8'))
+            for path in sorted(os.path.normcase(os.path.join(package.source_path, file.path)) for file in component.files):
+                hasher.update((path + '\n').encode('utf-8'))
+            digest = 'deferred-' + hasher.hexdigest()
+        else:
+            digest = component.archive_digest()
+        archives_by_digest.setdefault(digest, []).append((package, component, archive_filename))
+
+    def deploy_archives(digest):
+        """Deploy all the archives of a digest, once the first one has been created or fetched from the cache. In the objects deploy layout, the archive is deployed once in the object store."""
+        same_archives = archives_by_digest[digest]
+        first_archive_filename = same_archives[0][2]
+        if deploy_layout == 'objects':
+            deploy_object(first_archive_filename, destination, same_archives[0][1].archive_digest() + '.zip', move=True)
+            return
+        for package, component, archive_filename in same_archives[1:]:
+            link_or_copy(first_archive_filename, archive_filename)
+        for package, component, archive_filename in same_archives:
+            deploy([ archive_filename ], package_folder(destination, package), move=True)
+
+    # Fetch archives from the cache
+    digests_to_create = []
+    for digest, same_archives in archives_by_digest.items():
+        if deploy_layout == 'objects' and not digest.startswith('deferred-') and os.path.isfile(os.path.join(destination, object_path(digest + '.zip'))):
+            print("   Found " + same_archives[0][0].id + " " + same_archives[0][1].name + " in the object store")
+        elif archive_cache != None and not digest.startswith('deferred-') and archive_cache.fetch(digest, same_archives[0][2]):
+            print("   Found " + same_archives[0][0].id + " " + same_archives[0][1].name + " in the archive cache")
+            deploy_archives(digest)
+        else:
+            digests_to_create.append(digest)
+
+    # Size of the files of each archive to create
+    archive_sizes = dict()
+    for digest in digests_to_create:
+        package, component, archive_filename = archives_by_digest[digest][0]
+        archive_sizes[digest] = sum(os.path.getsize(os.path.join(package.source_path, file.path)) for file in component.files)
+
+    def archive_created(digest, file_hashes, stored_files, seconds):
+        """Set the hashes calculated while creating the archive (if any) for all the components of its digest, remember the adaptive compression decisions, store the archive in the cache, and deploy it."""
+        for package, component, archive_filename in archives_by_digest[digest]:
+            component.set_deferred_hashes(file_hashes, package.source_path)
+        package, component, archive_filename = archives_by_digest[digest][0]
+        component.set_stored_files(stored_files)
+        stats.add('files stored', sum(1 for stored in stored_files.values() if stored))
+        stats.component_compressed(package, component, archive_sizes[digest], os.path.getsize(archive_filename), seconds)
+        if archive_cache != None:
+            archive_cache.store(archives_by_digest[digest][0][1].archive_digest(), archives_by_digest[digest][0][2])
+        deploy_archives(digest)
+
+    if compress_jobs == 1:
+        for digest in digests_to_create:
+            package, component, archive_filename = archives_by_digest[digest][0]
+            print("   Compressing " + package.id + " " + component.name + " to .zip archive, using method '" + component.compression + "'...")
+            file_hashes, stored_files, seconds = create_zip_archive_timed(*component.archive_arguments(archive_filename, package.source_path))
+            archive_created(digest, file_hashes, stored_files, seconds)
+    elif len(digests_to_create) != 0:
+        # Biggest components first, so that the last running archives are the smallest ones
+        digests_to_create.sort(key=lambda digest: archive_sizes[digest], reverse=True)
+
+        print("Compressing " + str(len(digests_to_create)) + " component(s) using " + str(compress_jobs) + " process(es)...")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=compress_jobs) as executor:
+            futures = dict()
+            for digest in digests_to_create:
+                package, component, archive_filename = archives_by_digest[digest][0]
+                future = executor.submit(create_zip_archive_timed, *component.archive_arguments(archive_filename, package.source_path))
+                futures[future] = digest
+
+            for future in concurrent.futures.as_completed(futures):
+                digest = futures[future]
+                file_hashes, stored_files, seconds = future.result()
+                package, component, archive_filename = archives_by_digest[digest][0]
+                print("   Compressed " + package.id + " " + component.name + " to .zip archive, using method '" + component.compression + "'")
+                archive_created(digest, file_hashes, stored_files, seconds)
+
+    if archive_cache != None:
+        archive_cache.print_stats()
+        archive_cache.prune()
+
+def version_key(version):
+    """Returns a key to sort versions: their numbers, compared numerically ('6.1.5.9' < '6.1.5.19')"""
+    return [int(number) for number in re.findall(r'\d+', version)], version
+
+def find_delta_bases(package_index):
+    """Returns a dictionary of package id -> package of the previous version of the same product, for the packages of 'package_index' having one. Packages are versions of the same product if they have the same type, and the same id apart from their version (e.g. ewam-6.1.5.15-x64 and ewam-6.1.5.19-x64)."""
+    packages_by_product = dict()
+    for package in package_index.packages:
+        if package.state == 'removed' or package.version == '':
+            continue
+        packages_by_product.setdefault((package.type, package.id.replace(package.version, '*')), []).append(package)
+
+    delta_bases = dict()
+    for product_packages in packages_by_product.values():
+        product_packages.sort(key=lambda package: version_key(package.version))
+        for base_package, package in zip(product_packages, product_packages[1:]):
+            if version_key(base_package.version) != version_key(package.version):
+                delta_bases[package.id] = base_package
+    return delta_bases
+
+def deployed_archive_filename(destination, package, component):
+    """Returns the path of the deployed archive of a compressed component, according to the deploy layout (in the staged folder of its package, if staged)."""
+    if deploy_layout == 'objects':
+        return os.path.join(destination, object_path(component.archive_digest() + '.zip'))
+    return os.path.join(package_folder(destination, package), component.name + '.zip')
+
+# Staging folder of the destination (see --deploy-staging)
+STAGING_DIR = '.staging'
+
+# Packages staged by the current deploy: package id -> staged folder, see package_folder()
+staged_package_folders = dict()
+
+def package_folder(destination, package):
+    """Returns the folder of the destination where the files of 'package' are deployed: its staged folder if it is being staged (see --deploy-staging), its folder otherwise."""
+    return staged_package_folders.get(package.id, os.path.join(destination, package.id))
+
+def published_path(filename):
+    """Returns the path file 'filename' of the destination will have once published: files of staged package folders are renamed along with their folder (see publish_staged_packages), the other files keep their path."""
+    staging_dir = os.path.join(destination, STAGING_DIR)
+    if deploy_staging and filename.startswith(staging_dir + os.sep):
+        return os.path.join(destination, os.path.relpath(filename, staging_dir))
+    return filename
+
+def stage_package(destination, package):
+    """Create the staged folder of 'package' (see --deploy-staging) with hard links to the files of its current folder (copies if they can't be linked): files are then deployed to the staged folder as they would be to the current folder, which is left untouched. Deployed files are never modified in place, they are removed then written again, so the current folder is not modified through its links. Returns the staged folder."""
+    staged_folder = os.path.join(destination, STAGING_DIR, package.id)
+    current_folder = os.path.join(destination, package.id)
+    if os.path.isdir(current_folder):
+        shutil.copytree(current_folder, staged_folder, copy_function=link_or_copy)
+    else:
+        os.makedirs(staged_folder)
+    staged_package_folders[package.id] = staged_folder
+    return staged_folder
+
+def publish_staged_packages(destination):
+    """Replace the folder of each staged package by its staged folder, by renaming folders (see --deploy-staging). The previous folders are moved to the staging folder, which is removed once the new package index is deployed. If a folder can't be renamed (e.g. locked by the web server), the folders already replaced are restored before the error is raised again."""
+    previous_dir = os.path.join(destination, STAGING_DIR, '.previous')
+    os.makedirs(previous_dir, exist_ok=True)
+    published_packages = []
+    try:
+        for package_id, staged_folder in sorted(staged_package_folders.items()):
+            folder = os.path.join(destination, package_id)
+            if os.path.isdir(folder):
+                os.rename(folder, os.path.join(previous_dir, package_id))
+            published_packages.append((package_id, staged_folder))
+            os.rename(staged_folder, folder)
+    except OSError as error:
+        print("Error: can't publish the staged package folders (" + str(error) + "), restoring the previous ones...")
+        for package_id, staged_folder in reversed(published_packages):
+            restore_package_folder(os.path.join(destination, package_id), staged_folder, os.path.join(previous_dir, package_id))
+        raise
+    if len(staged_package_folders) != 0:
+        print("Published " + str(len(staged_package_folders)) + " staged package folder(s)")
+    staged_package_folders.clear()
+
+def restore_package_folder(folder, staged_folder, previous_folder):
+    """Restore the package folder 'folder' replaced by publish_staged_packages: it is moved back to 'staged_folder', and 'previous_folder' is moved back in its place. If it can't be, the previous folder is moved next to the package folder instead, so that it is not removed with the staging folder."""
+    try:
+        if os.path.isdir(folder) and not os.path.isdir(staged_folder):
+            os.rename(folder, staged_folder)
+        if os.path.isdir(previous_folder):
+            os.rename(previous_folder, folder)
+    except OSError as error:
+        print("Error: can't restore " + folder + " (" + str(error) + "), its previous folder is kept in " + folder + ".previous")
+        os.rename(previous_folder, folder + '.previous')
+
+def remove_part_archives(parts, package_destination, kept_archives=()):
+    """Remove the deployed part archives of 'parts' (see --archive-part-size) from the package folder 'package_destination', except those named in 'kept_archives'. In the objects deploy layout, part archives are objects, removed by collect_objects once no longer referenced."""
+    for part in parts:
+        part_filename = os.path.join(package_destination, part.archive)
+        if not part.archive in kept_archives and os.path.isfile(part_filename):
+            os.remove(part_filename)
+
+def create_deltas(archives, package_index, destination, archive_dir, compress_jobs):
+    """Create and deploy a delta archive for each component archive built by create_archives ('archives' is a list of (package, component, archive_filename)), against the deployed archive of the same component of the previous version of the package. Delta archives bigger than delta_max_ratio times the full archive are not kept. Delta archives are created in a pool of 'compress_jobs' processes."""
+    delta_bases = find_delta_bases(package_index)
+
+    deltas_to_create = []
+    for package, component, archive_filename in archives:
+        base_package = delta_bases.get(package.id)
+        if base_package == None:
+            continue
+        base_component = base_package[component]
+        if base_component == None or base_component.state == 'removed' or not base_component.is_compressed():
+            continue
+        base_archive_filename = deployed_archive_filename(destination, base_package, base_component)
+        if not os.path.isfile(base_archive_filename):
+            continue
+        delta_filename = os.path.join(archive_dir, package.id, component.name + '.delta-' + base_package.version + '.zip')
+        deltas_to_create.append((package, component, base_package, base_archive_filename, delta_filename))
+
+    if len(deltas_to_create) == 0:
+        return
+
+    def delta_created(package, component, base_package, delta_filename, delta_size):
+        """Keep the delta archive if it is small enough compared to the full archive, and deploy it."""
+        full_size = os.path.getsize(deployed_archive_filename(destination, package, component))
+        if delta_size > delta_max_ratio * full_size:
+            print("   Delta of " + package.id + " " + component.name + " against " + base_package.version + " not kept: " + str(delta_size) + " bytes, full archive is " + str(full_size) + " bytes")
+            os.remove(delta_filename)
+            return
+        print("   Delta of " + package.id + " " + component.name + " against " + base_package.version + ": " + str(delta_size) + " bytes, full archive is " + str(full_size) + " bytes")
+        component.delta = Delta(base_package.id, base_package.version, os.path.basename(delta_filename), hash_file(delta_filename), delta_size)
+        deploy([ delta_filename ], package_folder(destination, package), move=True)
+
+    def delta_arguments(package, component, base_package, base_archive_filename, delta_filename):
+        base_files = dict((file.path, file.hash) for file in base_package[component].files if file.state != 'removed')
+        files = dict((file.path, file.hash) for file in component.files if file.state != 'removed')
+        return (delta_filename, component.archive_format(), base_archive_filename, base_files, package.source_path, files, delta_max_file_size)
+
+    print("Creating " + str(len(deltas_to_create)) + " delta archive(s)...")
+    if compress_jobs == 1:
+        for package, component, base_package, base_archive_filename, delta_filename in deltas_to_create:
+            delta_size = create_delta_archive(*delta_arguments(package, component, base_package, base_archive_filename, delta_filename))
+            delta_created(package, component, base_package, delta_filename, delta_size)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=compress_jobs) as executor:
+        futures = dict()
+        for delta_to_create in deltas_to_create:
+            futures[executor.submit(create_delta_archive, *delta_arguments(*delta_to_create))] = delta_to_create
+        for future in concurrent.futures.as_completed(futures):
+            package, component, base_package, base_archive_filename, delta_filename = futures[future]
+            delta_created(package, component, base_package, delta_filename, future.result())
+
+def publish_file(filename, destination, sidecars=False):
+    """Deploy file 'filename' to the 'destination' folder as deploy() does, but atomically: the file is copied next to its destination under a temporary name, then renamed, so that clients downloading it (package indexes) never get a partially written file. If 'sidecars', its sidecars (see --precompress) are written under temporary names too, and renamed right before the file: clients accepting precompressed files never get a previous version of it once it is published. Returns the deployed file name."""
+    if not os.path.isabs(filename):
+        real_destination = os.path.join(destination, os.path.dirname(filename))
+    else:
+        real_destination = destination
+    destination_filename = os.path.join(real_destination, os.path.basename(filename))
+    with stats.phase('copy'):
+        make_directories(real_destination)
+    published_sidecars = write_published_sidecars(filename, destination_filename) if sidecars and len(precompress) != 0 else []
+
+    with stats.phase('copy'):
+        print_detail("   copying " + filename + " to " + real_destination)
+        stats.add('files copied')
+        stats.add('bytes copied', os.path.getsize(filename))
+        shutil.copyfile(filename, destination_filename + '.tmp')
+        for temporary_sidecar, sidecar_filename in published_sidecars:
+            if temporary_sidecar != None:
+                os.replace(temporary_sidecar, sidecar_filename)
+            elif os.path.isfile(sidecar_filename):
+                os.remove(sidecar_filename)
+        os.replace(destination_filename + '.tmp', destination_filename)
+    return destination_filename
 
 def deploy_packages(package_index_file, new_package_index, destination, deploy_policy):
-    """Deploy files from package index. Use 'state' attribute to know if the package/component/file has been modified, added, removed or is unchanged, thus deciding what to do about it, depending on the deploy_policy"""
+    """Deploy files from package index. Use 'state' attribute to know if the package/component/file has been modified, added, removed or is unchanged, thus deciding what to do about it, depending on the deploy_policy. Component archives are created in parallel once the list of archives to (re)build is known (see create_archives). Package indexes are deployed last, once every archive has been deployed. With --deploy-staging, packages are deployed to staged folders, published right before the package index."""
     print("Deploying...")
 
-    # backup cwd
-    tmp_dir = os.getcwd()
-
     if deploy_policy == 'wipe' and os.path.exists(destination):
         print("Wiping destination folder " + destination + "...")
-        shutil.rmtree(destination, ignore_errors=False)
-
-    # Zip everything (if needed) and copy to target destination
-    for package in new_package_index.packages:
-        
-        # if the package is marked as unchanged, just skip it
-        if deploy_policy == 'update' and package.state == "unchanged":
-            print("unchanged package '" + package.id)
-            continue
+        with stats.phase('cleanup'):
+            shutil.rmtree(destination, ignore_errors=False)
+    existing_directories.clear()
+    deploy_failures.clear()
+
+    # Staged folders and temporary archives left by an interrupted run are dropped
+    staging_dir = os.path.join(destination, STAGING_DIR)
+    staged_package_folders.clear()
+    if os.path.isdir(staging_dir):
+        with stats.phase('cleanup'):
+            shutil.rmtree(staging_dir, ignore_errors=False)
+    os.makedirs(staging_dir, exist_ok=True)
+
+    try:
+        # Folders of the packages removed, deleted once the new package index is deployed (with --deploy-staging)
+        removed_package_folders = []
+
+        # Archives to create: they are created in a temporary folder of the staging folder of the destination (not served, see Documentation/web.config), so that they are deployed
+        # by renaming them, and not written twice when the current directory is on another volume. The temporary folder has a sub-folder per package as several packages may have
+        # components with the same name. Files of the packages are found from the package folders.
+        archive_dir = tempfile.mkdtemp(prefix='.packagebuilder-', dir=staging_dir)
+        archives = []
+
+        # Components split in part archives, and their parts (see --archive-part-size)
+        split_components = []
+
+        # Packages which sub-index (sharded package index) has to be deployed
+        sub_index_packages = []
+
+        # Find archives to (re)build and copy raw files to target destination
+        for package in new_package_index.packages:
+            package_destination = os.path.join(destination, package.id)
+
+            # if the package is marked as unchanged, just skip it (unless some of its objects are missing from the object store)
+            if deploy_policy == 'update' and package.state == "unchanged" and not (deploy_layout == 'objects' and any(has_missing_objects(component, destination) for component in package.components if component.state != "removed")):
+                print("unchanged package '" + package.id)
+                # its sub-index is deployed all the same if missing (previous package index not sharded)
+                if package_index_mode == 'sharded' and not os.path.isfile(os.path.join(package_destination, os.path.basename(package_index_file))):
+                    sub_index_packages.append(package)
+                continue
         
-        # if package is marked as removed, delete its destination
-        if deploy_policy == 'update' and package.state == "removed":
-            print("removed package '" + package.id)
-            shutil.rmtree(destination + "\\" + package.id, ignore_errors=False)
-            continue
+            # if package is marked as removed, delete its destination (its objects are removed by collect_objects, unless another package references them)
+            if deploy_policy == 'update' and package.state == "removed":
+                print("removed package '" + package.id)
+                if deploy_staging:
+                    removed_package_folders.append(package_destination)
+                elif os.path.isdir(package_destination):
+                    shutil.rmtree(package_destination, ignore_errors=False)
+                continue
 
-        # for each component of the package
-        print("deploying package " + package.id)
-        os.chdir(package.source_path)
-        for component in package.components:
+            # files of a staged package are deployed to its staged folder
+            if deploy_staging:
+                with stats.phase('copy'):
+                    package_destination = stage_package(destination, package)
 
-            # if component is marked as unchanged, skip it
-            if deploy_policy == 'update' and component.state == "unchanged":
-                continue
+            # for each component of the package
+            print("deploying package " + package.id)
+            for component in package.components:
+
+                # if component is marked as unchanged, skip it (unless some of its objects are missing from the object store)
+                if deploy_policy == 'update' and component.state == "unchanged" and not (deploy_layout == 'objects' and has_missing_objects(component, destination)):
+                    continue
 
-            # If component compression has changed, just remove any existing file, the component will be re-generated (zip or raw files of the component)
-            if deploy_policy == 'update' and component.state == "modifiedcompression":
+                # If component compression has changed, just remove any existing file, the component will be re-generated (zip or raw files of the component)
+                if deploy_policy == 'update' and component.state == "modifiedcompression":
                 
-                print("   changed compression of '" + component.name + "' to " + component.compression)
+                    print("   changed compression of '" + component.name + "' to " + component.compression)
+
+                    zip_filename = component.name + ".zip"
+                    if os.path.isfile(os.path.join(package_destination, zip_filename)):
+                        os.remove(os.path.join(package_destination, zip_filename))
+                    remove_part_archives(component.parts, package_destination)
+                    component.parts = []
 
-                zip_filename = component.name + ".zip"
-                if os.path.isfile(destination + "\\" + package.id + '\\' + zip_filename):
-                    os.remove(destination + "\\" + package.id + '\\' + zip_filename)
+                    for file in component.files:
+                        if os.path.isfile(os.path.join(package_destination, file.path)):
+                            remove_deployed_file(os.path.join(package_destination, file.path))
 
-                for file in component.files:
-                    if os.path.isfile(destination + "\\" + package.id + '\\' + file.path):
-                        os.remove(destination + "\\" + package.id + '\\' + file.path)
+                # The delta archive of a component is out of date once the component changed (it is re-created by create_deltas if needed)
+                if component.state != "removed" and component.delta != None:
+                    if os.path.isfile(os.path.join(package_destination, component.delta.archive)):
+                        os.remove(os.path.join(package_destination, component.delta.archive))
+                    component.delta = None
 
-            # if the component is marked for compression, put all its files in a zip file named after the component
-            if component.compression != None and component.compression != "None" and component.compression != "":
+                # if the component is marked for compression, put all its files in a zip file named after the component
+                if component.is_compressed():
 
-                zip_filename = component.name + ".zip"
+                    zip_filename = component.name + ".zip"
                 
-                # if the component has been marked as removed, remove its corresponding archive if it exists
-                if deploy_policy == 'update' and component.state == "removed":
-                    if os.path.isfile(destination + "\\" + package.id + '\\' + zip_filename):
-                        print("   component '" + component.name + "' : removed")
-                        os.remove(destination + "\\" + package.id + '\\' + zip_filename)
-                    continue
+                    # if the component has been marked as removed, remove its corresponding archive if it exists
+                    if deploy_policy == 'update' and component.state == "removed":
+                        if os.path.isfile(os.path.join(package_destination, zip_filename)):
+                            print("   component '" + component.name + "' : removed")
+                            os.remove(os.path.join(package_destination, zip_filename))
+                        if component.delta != None and os.path.isfile(os.path.join(package_destination, component.delta.archive)):
+                            os.remove(os.path.join(package_destination, component.delta.archive))
+                        remove_part_archives(component.parts, package_destination)
+                        continue
 
-                # Create component zip
-                print("   Compressing " + component.name + " to .zip archive, using method '" + component.compression + "'...")
-                component.create_zip(tmp_dir + "\\" + zip_filename)
-                deploy([ tmp_dir + "\\" + zip_filename ], destination + "\\" + package.id, move=True)
+                    # Component zip is created later, along with all the other archives
+                    parts = component.split(package.source_path)
+                    if len(parts) == 0:
+                        remove_part_archives(component.parts, package_destination)
+                        component.parts = []
+                        archives.append((package, component, os.path.join(archive_dir, package.id, zip_filename)))
 
-            # if the component is not marked for compression, simply deploy the files of the component
-            else:
+                    # A big component is split in part archives: only the parts which content changed are rebuilt
+                    else:
+                        if os.path.isfile(os.path.join(package_destination, zip_filename)):
+                            os.remove(os.path.join(package_destination, zip_filename))
+                        deployed_parts = dict((part.archive, part.digest) for part in component.parts) if deploy_policy == 'update' else dict()
+                        unchanged_count = 0
+                        for part in parts:
+                            if not part.has_deferred_hashes() and deployed_parts.get(part.name + '.zip') == part.archive_digest() and os.path.isfile(deployed_archive_filename(destination, package, part)):
+                                unchanged_count += 1
+                                continue
+                            archives.append((package, part, os.path.join(archive_dir, package.id, part.name + '.zip')))
+                        remove_part_archives(component.parts, package_destination, set(part.name + '.zip' for part in parts))
+                        split_components.append((component, parts))
+                        print("   component '" + component.name + "' : " + str(len(parts)) + " part(s), " + str(unchanged_count) + " unchanged")
+
+                # if the component is not marked for compression, simply deploy the files of the component
+                else:
 
-                # if the component is marked as removed, delete each of his existing already deployed files
-                if deploy_policy == 'update' and component.state == "removed":
-                    print("   component '" + component.name + "' : removed, removing files:")
-                    for file in component.files:
-                        if os.path.isfile(destination + "\\" + package.id + '\\' + file.path):
-                            print("      file '" + file.path + "' : removed")
-                            os.remove(destination + "\\" + package.id + '\\' + file.path)
-                    continue
+                    # if the component is marked as removed, delete each of his existing already deployed files
+                    if deploy_policy == 'update' and component.state == "removed":
+                        print("   component '" + component.name + "' : removed, removing files:")
+                        for file in component.files:
+                            if os.path.isfile(os.path.join(package_destination, file.path)):
+                                print_detail("      file '" + file.path + "' : removed")
+                                remove_deployed_file(os.path.join(package_destination, file.path))
+                        continue
 
-                # for each file of the component...
-                filenames_to_deploy = []
-                for file in component.files:
+                    # for each file of the component...
+                    filenames_to_deploy = []
+                    file_hashes = dict()
+                    for file in component.files:
 
-                    # if the file is marked as removed, remove its pre-existing instance
-                    if deploy_policy == 'update' and file.state == "removed":
-                        if os.path.isfile(destination + "\\" + package.id + '\\' + file.path):
-                            print("      file '" + file.path + "' : removed")
-                            os.remove(destination + "\\" + package.id + '\\' + file.path)
+                        # if the file is marked as removed, remove its pre-existing instance
+                        if deploy_policy == 'update' and file.state == "removed":
+                            if os.path.isfile(os.path.join(package_destination, file.path)):
+                                print_detail("      file '" + file.path + "' : removed")
+                                remove_deployed_file(os.path.join(package_destination, file.path))
                             
-                    # otherwise just add the file to the list of files to deploy
-                    else:
-                        filenames_to_deploy.append(file.path)
+                        # otherwise just add the file to the list of files to deploy
+                        else:
+                            filenames_to_deploy.append(file.path)
+                            file_hashes[file.path] = file.hash
                 
-                deploy(filenames_to_deploy, destination + "\\" + package.id)
-
+                    if deploy_layout == 'objects':
+                        stored_count = 0
+                        for filename in filenames_to_deploy:
+                            if file_hashes[filename] == '':
+                                continue
+                            stored = deploy_object(os.path.join(package.source_path, filename), destination, file_hashes[filename])
+                            update_sidecars(os.path.join(destination, object_path(file_hashes[filename])), stored)
+                            if stored:
+                                stored_count += 1
+                        print("   component '" + component.name + "' : " + str(stored_count) + " file(s) stored, " + str(len(filenames_to_deploy) - stored_count) + " already in the object store")
+                    else:
+                        deploy(filenames_to_deploy, package_destination, file_hashes=file_hashes, sidecars=True, base_dir=package.source_path)
+
+            # its sub-index is deployed once written: with a deferred package index write, 'index_file' is only set then
+            if package_index_mode == 'sharded':
+                sub_index_packages.append(package)
+
+        # Create and deploy component archives, then their delta archives
+        with stats.phase('compress'):
+            create_archives(archives, destination, compress_jobs)
+        # the digests of the parts are known once their files are all hashed
+        for component, parts in split_components:
+            component.parts = [Part(part.name + '.zip', part.archive_digest()) for part in parts]
+        if delta:
+            with stats.phase('delta'):
+                create_deltas(archives, new_package_index, destination, archive_dir, compress_jobs)
+        with stats.phase('cleanup'):
+            shutil.rmtree(archive_dir, ignore_errors=True)
+
+        # The new package index is not deployed if some of its files could not be: clients keep using the previous one
+        if len(deploy_failures) != 0:
+            print("Error: " + str(len(deploy_failures)) + " file(s) could not be deployed after " + str(deploy_retries) + " retries, package index not deployed:")
+            for destination_filename, error in deploy_failures:
+                print("   " + destination_filename + ": " + error)
+            exit(1)
 
-    os.chdir(tmp_dir)
+        # With deferred hashing, delta or part archives, the package index could only be written once all the archives got created.
+        # Sub-indexes of a sharded index are written along with it, so they are only deployed below, once it is written.
+        if not new_package_index.is_written:
+            write_package_index(new_package_index, package_index_file)
+
+        # Deploy package sub-indexes (sharded package index). Sub-indexes of unchanged packages are not re-generated by make_package_index.
+        for package in sub_index_packages:
+            if not os.path.isfile(package.index_file):
+                package.write_sub_index()
+            publish_file(package.index_file, package_folder(destination, package), sidecars=True)
+
+        # Staged packages are published all at once, right before the package index
+        if deploy_staging:
+            with stats.phase('publish'):
+                publish_staged_packages(destination)
+
+        # Deploy newly created package-index
+        print("Deploying " + package_index_file + "...")
+        publish_file(package_index_file, destination, sidecars=True)
+
+        # Folders of the removed packages, and previous folders of the staged packages (in the staging folder), are not referenced anymore
+        with stats.phase('cleanup'):
+            for folder in removed_package_folders:
+                if os.path.isdir(folder):
+                    shutil.rmtree(folder, ignore_errors=False)
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        # Objects are only removed once the new package index, which doesn't reference them anymore, is deployed
+        if deploy_layout == 'objects' and deploy_policy == 'update':
+            with stats.phase('cleanup'):
+                collect_objects(new_package_index, destination)
+    finally:
+        # Staged folders, temporary archives and previous folders of the published packages are dropped, whether the deploy succeeded or not
+        staged_package_folders.clear()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+# Linux inotify API (see inotify(7)), used through ctypes by InotifyWatcher
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+class InotifyWatcher:
+    """Watches directory trees for changes with the Linux inotify API. Every directory of the trees is watched, directories created later are watched as soon as they are reported."""
+
+    EVENT = struct.Struct('iIII') # wd, mask, cookie, length of the name that follows
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self, root_dirs):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1: " + os.strerror(ctypes.get_errno()))
+        self.watches = dict() # watch descriptor -> directory
+        try:
+            for root_dir in root_dirs:
+                self.watch_tree(root_dir)
+        except OSError:
+            self.close()
+            raise
+
+    def watch_tree(self, path):
+        """Watch directory 'path' and its sub-directories"""
+        for directory, subdirectories, filenames in os.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                # the directory may already be gone, its removal is reported anyway
+                if error == errno.ENOENT or error == errno.ENOTDIR:
+                    continue
+                raise OSError(error, "inotify_add_watch " + directory + ": " + os.strerror(error))
+            self.watches[wd] = directory
+
+    def wait(self, timeout):
+        """Wait up to 'timeout' seconds (forever if None) for changes. Returns the set of changed paths (files or directories), and True if changes were lost (too many changes at once): the trees must then be scanned again."""
+        ready, unused, unused = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return set(), False
+
+        changed_paths = set()
+        rescan = False
+        data = os.read(self.fd, 1024 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0')
+            offset += self.EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                rescan = True
+                continue
+            directory = self.watches.get(wd)
+            if directory == None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if len(name) != 0 else directory
+            changed_paths.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self.watch_tree(path)
+                except OSError as error:
+                    print("Warning: can't watch " + path + " (" + str(error) + "), rescanning")
+                    rescan = True
+        return changed_paths, rescan
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """Watches directory trees for changes by comparing the size and modification time of every file at regular intervals. Used where inotify is not available."""
+
+    def __init__(self, root_dirs, interval):
+        self.root_dirs = root_dirs
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        """Returns a dictionary of path -> (is_dir, size, modification time) of every file and directory of the trees. Only the existence of directories is compared: their modification time changes along with their content, which is reported file by file."""
+        snapshot = dict()
+        pending = list(self.root_dirs)
+        while len(pending) != 0:
+            try:
+                with os.scandir(pending.pop()) as directory:
+                    for entry in directory:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                snapshot[entry.path] = (True, 0, 0)
+                                pending.append(entry.path)
+                            else:
+                                entry_stat = entry.stat(follow_symlinks=False)
+                                snapshot[entry.path] = (False, entry_stat.st_size, entry_stat.st_mtime_ns)
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+        return snapshot
+
+    def wait(self, timeout):
+        """Wait 'timeout' seconds (the polling interval if None), then returns the set of paths changed since the previous call, see InotifyWatcher.wait"""
+        time.sleep(self.interval if timeout == None else timeout)
+        snapshot = self.take_snapshot()
+        changed_paths = set(path for path, entry in snapshot.items() if self.snapshot.get(path) != entry)
+        changed_paths.update(path for path in self.snapshot if not path in snapshot)
+        self.snapshot = snapshot
+        return changed_paths, False
+
+    def close(self):
+        pass
+
+def make_watcher(root_dirs):
+    """Returns the watcher of the root paths selected by --watch-method"""
+    if watch_method != 'polling':
+        try:
+            return InotifyWatcher(root_dirs)
+        except (OSError, AttributeError) as error:
+            if watch_method == 'inotify':
+                print("Error: can't watch changes with inotify: " + str(error))
+                exit(1)
+            print("Warning: inotify not available (" + str(error) + "), polling for changes every " + str(watch_poll_interval) + " second(s)")
+    return PollingWatcher(root_dirs, watch_poll_interval)
+
+def is_ignored_path(path):
+    """Returns True for the paths changed by the package builder itself: destination, staging folders and temporary archives, package indexes, index store, hash cache and statistics"""
+    if destination != None and (path == destination or path.startswith(destination + os.sep)):
+        return True
+    index_name = os.path.basename(package_index_file)
+    if os.path.basename(path) == index_name or os.path.basename(path) == index_name + '.tmp':
+        return True
+    if path.startswith(os.path.abspath(hash_cache_file)) or (trace_json_file != None and path == os.path.abspath(trace_json_file)):
+        return True
+    if index_store_file != None and path.startswith(os.path.abspath(index_store_file)):
+        return True
+    # Staging folders and temporary archives of a deploy, wherever the destination is (see deploy_packages)
+    return any(segment == STAGING_DIR or segment.startswith('.packagebuilder-') for segment in path.split(os.sep))
+
+def is_definition_file(path):
+    """Returns True for *.package-definition and *.package-components files"""
+    return path.endswith('.package-definition') or path.endswith('.package-components')
+
+def is_in_directory(path, directory):
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+def mark_modified(package, component):
+    """Mark a component, and its package, as modified by a change of one of its files"""
+    if component.state == 'unchanged' or component.state == 'removed':
+        component.state = 'modified'
+    if package.state == 'unchanged':
+        package.state = 'modified'
+
+def remove_component_file(package, component, componentFile):
+    """Remove a file that doesn't exist anymore from a component. Files of raw components are kept with the 'removed' state until deployed, so that deploy_packages removes them from the destination. A component left without files is removed."""
+    if component.is_compressed() or componentFile.state == 'added':
+        component.remove(componentFile)
+    else:
+        componentFile.state = 'removed'
+    mark_modified(package, component)
+    if all(other_file.state == 'removed' for other_file in component.files):
+        if component.state == 'added':
+            package.remove(component)
+        else:
+            component.state = 'removed'
+
+def update_package_file(package, path, files_to_hash):
+    """Update the components of 'package' for file 'path' (relative to the package folder), which has been added, modified or removed: the file is added to the components which patterns match it, and removed from the others. Files to (re)hash are appended to 'files_to_hash', as (File, Package, Component, hash before the change)."""
+    path = os.path.normpath(path)
+    exists = os.path.isfile(os.path.join(package.source_path, path))
+    for name, (compression, patterns) in package.component_patterns.items():
+        matches = exists and any(DirectoryIndex.path_matches(pattern, path) for pattern in patterns)
+        component = package.components_by_name.get(name)
+        componentFile = component.files_by_path.get(path) if component != None else None
+
+        if matches:
+            if component == None:
+                component = Component(name, compression)
+                component.patterns = patterns
+                package.append(component)
+            if component.state == 'added' or component.state == 'removed':
+                mark_modified(package, component)
+            if componentFile == None:
+                componentFile = File(path)
+                component.append(componentFile)
+                files_to_hash.append((componentFile, package, component, None))
+                continue
+            if componentFile.state == 'removed':
+                componentFile.state = 'unchanged'
+            files_to_hash.append((componentFile, package, component, componentFile.hash))
+
+        elif componentFile != None and componentFile.state != 'removed':
+            remove_component_file(package, component, componentFile)
+
+def rebuild_root(package_index, root_dir, directory_indexes):
+    """Build the packages of root path 'root_dir' again (a package or components definition changed), and replace its packages in 'package_index', setting their state as an update would"""
+    try:
+        packages = build_pacakge_list(root_dir, directory_indexes)
+    except SystemExit:
+        print("Error: packages of " + root_dir + " not updated, waiting for the next change...")
+        return
+    hash_packages(packages, jobs)
+
+    old_packages = [package for package in package_index.packages if package.source_path != '' and is_in_directory(package.source_path, root_dir)]
+    root_package_index = PackageIndex(packages)
+    diff_package_index(root_package_index, PackageIndex(old_packages), package_index_policy if package_index_policy == 'update-keep-old-packages' else 'update')
+    for package in old_packages:
+        package_index.remove(package)
+    for package in root_package_index.packages:
+        package.sort()
+        package_index.append(package)
+
+def apply_changes(package_index, directory_indexes, changed_paths, rescan):
+    """Update 'package_index' for 'changed_paths' (absolute paths of files or directories added, modified or removed). The packages of a root path are built again if one of its definition files changed (or if changes were lost), otherwise each changed file is matched against the component patterns of the packages which folder contains it. Returns the files to hash, see update_package_file."""
+    roots_to_rebuild = set(directory_indexes) if rescan else set()
+    # files matched by patterns going out of the package folder can't be mapped to their package: the whole root path is built again
+    outside_roots = set(root_dir for root_dir in directory_indexes if any(DirectoryIndex.is_outside(pattern) for package in package_index.packages if is_in_directory(package.source_path, root_dir) for compression, patterns in package.component_patterns.values() for pattern in patterns))
+    # (root path, file path) of each file changed, once even if it is found under several paths (see DirectoryIndex.aliases)
+    changed_files = dict()
+    for changed_path in sorted(changed_paths):
+        root_dirs = [root_dir for root_dir in directory_indexes if is_in_directory(changed_path, root_dir)]
+        if len(root_dirs) == 0:
+            continue
+        root_dir = max(root_dirs, key=len)
+        directory_index = directory_indexes[root_dir]
+        path = os.path.relpath(changed_path, root_dir)
+
+        # a directory added or removed stands for all its files, and the path may be indexed under symbolic links to its folders too (see DirectoryIndex.aliases)
+        indexed_paths = [path] + directory_index.aliases(path)
+        paths = []
+        was_dirs = []
+        for indexed_path in indexed_paths:
+            entry = directory_index.lookup(indexed_path)
+            was_dirs.append(entry != None and entry[1])
+            if was_dirs[-1]:
+                paths.extend(directory_index.list_files(indexed_path))
+        directory_index.update(path)
+        for indexed_path, was_dir in zip(indexed_paths, was_dirs):
+            entry = directory_index.lookup(indexed_path)
+            is_dir = entry != None and entry[1]
+            if is_dir and not was_dir:
+                paths.extend(directory_index.list_files(indexed_path))
+            elif not is_dir:
+                paths.append(indexed_path)
+
+        for path in paths:
+            changed_files[(root_dir, path)] = True
+            if is_definition_file(path) or root_dir in outside_roots:
+                roots_to_rebuild.add(root_dir)
+
+    if rescan:
+        for directory_index in directory_indexes.values():
+            directory_index.update('')
+    for root_dir in sorted(roots_to_rebuild):
+        rebuild_root(package_index, root_dir, directory_indexes)
+
+    files_to_hash = []
+    for root_dir, path in changed_files:
+        if root_dir in roots_to_rebuild:
+            continue
+        full_path = os.path.join(root_dir, path)
+        for package in package_index.packages:
+            if package.source_path != '' and package.state != 'removed' and is_in_directory(full_path, package.source_path):
+                update_package_file(package, os.path.relpath(full_path, package.source_path), files_to_hash)
+    return files_to_hash
+
+def hash_changed_files(files_to_hash):
+    """Hash the files added or modified (see update_package_file), and set the state of their component and package accordingly"""
+    print("Hashing " + str(len(files_to_hash)) + " file(s) using " + str(jobs) + " thread(s)...")
+    hash_files([(componentFile, package.source_path, False) for componentFile, package, component, previous_hash in files_to_hash], jobs)
+    for componentFile, package, component, previous_hash in files_to_hash:
+        # the file may have been removed since
+        if componentFile.hash == '':
+            if componentFile in component:
+                remove_component_file(package, component, componentFile)
+        elif previous_hash == None or componentFile.hash != previous_hash:
+            if componentFile.state != 'added':
+                componentFile.state = 'modified'
+            mark_modified(package, component)
+
+def settle_package_index(package_index):
+    """Once 'package_index' is published, drop its removed packages, components and files, and mark everything else as unchanged: the next changes are compared to what has been published (see watch_package_index)."""
+    for package in list(package_index.packages):
+        if package.state == 'unchanged':
+            continue
+        if package.state == 'removed':
+            package_index.remove(package)
+            continue
+        for component in list(package.components):
+            if component.state == 'removed':
+                package.remove(component)
+                continue
+            for componentFile in list(component.files):
+                if componentFile.state == 'removed':
+                    component.remove(componentFile)
+                else:
+                    componentFile.state = 'unchanged'
+            component.state = 'unchanged'
+        package.state = 'unchanged'
+
+def update_package_index(package_index, directory_indexes, changed_paths, rescan):
+    """Update 'package_index' for the changed paths, then write and deploy it (see watch_package_index)"""
+    print(("Changes lost, rescanning" if rescan else str(len(changed_paths)) + " path(s) changed") + ", updating package index...")
+    with stats.phase('parse'):
+        files_to_hash = apply_changes(package_index, directory_indexes, changed_paths, rescan)
+    with stats.phase('hash'):
+        hash_changed_files(files_to_hash)
+
+    changed_packages = [package for package in package_index.packages if package.state != 'unchanged']
+    if len(changed_packages) == 0:
+        print("No package changed")
+        return
+    for package in changed_packages:
+        print("   " + package.state + " package " + package.id)
+        package.sort()
+    package_index.packages.sort(key=lambda package:package.id)
+
+    with stats.phase('diff'):
+        write_package_index_when_ready(package_index, package_index_file)
+    if destination != None and destination != "":
+        with stats.phase('deploy'):
+            try:
+                deploy_packages(package_index_file, package_index, destination, 'update')
+            except SystemExit:
+                # packages are not settled: they are deployed again along with the next change
+                print("Error: package index not deployed, waiting for the next change...")
+                return
+    with stats.phase('cleanup'):
+        hash_cache.commit()
+        record_index_store_run(package_index, 'update')
+    settle_package_index(package_index)
+    print("Package index updated")
+
+def watch_package_index(package_index, directory_indexes):
+    """Keep 'package_index' and the DirectoryIndex of each root path ('directory_indexes') in memory, and update them as files change (see --watch), until interrupted. Changes are processed by bursts: once no change happened for --watch-debounce seconds (or after 10 times as long, for changes that never stop)."""
+    global stats
+
+    settle_package_index(package_index)
+    watcher = make_watcher(sorted(directory_indexes))
+    print("Watching " + ", ".join(sorted(directory_indexes)) + " for changes (Ctrl+C to stop)...")
+    try:
+        while True:
+            changed_paths, rescan = watcher.wait(None)
+            if len(changed_paths) == 0 and not rescan:
+                continue
+            first_change_time = time.monotonic()
+            while time.monotonic() - first_change_time < 10 * watch_debounce:
+                more_paths, more_rescan = watcher.wait(watch_debounce)
+                if len(more_paths) == 0 and not more_rescan:
+                    break
+                changed_paths.update(more_paths)
+                rescan = rescan or more_rescan
 
-    # Deploy newly created package-index
-    print("Deploying " + package_index_file + "...")
-    deploy([ package_index_file ], destination, move=False)
+            changed_paths = set(path for path in changed_paths if not is_ignored_path(path))
+            if len(changed_paths) == 0 and not rescan:
+                continue
+            stats = RunStats()
+            update_package_index(package_index, directory_indexes, changed_paths, rescan)
+            if show_stats:
+                stats.print_summary()
+            if trace_json_file != None:
+                stats.write_json(trace_json_file)
+    except KeyboardInterrupt:
+        print("Stopped watching for changes")
+    finally:
+        watcher.close()
 
 def main():
+    global hash_cache, index_store, stats
+
+    parse_arguments()
+    stats = RunStats()
+
+    # Open file hash cache, to avoid re-hashing files that didn't change since previous run
+    hash_cache = HashCache(os.path.abspath(hash_cache_file), rehash, hash_algorithm)
+    if index_store_file != None:
+        index_store = IndexStore(os.path.abspath(index_store_file))
+
     # Gather packages/components/files list from **/.package-definition and **/.package-components files
+    # Root paths are scanned concurrently, then their packages are listed in the order of the root paths
     packages = []
-    for root_path in root_pathes:
-        root_path = os.path.abspath(root_path)
-        packages.extend(build_pacakge_list(root_path))
+    directory_indexes = dict()
+    scan_cache = ScanCache()
+    root_dirs = [os.path.abspath(root_path) for root_path in root_pathes]
+    with stats.phase('scan'):
+        scan_root_paths(root_dirs, directory_indexes)
+    for root_dir in root_dirs:
+        with stats.phase('parse'):
+            packages.extend(build_pacakge_list(root_dir, directory_indexes, scan_cache))
+
+    # Hash all the files found. Hashing can only be deferred to the creation of component archives if packages are deployed.
+    with stats.phase('hash'):
+        hash_packages(packages, jobs, defer_hash and destination != None)
+    hash_cache.print_stats()
 
     #Build new package index, and generate package-index XML file
     old_package_index_file = package_index_file
     if destination != None and destination != "":
-        old_package_index_file = destination + "\\" + package_index_file
-    new_package_index = make_package_index(packages, package_index_file, old_package_index_file, package_index_policy)
+        old_package_index_file = os.path.join(destination, package_index_file)
+    with stats.phase('diff'):
+        new_package_index = make_package_index(packages, package_index_file, old_package_index_file, package_index_policy)
 
     # Deploy
     if destination != None and destination != "":
-        deploy_packages(package_index_file, new_package_index, destination, deploy_policy)
-
-main()
\ No newline at end of file
+        with stats.phase('deploy'):
+            deploy_packages(package_index_file, new_package_index, destination, deploy_policy)
+
+    # Save file hashes, including the ones calculated while compressing (dropping the files not found by this run), and the package index in the index store
+    with stats.phase('cleanup'):
+        hash_cache.commit(prune=True)
+        record_index_store_run(new_package_index, package_index_policy)
+
+    if show_stats:
+        stats.print_summary()
+    if trace_json_file != None:
+        stats.write_json(trace_json_file)
+
+    # Keep running, updating the package index as files change
+    if watch_changes:
+        watch_package_index(new_package_index, directory_indexes)
+    hash_cache.save()
+    if index_store != None:
+        index_store.close()
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
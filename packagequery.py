@@ -0,0 +1,44 @@
+import argparse
+import os
+
+import packagebuilder
+
+# This script queries the package index store of packagebuilder.py (see its --index-store argument), without loading the whole
+# package index: which packages contain a file, what changed since a given run, and the list of runs.
+#
+# Example:
+# > python packagequery.py D:\wyde\package-index.db --file Bin\ewam.exe
+# > python packagequery.py D:\wyde\package-index.db --changes-since 12
+
+parser = argparse.ArgumentParser(description="Query the package index store written by packagebuilder.py --index-store")
+parser.add_argument('index_store', metavar='STORE', help='index store database')
+parser.add_argument('--file', action='append', default=[], help='list the packages and components containing this file (path relative to the package folder). Can be repeated.')
+parser.add_argument('--changes-since', type=int, metavar='RUN', help='list the packages, components and files added, modified or removed by the runs after RUN (0 for every run)')
+parser.add_argument('--runs', action='store_true', help='list the runs recorded, with their number of changes')
+
+def main():
+    args = parser.parse_args()
+    if not os.path.isfile(args.index_store):
+        print("Error: index store " + args.index_store + " not found")
+        exit(1)
+    index_store = packagebuilder.IndexStore(args.index_store)
+
+    if args.runs:
+        for run, run_time, policy, hash_algorithm, change_count in index_store.runs():
+            print("run " + str(run) + ": " + run_time + " UTC, policy " + policy + ", " + hash_algorithm + ", " + str(change_count) + " change(s)")
+
+    for path in args.file:
+        found = index_store.packages_containing(path)
+        if len(found) == 0:
+            print(path + ": not found")
+        for package_id, component, file_hash in found:
+            print(path + ": " + package_id + " / " + component + " (" + file_hash + ")")
+
+    if args.changes_since != None:
+        for run, package_id, component, path, state in index_store.changes_since(args.changes_since):
+            print("run " + str(run) + ": " + state + " " + " / ".join(name for name in (package_id, component, path) if name != None))
+
+    index_store.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# Tests of the binary deltas and delta archives of packagebuilder (see its --delta argument).
+#
+# Example:
+# > python -m unittest discover tests
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import packagebuilder
+
+def modified(rng, data, changes=10):
+    """Returns 'data' with 'changes' small random changes: bytes overwritten, inserted or removed"""
+    data = bytearray(data)
+    for change in range(changes):
+        position = rng.randrange(len(data) + 1)
+        operation = rng.randrange(3)
+        if operation == 0:
+            data[position:position + 8] = rng.randbytes(8)
+        elif operation == 1:
+            data[position:position] = rng.randbytes(rng.randrange(1, 200))
+        else:
+            del data[position:position + rng.randrange(1, 200)]
+    return bytes(data)
+
+class BinaryDeltaTest(unittest.TestCase):
+
+    def assertRoundTrip(self, base, target):
+        binary_delta = packagebuilder.make_binary_delta(base, target)
+        self.assertEqual(packagebuilder.apply_binary_delta(base, binary_delta), target)
+        return binary_delta
+
+    def test_empty(self):
+        rng = random.Random(0)
+        self.assertRoundTrip(b'', b'')
+        self.assertRoundTrip(b'', rng.randbytes(1000))
+        self.assertRoundTrip(rng.randbytes(1000), b'')
+
+    def test_shorter_than_a_block(self):
+        self.assertRoundTrip(b'abc', b'abd')
+        self.assertRoundTrip(b'a' * (packagebuilder.BINARY_DELTA_BLOCK_SIZE - 1), b'a' * packagebuilder.BINARY_DELTA_BLOCK_SIZE)
+
+    def test_identical(self):
+        data = random.Random(1).randbytes(100000)
+        binary_delta = self.assertRoundTrip(data, data)
+        self.assertLess(len(binary_delta), 100)
+
+    def test_fully_different(self):
+        rng = random.Random(2)
+        base = rng.randbytes(50000)
+        target = rng.randbytes(50000)
+        self.assertRoundTrip(base, target)
+        self.assertIsNone(packagebuilder.make_binary_delta(base, target, len(target) - 1))
+
+    def test_modified(self):
+        rng = random.Random(3)
+        for size in (100, 5000, 300000):
+            base = rng.randbytes(size)
+            target = modified(rng, base)
+            binary_delta = self.assertRoundTrip(base, target)
+            if size >= 5000:
+                self.assertLess(len(binary_delta), len(target) // 2)
+
+    def test_repeated_content(self):
+        base = bytes(200000)
+        target = bytearray(base)
+        target[1000] = 1
+        self.assertRoundTrip(base, bytes(target))
+        self.assertRoundTrip(b'ab' * 1000, b'ba' * 1000)
+
+    def test_not_a_binary_delta(self):
+        with self.assertRaises(ValueError):
+            packagebuilder.apply_binary_delta(b'', b'not a delta')
+
+class DeltaArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='packagebuilder-test-')
+        self.rng = random.Random(4)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write_files(self, folder, files):
+        """Write 'files' (dictionary of path -> bytes) in 'folder' of the work folder, and returns the folder and the dictionary of path -> hash"""
+        base_dir = os.path.join(self.work_dir, folder)
+        for path, data in files.items():
+            filename = os.path.join(base_dir, path)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as data_file:
+                data_file.write(data)
+        return base_dir, dict((path, packagebuilder.hash_file(os.path.join(base_dir, path))) for path in files)
+
+    def make_delta(self, base_files, files, max_file_size=None):
+        """Create the base archive of 'base_files' and the delta archive to 'files', and returns the delta archive"""
+        base_dir, base_hashes = self.write_files('base', base_files)
+        base_archive_filename = os.path.join(self.work_dir, 'base.zip')
+        packagebuilder.create_zip_archive(base_archive_filename, zipfile.ZIP_DEFLATED, base_dir, list(base_files))
+        new_dir, hashes = self.write_files('new', files)
+        delta_filename = os.path.join(self.work_dir, 'delta.zip')
+        packagebuilder.create_delta_archive(delta_filename, zipfile.ZIP_DEFLATED, base_archive_filename, base_hashes, new_dir, hashes, max_file_size)
+        return zipfile.ZipFile(delta_filename)
+
+    def manifest(self, delta_archive):
+        """Returns the delta.txt of 'delta_archive', as a dictionary of path -> state"""
+        return dict((line.split('\t')[1], line.split('\t')[0]) for line in delta_archive.read('delta.txt').decode('utf-8').splitlines())
+
+    def test_delta_archive(self):
+        small = self.rng.randbytes(20000)
+        big = self.rng.randbytes(300000)
+        base_files = { 'unchanged.bin': b'unchanged', 'small.bin': small, 'big.bin': big, 'removed.bin': b'removed' }
+        files = { 'unchanged.bin': b'unchanged', 'small.bin': modified(self.rng, small), 'big.bin': modified(self.rng, big), 'added.bin': b'added' }
+        with self.make_delta(base_files, files) as delta_archive:
+            self.assertEqual(self.manifest(delta_archive), { 'small.bin': 'patched', 'big.bin': 'patched', 'added.bin': 'added', 'removed.bin': 'removed' })
+            for path in ('small.bin', 'big.bin'):
+                self.assertEqual(packagebuilder.apply_binary_delta(base_files[path], delta_archive.read('patched/' + path)), files[path])
+            self.assertEqual(delta_archive.read('added/added.bin'), b'added')
+
+    def test_max_file_size(self):
+        small = self.rng.randbytes(20000)
+        big = self.rng.randbytes(300000)
+        base_files = { 'small.bin': small, 'big.bin': big, 'grown.bin': b'grown' }
+        files = { 'small.bin': modified(self.rng, small), 'big.bin': modified(self.rng, big), 'grown.bin': b'grown' + self.rng.randbytes(200000) }
+        with self.make_delta(base_files, files, 100000) as delta_archive:
+            # files bigger than the maximum size (or whose base file is) are stored whole
+            self.assertEqual(self.manifest(delta_archive), { 'small.bin': 'patched', 'big.bin': 'added', 'grown.bin': 'added' })
+            self.assertEqual(delta_archive.read('added/big.bin'), files['big.bin'])
+            self.assertEqual(delta_archive.read('added/grown.bin'), files['grown.bin'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# Tests of the directory index of packagebuilder (DirectoryIndex), which matches the patterns of the *.package-components files
+# against an in-memory index of a tree: it must find the same paths as glob.glob(..., recursive=True) on the file system.
+#
+# Example:
+# > python -m unittest discover tests
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import packagebuilder
+
+# Files of the test tree, relative to its root ('/' separators)
+TREE_FILES = [
+    'a.txt', '.hidden.txt', 'setup.exe',
+    'Bin/x.dll', 'Bin/x.pdb', 'Bin/.hidden/y.dll', 'Bin/sub/z.dll', 'Bin/sub/deep/w.dll', 'Bin/sub/deep/w.txt',
+    'Doc/readme.txt', 'Doc/.config', 'Doc/Help/index.html',
+]
+
+# Patterns compared with glob.glob: hidden files, '**' at the start, middle and end, patterns without magic, trailing separators
+PATTERNS = [
+    '*', '*.txt', '.*', '*/', '[!B]*', 'B?n/[sx]*', 'Doc/.config', 'Doc/*',
+    '**', '**/', '**/*', '**/*.dll', '**/.hidden/*', '**/deep/*',
+    'Bin/**', 'Bin/**/', 'Bin/**/*.dll', 'Bin/**/w.*', '*/sub/**/*.dll',
+    'a.txt', 'Bin/sub/z.dll', 'missing.txt', 'Bin/missing/*.dll', 'Bin', 'Bin/', 'Bin/sub/', 'a.txt/', 'Empty', 'Empty/*',
+]
+
+# Patterns going through the symbolic link to the Bin folder (on systems where it can be created)
+LINK_PATTERNS = [ 'link', 'link/', 'link/*.dll', 'link/**/*.dll', '**/z.dll', '*/sub/*' ]
+
+class DirectoryIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp(prefix='packagebuilder-test-')
+        for path in TREE_FILES:
+            self.write_file(path)
+        os.makedirs(os.path.join(self.root_dir, 'Empty'))
+        try:
+            os.symlink(os.path.join(self.root_dir, 'Bin'), os.path.join(self.root_dir, 'link'), target_is_directory=True)
+            self.patterns = PATTERNS + LINK_PATTERNS
+        except (OSError, NotImplementedError): # Windows without the privilege to create symbolic links
+            self.patterns = PATTERNS
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir, ignore_errors=True)
+
+    def write_file(self, path):
+        filename = os.path.join(self.root_dir, *path.split('/'))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as data_file:
+            data_file.write(path)
+
+    def assertSameAsGlob(self, directory_index, root_dir=None):
+        """Check that 'directory_index' finds the same paths and files as glob.glob in 'root_dir' (the root of the test tree by default), for every pattern"""
+        root_dir = root_dir if root_dir != None else self.root_dir
+        for pattern in self.patterns:
+            pattern = pattern.replace('/', os.sep)
+            with self.subTest(pattern=pattern):
+                self.assertEqual(sorted(directory_index.glob(pattern)), sorted(glob.glob(pattern, root_dir=root_dir, recursive=True)))
+                self.assertEqual(sorted(packagebuilder.find_files(pattern, directory_index)), sorted(packagebuilder.find_files(pattern, None, root_dir)))
+
+    def test_glob(self):
+        self.assertSameAsGlob(packagebuilder.DirectoryIndex(self.root_dir))
+
+    def test_subdirectory(self):
+        directory_index = packagebuilder.DirectoryIndex(self.root_dir)
+        self.assertSameAsGlob(directory_index.subdirectory('Bin'), os.path.join(self.root_dir, 'Bin'))
+        self.assertSameAsGlob(directory_index.subdirectory(os.path.join('Doc', 'Help')), os.path.join(self.root_dir, 'Doc', 'Help'))
+
+    def test_path_matches(self):
+        files = [ os.path.normpath(path) for path in TREE_FILES ]
+        for pattern in self.patterns:
+            pattern = pattern.replace('/', os.sep)
+            found_files = set(packagebuilder.find_files(pattern, None, self.root_dir))
+            for path in files:
+                with self.subTest(pattern=pattern, path=path):
+                    self.assertEqual(packagebuilder.DirectoryIndex.path_matches(pattern, path), path in found_files)
+        self.assertFalse(packagebuilder.DirectoryIndex.path_matches(os.path.join('..', '*.txt'), 'a.txt'))
+
+    def test_update(self):
+        directory_index = packagebuilder.DirectoryIndex(self.root_dir)
+        # files and folders created, removed, or replaced by a file or folder of the same name
+        self.write_file('Bin/new.dll')
+        self.write_file('New/sub/n.dll')
+        os.remove(os.path.join(self.root_dir, 'Doc', 'readme.txt'))
+        shutil.rmtree(os.path.join(self.root_dir, 'Bin', 'sub'))
+        os.remove(os.path.join(self.root_dir, 'setup.exe'))
+        self.write_file('setup.exe/setup.dll')
+        shutil.rmtree(os.path.join(self.root_dir, 'Empty'))
+        self.write_file('Empty')
+        for path in [ 'Bin/new.dll', 'New/sub/n.dll', 'Doc/readme.txt', 'Bin/sub', 'setup.exe', 'Empty' ]:
+            directory_index.update(os.path.normpath(path))
+        self.assertSameAsGlob(directory_index)
+        self.assertEqual(directory_index.entries, packagebuilder.DirectoryIndex(self.root_dir).entries)
+
+if __name__ == '__main__':
+    unittest.main()
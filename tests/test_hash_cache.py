@@ -0,0 +1,143 @@
+# Tests of the file hash cache of packagebuilder (see its --hash-cache and --rehash arguments): invalidation of the cached hashes,
+# racy files, and pruning of the files not found by a run.
+#
+# Example:
+# > python -m unittest discover tests
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import packagebuilder
+
+# Modification time of the test files: old enough not to be racy (see HashCache.RACY_DELAY_NS)
+OLD_MTIME_NS = time.time_ns() - 3600 * 1000000000
+
+class HashCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='packagebuilder-test-')
+        self.cache_file = os.path.join(self.work_dir, 'package-index.xml.hash-cache')
+        self.hash_cache = packagebuilder.HashCache(self.cache_file)
+
+    def tearDown(self):
+        self.hash_cache.connection.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write_file(self, name, data, mtime_ns=OLD_MTIME_NS):
+        """Write file 'name' of the work folder with 'data' and the given modification time, and returns its path"""
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'w') as data_file:
+            data_file.write(data)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+        return path
+
+    def store(self, path):
+        """Hash the file at 'path' and store its hash in the cache, and returns the hash"""
+        file_hash = packagebuilder.hash_file(path)
+        self.hash_cache.store(path, os.stat(path), file_hash)
+        return file_hash
+
+    def reopen(self, rehash=False):
+        """Save the cache and open it again, as the next run does"""
+        self.hash_cache.save()
+        self.hash_cache = packagebuilder.HashCache(self.cache_file, rehash)
+
+    def lookup(self, path):
+        return self.hash_cache.lookup(path, os.stat(path))
+
+    def test_unchanged(self):
+        path = self.write_file('a.txt', 'content')
+        file_hash = self.store(path)
+        self.reopen()
+        self.assertEqual(self.lookup(path), file_hash)
+        self.assertEqual((self.hash_cache.hits, self.hash_cache.misses), (1, 0))
+
+    def test_size_changed(self):
+        path = self.write_file('a.txt', 'content')
+        self.store(path)
+        self.reopen()
+        self.write_file('a.txt', 'longer content')
+        self.assertIsNone(self.lookup(path))
+        self.assertEqual((self.hash_cache.hits, self.hash_cache.misses), (0, 1))
+
+    def test_mtime_changed(self):
+        path = self.write_file('a.txt', 'content')
+        self.store(path)
+        self.reopen()
+        self.write_file('a.txt', 'CONTENT', OLD_MTIME_NS + 1000000000)
+        self.assertIsNone(self.lookup(path))
+
+    def test_inode_changed(self):
+        path = self.write_file('a.txt', 'content')
+        self.store(path)
+        self.reopen()
+        # same size and modification time, but another file replaced it
+        new_path = self.write_file('b.txt', 'CONTENT')
+        os.replace(new_path, path)
+        self.assertIsNone(self.lookup(path))
+
+    def test_racy_file(self):
+        # a file modified right before the run (or during it) could change again within the same mtime tick
+        path = self.write_file('a.txt', 'content', time.time_ns())
+        self.store(path)
+        self.assertIsNone(self.lookup(path))
+        self.reopen()
+        self.assertIsNone(self.lookup(path))
+        # once the file is older than the racy delay when the run starts, its hash is cached
+        os.utime(path, ns=(self.hash_cache.start_time_ns - packagebuilder.HashCache.RACY_DELAY_NS - 1,) * 2)
+        file_hash = self.store(path)
+        self.assertEqual(self.lookup(path), file_hash)
+
+    def test_rehash(self):
+        path = self.write_file('a.txt', 'content')
+        self.store(path)
+        self.reopen(rehash=True)
+        self.assertIsNone(self.lookup(path))
+        # the cache is refreshed with the new hashes
+        self.hash_cache.store(path, os.stat(path), 'new hash')
+        self.reopen()
+        self.assertEqual(self.lookup(path), 'new hash')
+
+    def test_prune(self):
+        kept_path = self.write_file('kept.txt', 'kept')
+        unused_path = self.write_file('unused.txt', 'unused')
+        removed_path = self.write_file('removed.txt', 'removed')
+        kept_hash = self.store(kept_path)
+        unused_hash = self.store(unused_path)
+        removed_hash = self.store(removed_path)
+        for file_hash in (kept_hash, unused_hash, removed_hash):
+            self.hash_cache.store_stored(file_hash, True)
+        self.reopen()
+
+        # a run only finding kept.txt: the other files are removed from the cache, with their adaptive compression decisions
+        os.remove(removed_path)
+        self.assertEqual(self.lookup(kept_path), kept_hash)
+        self.hash_cache.commit(prune=True)
+        self.assertIsNone(self.lookup(unused_path))
+        self.assertIsNone(self.hash_cache.lookup_stored(unused_hash))
+        self.reopen()
+        self.assertEqual(self.lookup(kept_path), kept_hash)
+        self.assertIsNone(self.lookup(unused_path))
+        self.assertEqual(self.hash_cache.connection.execute("SELECT path FROM file_hashes").fetchall(), [ (packagebuilder.HashCache.key(kept_path),) ])
+        self.assertEqual(self.hash_cache.lookup_stored(kept_hash), True)
+        self.assertIsNone(self.hash_cache.lookup_stored(removed_hash))
+
+    def test_commit_without_prune(self):
+        # the updates of --watch only look up the files changed: the other entries are kept
+        first_path = self.write_file('first.txt', 'first')
+        second_path = self.write_file('second.txt', 'second')
+        second_hash = self.store(second_path)
+        self.store(first_path)
+        self.reopen()
+        self.lookup(first_path)
+        self.hash_cache.commit()
+        self.reopen()
+        self.assertEqual(self.lookup(second_path), second_hash)
+
+if __name__ == '__main__':
+    unittest.main()
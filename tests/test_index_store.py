@@ -0,0 +1,158 @@
+# Tests of the index store of packagebuilder (see its --index-store argument): IndexStore.diff must find the same states as
+# diff_package_index, and the package index written after either diff must be the same.
+#
+# Example:
+# > python -m unittest discover tests
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import packagebuilder
+
+# Packages of the previous run: package id -> component name -> (compression, dictionary of path -> content)
+OLD_PACKAGES = {
+    'ewam-6.1': {
+        'Bin': ('', { os.path.join('Bin', 'ewam.exe'): b'exe', os.path.join('Bin', 'ewam.dll'): b'dll' }),
+        'Tgv': ('lzma', { os.path.join('Tgv', 'a.tgv'): b'a', os.path.join('Tgv', 'b.tgv'): b'b', os.path.join('Tgv', 'c.tgv'): b'c' }),
+    },
+    'wynsure-5.8': {
+        'Bin': ('', { os.path.join('Bin', 'wynsure.exe'): b'exe' }),
+        'Doc': ('deflate', { os.path.join('Doc', 'readme.txt'): b'readme' }),
+    },
+}
+
+def make_package_index(packages):
+    """Returns a PackageIndex of 'packages' (see OLD_PACKAGES), in the state of a newly scanned index"""
+    package_index = packagebuilder.PackageIndex()
+    for package_id, components in packages.items():
+        package = packagebuilder.Package('', package_id, package_id + ' package', package_id.split('-')[0], package_id.split('-')[1], package_id)
+        for name, (compression, files) in components.items():
+            component = packagebuilder.Component(name, compression)
+            for path, content in files.items():
+                componentFile = packagebuilder.File(path)
+                componentFile.hash = hashlib.md5(content).hexdigest()
+                component.append(componentFile)
+            package.append(component)
+        package_index.append(package)
+    # the delta and parts of a component are kept from the previous run
+    tgv = package_index.packages_by_id['ewam-6.1'].components_by_name['Tgv']
+    tgv.delta = packagebuilder.Delta('ewam-6.0', '6.0', 'Tgv.delta-6.0.zip', 'ab' * 16, 1234)
+    tgv.parts = [ packagebuilder.Part('Tgv.part-000.zip', 'cd' * 16), packagebuilder.Part('Tgv.part-001.zip', 'ef' * 16) ]
+    return package_index
+
+def copy_packages(packages):
+    """Returns a copy of 'packages' (see OLD_PACKAGES) that can be modified"""
+    return dict((package_id, dict((name, (compression, dict(files))) for name, (compression, files) in components.items())) for package_id, components in packages.items())
+
+def index_states(package_index):
+    """Returns the states of the packages, components and files of 'package_index', sorted, as nested lists"""
+    package_index.sort()
+    return [ (package.id, package.state, [ (component.name, component.state, [ (componentFile.path, componentFile.state, componentFile.hash) for componentFile in component.files ]) for component in package.components ]) for package in package_index.packages ]
+
+class IndexStoreDiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='packagebuilder-test-')
+        self.saved_cwd = os.getcwd()
+        self.saved_policy = packagebuilder.package_index_policy
+        # removed files are only listed if they exist (see Component.append_file), relative to the current directory
+        os.chdir(self.work_dir)
+        for components in OLD_PACKAGES.values():
+            for compression, files in components.values():
+                for path, content in files.items():
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'wb') as data_file:
+                        data_file.write(content)
+
+        # previous run, as a package index file and in the store
+        self.old_index_file = os.path.join(self.work_dir, 'old-package-index.xml')
+        make_package_index(OLD_PACKAGES).write_xml(self.old_index_file)
+        self.index_store = packagebuilder.IndexStore(os.path.join(self.work_dir, 'index-store.db'))
+        self.index_store.record_run(make_package_index(OLD_PACKAGES), 'overwrite')
+
+    def tearDown(self):
+        self.index_store.close()
+        os.chdir(self.saved_cwd)
+        packagebuilder.package_index_policy = self.saved_policy
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def assertSameDiff(self, packages, policy='update'):
+        """Diff the package index of 'packages' with the previous run, with diff_package_index and with the store, and check the states and the written package indexes are the same. Returns the states."""
+        packagebuilder.package_index_policy = policy
+        old_package_index = packagebuilder.PackageIndex()
+        old_package_index.import_from_xml(self.old_index_file)
+        package_index = make_package_index(packages)
+        packagebuilder.diff_package_index(package_index, old_package_index, policy)
+        stored_package_index = make_package_index(packages)
+        self.index_store.diff(stored_package_index, policy)
+
+        states = index_states(package_index)
+        self.assertEqual(index_states(stored_package_index), states)
+        package_index.write_xml(os.path.join(self.work_dir, 'package-index.xml'))
+        stored_package_index.write_xml(os.path.join(self.work_dir, 'stored-package-index.xml'))
+        with open(os.path.join(self.work_dir, 'package-index.xml')) as index_file, open(os.path.join(self.work_dir, 'stored-package-index.xml')) as stored_index_file:
+            self.assertEqual(stored_index_file.read(), index_file.read())
+        return dict((package_id, (state, dict((name, (component_state, dict((path, file_state) for path, file_state, file_hash in files))) for name, component_state, files in components))) for package_id, state, components in states)
+
+    def test_unchanged(self):
+        states = self.assertSameDiff(OLD_PACKAGES)
+        self.assertEqual(set(state for state, components in states.values()), { 'unchanged' })
+
+    def test_files(self):
+        packages = copy_packages(OLD_PACKAGES)
+        tgv_files = packages['ewam-6.1']['Tgv'][1]
+        tgv_files[os.path.join('Tgv', 'a.tgv')] = b'a2'
+        del tgv_files[os.path.join('Tgv', 'b.tgv')]
+        tgv_files[os.path.join('Tgv', 'd.tgv')] = b'd'
+        states = self.assertSameDiff(packages)
+        self.assertEqual(states['ewam-6.1'][0], 'modified')
+        self.assertEqual(states['ewam-6.1'][1]['Bin'][0], 'unchanged')
+        self.assertEqual(states['ewam-6.1'][1]['Tgv'], ('modified', { os.path.join('Tgv', 'a.tgv'): 'modified', os.path.join('Tgv', 'b.tgv'): 'removed', os.path.join('Tgv', 'c.tgv'): 'unchanged', os.path.join('Tgv', 'd.tgv'): 'added' }))
+        self.assertEqual(states['wynsure-5.8'][0], 'unchanged')
+
+    def test_added_package_and_component(self):
+        packages = copy_packages(OLD_PACKAGES)
+        packages['wynsure-5.8']['Help'] = ('deflate', { os.path.join('Help', 'index.html'): b'help' })
+        packages['wynsure-5.9'] = { 'Bin': ('', { os.path.join('Bin', 'wynsure.exe'): b'exe 5.9' }) }
+        states = self.assertSameDiff(packages)
+        self.assertEqual(states['wynsure-5.8'][0], 'modified')
+        self.assertEqual(states['wynsure-5.8'][1]['Help'][0], 'added')
+        self.assertEqual(states['wynsure-5.9'][0], 'added')
+
+    def test_removed_component(self):
+        packages = copy_packages(OLD_PACKAGES)
+        del packages['wynsure-5.8']['Doc']
+        states = self.assertSameDiff(packages)
+        self.assertEqual(states['wynsure-5.8'][0], 'modified')
+        self.assertEqual(states['wynsure-5.8'][1]['Doc'][0], 'removed')
+        self.assertEqual(states['wynsure-5.8'][1]['Bin'][0], 'unchanged')
+
+    def test_removed_package(self):
+        packages = copy_packages(OLD_PACKAGES)
+        del packages['wynsure-5.8']
+        states = self.assertSameDiff(packages)
+        self.assertEqual(states['wynsure-5.8'][0], 'removed')
+        self.assertEqual(states['ewam-6.1'][0], 'unchanged')
+
+    def test_compression_change(self):
+        packages = copy_packages(OLD_PACKAGES)
+        packages['wynsure-5.8']['Doc'] = ('lzma', packages['wynsure-5.8']['Doc'][1])
+        states = self.assertSameDiff(packages)
+        self.assertEqual(states['wynsure-5.8'][0], 'modified')
+        self.assertEqual(states['wynsure-5.8'][1]['Doc'][0], 'modifiedcompression')
+
+    def test_update_keep_old_packages(self):
+        packages = copy_packages(OLD_PACKAGES)
+        del packages['wynsure-5.8']
+        packages['ewam-6.1']['Bin'][1][os.path.join('Bin', 'ewam.exe')] = b'exe2'
+        states = self.assertSameDiff(packages, 'update-keep-old-packages')
+        self.assertEqual(states['wynsure-5.8'][0], 'unchanged')
+        self.assertEqual(states['ewam-6.1'][1]['Bin'][0], 'modified')
+
+if __name__ == '__main__':
+    unittest.main()